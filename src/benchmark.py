@@ -0,0 +1,153 @@
+"""dbgen で作った DB で読み込み・計算・保存の各段階の時間とメモリを測る.
+
+    python src/benchmark.py [--packets N] [--rows MIN MAX] [--commands N] [--repeat N] [--save-baseline] [--tolerance R]
+
+結果は benchmark-baseline.json の同じ規模の結果と比べ, tolerance を超えて遅く (大きく) なった段階があれば終了コード 1 を返す.
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+from pathlib import Path
+
+import cmddb
+import dbgen
+import project
+import tlmdb
+
+baseline_file = Path(__file__).parents[1] / "benchmark-baseline.json"
+# これより小さい時間の差はタイマーや OS のゆらぎとして無視する. 1 CPU のマシンでは 10 ms 程度の段階が倍近くぶれることがある
+noise_seconds = 0.05
+
+
+class Stage(typing.NamedTuple):
+    name: str
+    rows: int
+    run: typing.Callable[[], typing.Any]
+
+
+def measure(run: typing.Callable[[], typing.Any], repeat: int) -> typing.Tuple[float, float]:
+    # 時間は repeat 回の最小値. tracemalloc は遅くなるので, ピークメモリは別にもう 1 回実行して測る
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(seconds), peak / 1e6
+
+
+def make_stages(tlm_settings: dict, cmd_settings: dict) -> typing.List[Stage]:
+    tlm = tlmdb.process_csv_files(tlm_settings)
+    calced = [{**data, "data": tlmdb.calc_data(data["data"].copy())} for data in tlm]
+    headers = [tlmdb.make_header_frame(data) for data in calced]
+    tlm_rows = sum(len(data["data"]) for data in tlm)
+    cmd = cmddb.process_csv_files(cmd_settings)
+    cmd_rows = sum(len(data["data"]) for data in cmd.values())
+    allocation = cmd_settings["allocation"]
+    saved = Path(tlm_settings["dest_path"]).parent / "saved"
+    saved.mkdir(parents=True, exist_ok=True)
+
+    def clear(path: Path) -> None:
+        # 内容が同じだと書き込まないので, 毎回書き込むように出力先と記録を消す
+        tlmdb._written.clear()
+        for csv_path in path.iterdir():
+            csv_path.unlink()
+
+    def save() -> None:
+        clear(saved)
+        for header, data in zip(headers, calced):
+            tlmdb.save(header, {**data, "path": saved / data["path"].name}, tlm_settings)
+
+    def export() -> None:
+        clear(Path(tlm_settings["dest_path"]))
+        for header, data in zip(headers, calced):
+            tlmdb.export(header, data, tlm_settings, save_source=False)
+
+    return [
+        Stage("tlm.process_csv_files", tlm_rows, lambda: tlmdb.process_csv_files(tlm_settings)),
+        Stage("tlm.extract_data", tlm_rows, lambda: [tlmdb.extract_data(data["path"], tlm_settings) for data in tlm]),
+        Stage("tlm.calc_data", tlm_rows, lambda: [tlmdb.calc_data(data["data"].copy()) for data in tlm]),
+        Stage("tlm.save", tlm_rows, save),
+        Stage("tlm.export", tlm_rows, export),
+        Stage("cmd.process_csv_files", cmd_rows, lambda: cmddb.process_csv_files(cmd_settings)),
+        Stage("cmd.calc_cmd_db", len(cmd["CMD_DB"]["data"]), lambda: cmddb.calc_cmd_db(allocation, cmd["CMD_DB"]["data"].copy())),
+    ]
+
+
+def run(packets: int, rows: typing.Tuple[int, int], commands: int, repeat: int, seed: int = 0) -> typing.Dict[str, dict]:
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="tlmdb-bench-") as tmp_dir:
+        path_base, settings = project.load_settings(dbgen.generate(Path(tmp_dir), packets, rows, commands, seed))
+        tlm_settings = project.tlmdb_settings(path_base, settings, "generated")
+        Path(tlm_settings["dest_path"]).mkdir(parents=True, exist_ok=True)
+        cmd_settings = project.cmddb_settings(path_base, settings, "generated")
+        for stage in make_stages(tlm_settings, cmd_settings):
+            seconds, peak_mb = measure(stage.run, repeat)
+            results[stage.name] = {"rows": stage.rows, "seconds": seconds, "rows_per_sec": stage.rows / seconds, "peak_mb": peak_mb}
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> typing.List[str]:
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result["seconds"] > max(base["seconds"] * (1 + tolerance), base["seconds"] + noise_seconds):
+            regressions.append(f"{name}: time {result['seconds']:.3f}s > baseline {base['seconds']:.3f}s (+{tolerance:.0%})")
+        if result["peak_mb"] > base["peak_mb"] * (1 + tolerance):
+            regressions.append(f"{name}: peak memory {result['peak_mb']:.1f}MB > baseline {base['peak_mb']:.1f}MB (+{tolerance:.0%})")
+    return regressions
+
+
+def print_table(results: dict, baseline: dict) -> None:
+    print(f"{'stage':<24}{'rows':>9}{'seconds':>10}{'rows/s':>12}{'peak MB':>10}{'vs base':>9}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        ratio = f"{result['seconds'] / base['seconds']:.2f}x" if base else "-"
+        print(f"{name:<24}{result['rows']:>9}{result['seconds']:>10.3f}{result['rows_per_sec']:>12.0f}{result['peak_mb']:>10.1f}{ratio:>9}")
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark TLM DB / CMD DB parsing, calculation and saving on a synthetic DB.")
+    parser.add_argument("--packets", type=int, default=432, help="number of TLM packets (default: 432)")
+    parser.add_argument("--rows", type=int, nargs=2, default=[50, 800], metavar=("MIN", "MAX"), help="rows per packet (default: 50 800)")
+    parser.add_argument("--commands", type=int, default=5000, help="number of commands in CMD_DB (default: 5000)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage; the fastest is reported (default: 3)")
+    parser.add_argument("--baseline", type=Path, default=baseline_file, help=f"baseline file (default: {baseline_file.name})")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline for this scale")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed slowdown / growth before failing (default: 0.3)")
+    args = parser.parse_args(argv)
+
+    scale = f"{args.packets}x{args.rows[0]}-{args.rows[1]}/{args.commands}"
+    try:
+        baselines = json.loads(args.baseline.read_text())
+    except (OSError, ValueError):
+        baselines = {}
+    results = run(args.packets, tuple(args.rows), args.commands, args.repeat)
+    print_table(results, baselines.get(scale, {}))
+
+    if args.save_baseline:
+        baselines[scale] = results
+        args.baseline.write_text(json.dumps(baselines, indent=2, sort_keys=True) + "\n")
+        print(f"saved baseline for {scale} to {args.baseline}")
+        return 0
+    if scale not in baselines:
+        print(f"no baseline for {scale}; run with --save-baseline to store one")
+        return 0
+    regressions = compare(results, baselines[scale], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""TLM DB と CMD DB を, エディタを使わずにスクリプトからまとめて編集する.
+
+    import bulkedit
+
+    with bulkedit.Transaction.open("project_name") as tx:
+        tx.replace("VarOrFunc", "g_old.", "g_new.")  # 全 packet の VarOrFunc の置換
+        tx.update("ExtType", "TC_FRAME", where=lambda df: df["Name"].str.startswith("TF_"))
+        tx.replace_commands("CMD_DB", "Name", r"^Cmd_OLD_", "Cmd_NEW_", regex=True)
+    # with を抜けると commit する. 例外で抜けたときは何も書かない
+
+変更は commit() までメモリ上に持つ. commit() は変更のあった全ファイルを一時ファイルに並列に書き, 全部書けてから置き換える.
+置き換えの途中で失敗したら, 置き換え済みのファイルを元の内容に戻す.
+"""
+
+import hashlib
+import os
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import cmddb
+import project
+import tlmdb
+
+Where = typing.Callable[[pd.DataFrame], typing.Any]
+
+
+class Staged(typing.NamedTuple):
+    path: Path
+    digest: str  # 読み込んだときの内容の digest
+    content: bytes
+
+
+def digest_of(content: bytes) -> str:
+    return hashlib.sha1(content).hexdigest()
+
+
+def retype(df: pd.DataFrame, rows: pd.Index) -> None:
+    # VarType を変えた行の BitLen を VarType から決め直す. bitfield の行は BitLen をそのまま使う
+    var_type = df["VarType"].astype(object)
+    is_cont = var_type == "||"
+    is_field = is_cont | is_cont.shift(-1, fill_value=False)
+    rows = rows[~is_field[rows].to_numpy()]
+    df.loc[rows, "BitLen"] = var_type[rows].map(tlmdb.type2bit).astype(np.int32)
+
+
+def validate(df: pd.DataFrame, column: str, values: pd.Series, name: str) -> pd.Series:
+    # 列の型に合わない値は ValueError にする. 数値の列は型を揃えた値を返す
+    dtype = df[column].dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        invalid = ~values.isin(dtype.categories)
+        if invalid.any():
+            raise ValueError(f"{name}: {values[invalid].iloc[0]!r} is not a valid {column} ({', '.join(map(str, dtype.categories))})")
+    elif dtype.kind in "iuf":
+        try:
+            return values.astype(dtype)
+        except (TypeError, ValueError):
+            raise ValueError(f"{name}: {column} must be a number") from None
+    return values
+
+
+class Transaction:
+    """TLM DB の packet と CMD_DB / BCT の一括編集.
+
+    packet は使うときに読み, 編集したものだけを書く. 置換や更新は対象の全 packet を 1 つの表につないでまとめて行う.
+    """
+
+    def __init__(self, tlm_settings: typing.Optional[dict] = None, cmd_settings: typing.Optional[dict] = None, jobs: typing.Optional[int] = None):
+        self.tlm_settings = tlm_settings
+        self.cmd_settings = cmd_settings
+        self.jobs = jobs
+        self.loader = tlmdb.PacketLoader(tlm_settings) if tlm_settings else None
+        self._packets: typing.Dict[str, dict] = {}
+        self._tables: typing.Dict[str, dict] = {}
+        self._digests: typing.Dict[Path, str] = {}
+        self._dirty: typing.Set[typing.Tuple[str, str]] = set()  # ("packet", 名前) / ("table", CMD_DB or BCT)
+
+    @classmethod
+    def open(cls, name: str, settings_file: typing.Optional[Path] = None, jobs: typing.Optional[int] = None) -> "Transaction":
+        """settings の project name の [name.tlmdb] と [name.cmddb] (ある方) を編集する."""
+        path_base, settings = project.load_settings(settings_file)
+        tlm = project.tlmdb_settings(path_base, settings, name) if name in project.sections(settings, "tlmdb") else None
+        cmd = project.cmddb_settings(path_base, settings, name) if name in project.sections(settings, "cmddb") else None
+        if tlm is None and cmd is None:
+            raise ValueError(f"unknown project: {name}")
+        return cls(tlm, cmd, jobs)
+
+    def __enter__(self) -> "Transaction":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        if self.loader is not None:
+            self.loader.shutdown()
+
+    # 読み込み
+
+    def packet_names(self) -> typing.List[str]:
+        if self.loader is None:
+            raise ValueError("no [*.tlmdb] settings for this transaction")
+        return self.loader.names()
+
+    def packet(self, name: str) -> pd.DataFrame:
+        """編集中の packet の表. 直接書き換えたときは edit_packet() を使うか mark() で知らせる."""
+        if name not in self._packets:
+            if name not in self.packet_names():
+                raise ValueError(f"unknown packet: {name}")
+            csv_path = self.loader.index[name]
+            self._digests[csv_path] = self.loader.cache.fingerprint(csv_path)[3]
+            self._packets[name] = self.loader.get(name)
+        return self._packets[name]["data"]
+
+    def table(self, kind: str) -> pd.DataFrame:
+        """編集中の CMD_DB / BCT の表."""
+        if kind not in self._tables:
+            if self.cmd_settings is None or kind not in cmddb.loaders:
+                raise ValueError(f"unknown table: {kind}")
+            path = Path(self.cmd_settings[cmddb.path_keys[kind]])
+            self._digests[path] = digest_of(path.read_bytes())
+            self._tables[kind] = cmddb.loaders[kind](path)
+        return self._tables[kind]["data"]
+
+    def _frames(self, target: str, names: typing.Optional[typing.Iterable[str]]) -> typing.Dict[str, pd.DataFrame]:
+        if target == "packet":
+            names = self.packet_names() if names is None else list(names)
+            if self.loader is not None:
+                self.loader.prewarm([name for name in names if name not in self._packets])
+            return {name: self.packet(name) for name in names}
+        return {target: self.table(target)}
+
+    # 編集
+
+    def mark(self, name: str, target: str = "packet") -> None:
+        """packet / 表を書き換えたことを記録する. 直接書き換えたときに呼ぶ. target は "packet" か "CMD_DB" / "BCT"."""
+        self._dirty.add(("packet", name) if target == "packet" else ("table", target))
+
+    def _apply(self, target: str, frames: typing.Dict[str, pd.DataFrame], column: str, new: pd.Series) -> int:
+        # new は (名前, 行) の index の, 変わるセルだけの値. 全部の値を確かめてから書き換える
+        if not len(new):
+            return 0
+        parts = {name: part.droplevel(0) for name, part in new.groupby(level=0, sort=False)}
+        parts = {name: validate(frames[name], column, part, name) for name, part in parts.items()}
+        for name, part in parts.items():
+            df = frames[name]
+            df.loc[part.index, column] = part
+            if target == "packet" and column in ("VarType", "BitLen"):
+                if column == "VarType":
+                    retype(df, part.index)
+                tlmdb.calc_data(df)
+            self.mark(name, target)
+        return len(new)
+
+    def _combined(self, frames: typing.Dict[str, pd.DataFrame], columns: typing.Optional[typing.List[str]] = None) -> pd.DataFrame:
+        # 全部の表を (名前, 行) の index で 1 つにつなぐ. columns を指定したらその列だけ
+        for name, df in frames.items():
+            missing = [column for column in columns or [] if column not in df]
+            if missing:
+                raise ValueError(f"{name}: no column {missing[0]!r}")
+        if not frames:
+            return pd.DataFrame(columns=columns or [], index=pd.MultiIndex.from_tuples([], names=["Packet", "Row"]))
+        return pd.concat({name: df if columns is None else df[columns] for name, df in frames.items()}, names=["Packet", "Row"])
+
+    def _replace(self, target: str, names, column: str, pattern: str, repl: str, regex: bool) -> int:
+        frames = self._frames(target, names)
+        text = self._combined(frames, [column])[column].astype(object).fillna("").astype(str)
+        replaced = text.str.replace(pattern, repl, regex=regex)
+        return self._apply(target, frames, column, replaced[replaced != text])
+
+    def _update(self, target: str, names, column: str, value: typing.Any, where: typing.Optional[Where]) -> int:
+        frames = self._frames(target, names)
+        # where は他の列も見るので, そのときは全部の列をつなぐ
+        combined = self._combined(frames, [column] if where is None else None)
+        if column not in combined:
+            raise ValueError(f"no column {column!r}")
+        mask = np.ones(len(combined), dtype=bool) if where is None else np.asarray(where(combined), dtype=bool)
+        current = combined[column].astype(object)
+        same = (current == value).to_numpy(dtype=bool) | (current.isna().to_numpy() & bool(pd.isna(value)))
+        return self._apply(target, frames, column, pd.Series(value, index=combined.index[mask & ~same], dtype=object))
+
+    def replace(self, column: str, pattern: str, repl: str, regex: bool = False, packets: typing.Optional[typing.Iterable[str]] = None) -> int:
+        """packets (None なら全 packet) の column の文字列を置換し, 変わったセルの数を返す."""
+        return self._replace("packet", packets, column, pattern, repl, regex)
+
+    def update(
+        self, column: str, value: typing.Any, where: typing.Optional[Where] = None, packets: typing.Optional[typing.Iterable[str]] = None
+    ) -> int:
+        """where(df) が真の行の column を value にし, 変わったセルの数を返す. df は packets をつないだ表で, index は (Packet, Row)."""
+        return self._update("packet", packets, column, value, where)
+
+    def replace_commands(self, kind: str, column: str, pattern: str, repl: str, regex: bool = False) -> int:
+        return self._replace(kind, None, column, pattern, repl, regex)
+
+    def update_commands(self, kind: str, column: str, value: typing.Any, where: typing.Optional[Where] = None) -> int:
+        return self._update(kind, None, column, value, where)
+
+    def edit_packet(self, name: str, edit: typing.Callable[[pd.DataFrame], pd.DataFrame]) -> None:
+        """行の追加や削除など, 置換と更新でできない編集. edit は表を受け取り編集後の表を返す. OctPos / BitPos は計算し直す."""
+        df = edit(self.packet(name).copy()).reset_index(drop=True)
+        self._packets[name]["data"] = tlmdb.calc_data(df)
+        self.mark(name)
+
+    def edit_table(self, kind: str, edit: typing.Callable[[pd.DataFrame], pd.DataFrame]) -> None:
+        """CMD_DB の区間の組み替えなど. Code と Num Params は commit() で計算し直す."""
+        df = edit(self.table(kind).copy()).reset_index(drop=True)
+        self._tables[kind]["data"] = df
+        self.mark(kind, kind)
+
+    # 確定
+
+    def staged(self) -> typing.List[Staged]:
+        """書き込む内容. 編集しても元と同じ内容になったファイルは含まない."""
+        items = []
+        for target, name in sorted(self._dirty):
+            if target == "packet":
+                data = self._packets[name]
+                content = tlmdb.render_source(tlmdb.make_header_frame(data), data)
+            else:
+                data = self._tables[name]
+                df = data["data"]
+                if name == "CMD_DB":
+                    df, _ = cmddb.calc_cmd_db(self.cmd_settings.get("allocation", {}), df.copy())
+                content = cmddb.render({**data, "data": df}).encode("utf-8")
+            path = Path(data["path"])
+            if digest_of(content) != self._digests[path]:
+                items.append(Staged(path, self._digests[path], content))
+        return items
+
+    def commit(self) -> typing.List[Path]:
+        """編集したファイルをまとめて書き, 書いたファイルを返す.
+
+        読み込んでから外部で書き換えられたファイルがあれば何も書かずに RuntimeError にする.
+        """
+        items = self.staged()
+        originals = {item.path: item.path.read_bytes() for item in items}
+        conflicts = [item.path.name for item in items if digest_of(originals[item.path]) != item.digest]
+        if conflicts:
+            raise RuntimeError(f"changed on disk since they were read: {', '.join(conflicts)}")
+        # 時間のかかる書き込みと fsync は並列に行い, 全部書けてから置き換える
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(tlmdb.write_temp, item.path, item.content) for item in items]
+        temps = [future.result() if future.exception() is None else None for future in futures]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            for tmp_name in temps:
+                if tmp_name is not None:
+                    os.unlink(tmp_name)
+            raise errors[0]
+        replaced = []
+        try:
+            for item, tmp_name in zip(items, temps):
+                os.replace(tmp_name, item.path)
+                replaced.append(item.path)
+        except BaseException:
+            for path in replaced:
+                tlmdb.atomic_write(path, originals[path])
+            for item, tmp_name in zip(items, temps):
+                if item.path not in replaced and os.path.exists(tmp_name):
+                    os.unlink(tmp_name)
+            raise
+        for item in items:
+            self._digests[item.path] = digest_of(item.content)
+        self._dirty.clear()
+        return replaced
+
+    def rollback(self) -> None:
+        """commit していない編集を捨てる. 次に使うときに読み直す."""
+        self._packets.clear()
+        self._tables.clear()
+        self._digests.clear()
+        self._dirty.clear()
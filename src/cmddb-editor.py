@@ -1,13 +1,21 @@
-import streamlit as st
+import functools
 import os
-import numpy as np
-import pandas as pd
-import csv
-import json
 import sys
-import toml
 from pathlib import Path
 
+import streamlit as st
+
+import cmddb
+import dblint
+import dbstore
+import history
+import memory
+import profiling
+import project
+import watcher
+import writer
+from dbcache import FileCache
+
 st.set_page_config(layout="wide")
 st.title("CMD DB")
 st.markdown(
@@ -22,222 +30,283 @@ button:not([title="View fullscreen"]) {
     unsafe_allow_html=True,
 )
 
-dict_index = {}
-dict_index["BCT"] = {
-    "num_start_line": 3,
-    0: "Comment",
-    1: "Name",
-    2: "ShortName",
-    3: "BCID",
-    4: "Alias Deploy",
-    5: "Alias SetBlockPosition",
-    6: "Alias Clear",
-    7: "Alias Activate",
-    8: "Alias Inactivate",
-    9: "Danger Flag",
-    10: "Description",
-    11: "Note",
-}
-dict_index["CMD_DB"] = {
-    "num_start_line": 4,
-    0: "Comment",
-    1: "Name",
-    2: "Target",
-    3: "Code",
-    4: "Num Params",
-    5: "Param1 Type",
-    6: "Param1 Description",
-    7: "Param2 Type",
-    8: "Param2 Description",
-    9: "Param3 Type",
-    10: "Param3 Description",
-    11: "Param4 Type",
-    12: "Param4 Description",
-    13: "Param5 Type",
-    14: "Param5 Description",
-    15: "Param6 Type",
-    16: "Param6 Description",
-    17: "Danger Flag",
-    18: "Is Restricted",
-    19: "Description",
-    20: "Note",
-}
 
+# settings はプロセスの間変わらない (load_settings はキャッシュする) ので, rerun ごとに settings を hash しないよう project 名で引く
+@st.cache_resource
+def get_caches(name: str, _settings: dict) -> dict:
+    return {kind: FileCache(load, cache_dir=_settings.get("cache_dir"), namespace=f"cmddb:{kind}") for kind, load in cmddb.loaders.items()}
 
-def find_settings_file():
-    for parent in [Path(__file__).parents[i] for i in range(4)]:
-        for file_name in ["tlm_cmd_db_editor_config.toml", "settings.toml"]:
-            path = parent / file_name
-            if path.is_file():
-                return path
-    raise FileNotFoundError("settings.toml / tlm_cmd_db_editor_config.toml is not found.")
 
+@st.cache_resource
+def get_watcher(name: str, _settings: dict) -> watcher.FileWatcher:
+    return watcher.FileWatcher([_settings[key] for key in cmddb.path_keys.values()])
+
+
+@st.cache_resource
+def get_store(name: str, _settings: dict) -> dbstore.DBStore:
+    return dbstore.DBStore()
+
+
+@st.cache_resource
+def get_writer(name: str, _settings: dict) -> writer.WriteBehind:
+    return writer.WriteBehind()
 
-# @st.cache_data
-def load_settings():
-    settings_file = find_settings_file()
-    settings = json.loads(json.dumps(toml.load(settings_file)))
-    return settings_file.parent, settings
+
+@st.cache_resource
+def get_linter(name: str, _settings: dict) -> dblint.Linter:
+    return dblint.Linter(max_workers=2, processes=False)
 
 
 @st.cache_data
-def process_csv_files(settings: dict):
-    data = {"CMD_DB": {}, "BCT": {}}
-    with open(settings["path_cmd_db"], "r", errors="ignore") as csv_file:
-        data["CMD_DB"]["path"] = settings["path_cmd_db"]
-        rows = list(csv.reader(csv_file, delimiter=","))
-        data["CMD_DB"]["Component"] = rows[1][0]
-        data["CMD_DB"]["init_rows"] = rows[:dict_index["CMD_DB"]["num_start_line"]]
-        rows = rows[dict_index["CMD_DB"]["num_start_line"]:]
-        df = pd.DataFrame([{dict_index["CMD_DB"][i]: col for i, col in enumerate(row) if i in dict_index["CMD_DB"]}
-                          for row in rows])
-        for _type in ["Param1 Type", "Param2 Type", "Param3 Type", "Param4 Type", "Param5 Type", "Param6 Type"]:
-            df[_type] = df[_type].astype(
-                pd.CategoricalDtype(["", "int8_t", "int16_t", "int32_t", "uint8_t",
-                                     "uint16_t", "uint32_t", "float", "double", "raw"]))
-        df["Num Params"] = df["Num Params"].astype(pd.CategoricalDtype(["", "0", "1", "2", "3", "4", "5", "6"]))
-        df["Danger Flag"] = df["Danger Flag"].astype(pd.CategoricalDtype(["", "danger"]))
-        df["Is Restricted"] = df["Is Restricted"].astype(pd.CategoricalDtype(["", "restricted"]))
-
-        data["CMD_DB"]["data"] = df
-
-    with open(settings["path_bct"], "r", errors="ignore") as csv_file:
-        data["BCT"]["path"] = settings["path_bct"]
-        rows = list(csv.reader(csv_file, delimiter=","))
-        data["BCT"]["init_rows"] = rows[:dict_index["BCT"]["num_start_line"]]
-        rows = rows[dict_index["BCT"]["num_start_line"]:]
-        df = pd.DataFrame([{dict_index["BCT"][i]: col for i, col in enumerate(row) if i in dict_index["BCT"]}
-                          for row in rows])
-        df["Danger Flag"] = df["Danger Flag"].astype(pd.CategoricalDtype(["", "danger"]))
-        data["BCT"]["data"] = df
+def load_settings():
+    return project.load_settings()
+
+
+def has_unsaved_edits(state: dict) -> bool:
+    # 編集していなければ merged は共有の表そのもの
+    if state["merged"] is state["loaded"]:
+        return False
+    return state["merged"].astype(object).fillna("").values.tolist() != state["loaded"].astype(object).fillna("").values.tolist()
+
+
+def calc_table(allocation: dict, option: str, df) -> tuple:
+    # calc_cmd_db は df を書き換えるので, 共有の表を渡しても壊さないようにコピーに対して計算する
+    if option == "CMD_DB":
+        return cmddb.calc_cmd_db(allocation, df.copy())
+    return df, []
+
+
+def build_table(cache: FileCache, allocation: dict, option: str, path: Path) -> dict:
+    data = dict(cache.warm(path))
+    data["data"], data["unknown"] = calc_table(allocation, option, data["data"])
     return data
 
 
-@st.cache_data
-def calc_bct(df):
-    return df
+def table_history(option: str, table) -> history.History:
+    # 表ごとの undo / redo. 保存して読み直した表が最後の編集と同じなら履歴を引き継ぐ. Code と Num Params は計算で決まるので比べない
+    changes = st.session_state.get(f"{option}_history")
+    if changes is None or not changes.matches(table):
+        changes = history.History(table, [column for column in table.columns if column not in ("Code", "Num Params")])
+        st.session_state[f"{option}_history"] = changes
+    return changes
 
 
-@st.cache_data
-def calc_cmd_db(allocation, df):
-    allocation = {k.upper(): v for k, v in allocation.items()}
-    for index, row in df.iterrows():
-        if row['Target'] != '':
-            num_params = sum(1 for i in range(1, 7) if row[f'Param{i} Type'] not in ["", None, np.nan])
-            df.at[index, 'Num Params'] = str(num_params)
-        for _type in ["Param1 Type", "Param2 Type", "Param3 Type", "Param4 Type", "Param5 Type", "Param6 Type"]:
-            df[_type].fillna("", inplace=True)
-
-    code_count = 0
-    code_count_next = 0
-    for index, row in df.iterrows():
-        if row['Comment'] == '' and row['Name'] != '':
-            code_str = format(code_count, '04X')  # 16進数の書式 '0000'
-            df.at[index, 'Code'] = f"0x{code_str}"
-            code_count += 1
-        elif row['Comment'].startswith('* '):
-            word = row['Comment'][2:].upper()
-            code_count = code_count_next
-            if word in allocation:
-                code_count_next += allocation[word]
-            else:
-                if word != "NONORDER":
-                    st.error(f"'{word}' not found in settings.")
-    return df
-
-
-def save(data):
-    data_to_write = data["init_rows"]
-    data_to_write.extend(data["data"].values.tolist())
-    with open(data["path"], mode="w") as csv_file:
-        for row in data_to_write:
-            csv_file.write(",".join(map(str, row)) + "\n")
-
-
-path_base, settings = load_settings()
-sections = list(settings.keys())
-sections = [key for key in sections if "cmddb" in settings[key]]
-selected_project = None
-if "selected_project" not in st.session_state:
-    st.session_state.selected_project = None
-
-if len(sys.argv) > 1 and sys.argv[1] in sections:
-    st.session_state.selected_project = sys.argv[1]
-    selected_project = st.session_state.selected_project
-elif len(sections) == 1:
-    st.session_state.selected_project = sections[0]
-    selected_project = st.session_state.selected_project
-elif st.session_state.selected_project:
-    selected_project = st.session_state.selected_project
-else:
-    selected_project = st.selectbox("Select a project:", sections)
-    if st.button("Select"):
-        st.session_state.selected_project = selected_project
-        st.experimental_rerun()
-    st.stop()
-
-settings = settings[selected_project]["cmddb"]
-for path_name in ["path_bct", "path_cmd_db"]:
-    settings[path_name] = path_base / settings[path_name]
-
-data = process_csv_files(settings)
-
-option = st.selectbox("CMD TYPE", ["CMD_DB", "BCT"])
-
-if option:
-    col1, col2 = st.columns(2)
-    if option == "BCT":
-        data[option]["data"] = calc_bct(data[option]["data"])
-        edited_df = st.data_editor(
-            data[option]["data"],
-            column_config={
-                "Code": st.column_config.Column(width="small"),
-                "Target": st.column_config.Column(width="small"),
-                "Comment": st.column_config.Column(width="small"),
-                "Num Params": st.column_config.Column(width="small"),
-                "Param1 Type": st.column_config.Column(width="small"),
-                "Param2 Type": st.column_config.Column(width="small"),
-                "Param3 Type": st.column_config.Column(width="small"),
-                "Param4 Type": st.column_config.Column(width="small"),
-                "Param5 Type": st.column_config.Column(width="small"),
-                "Param6 Type": st.column_config.Column(width="small"),
-                "Danger Flag": st.column_config.Column(width="small"),
-                "Is Restricted": st.column_config.Column(width="small"),
-            },
-            width=1600,
-            height=1000,
-            hide_index=False,
-            num_rows="dynamic"
-        )
-        if col1.button("Save"):
-            st.cache_data.clear()
-            save(data[option])
+def save_table(cache: FileCache, data: dict) -> str:
+    # 自分の書き込みを外部の変更と区別するための, 書き込み後の digest を返す
+    cmddb.save(data)
+    return cache.fingerprint(data["path"])[3]
+
+
+with profiling.rerun("cmd") as (timer, capture):
+    path_base, settings = load_settings()
+    sections = project.sections(settings, "cmddb")
+    selected_project = None
+    if "selected_project" not in st.session_state:
+        st.session_state.selected_project = None
+
+    if len(sys.argv) > 1 and sys.argv[1] in sections:
+        st.session_state.selected_project = sys.argv[1]
+        selected_project = st.session_state.selected_project
+    elif len(sections) == 1:
+        st.session_state.selected_project = sections[0]
+        selected_project = st.session_state.selected_project
+    elif st.session_state.selected_project:
+        selected_project = st.session_state.selected_project
+    else:
+        selected_project = st.selectbox("Select a project:", sections)
+        if st.button("Select"):
+            st.session_state.selected_project = selected_project
             st.experimental_rerun()
+        st.stop()
+
+    settings = project.cmddb_settings(path_base, settings, selected_project)
+
+    # パース・計算した表は全 session で共有する snapshot で, session ごとにはコピーしない
+    with timer.stage("load"):
+        caches = get_caches(selected_project, settings)
+        store = get_store(selected_project, settings)
+        data = {}
+        for kind, cache in caches.items():
+            path = settings[cmddb.path_keys[kind]]
+            snapshot = store.get(kind, cache.fingerprint(path)[3], lambda: build_table(cache, settings.get("allocation", {}), kind, path))
+            data[kind] = snapshot.data
+
+    # save() で自分が書いたものを除いて, 外部で書き換えられた CSV を知らせる
+    with timer.stage("watch"):
+        # watcher は全 session で共有するので, 変更は session ごとの cursor から後のものを取り出す
+        cursor_key = f"cmd_watch_{selected_project}"
+        st.session_state[cursor_key], changed = get_watcher(selected_project, settings).changes(st.session_state.get(cursor_key))
+        external = [
+            kind
+            for kind in data
+            if Path(settings[cmddb.path_keys[kind]]) in changed
+            and st.session_state.get(f"{kind}_state", {}).get("written") != caches[kind].fingerprint(data[kind]["path"])[3]
+        ]
+    if external:
+        st.info(f"{', '.join(external)} changed on disk")
+
+    with st.sidebar:
+        with st.expander("Memory"):
+            if st.checkbox("Measure", key="cmd_memory"):
+                with timer.stage("memory report"):
+                    st.dataframe(memory.memory_report({kind: data[kind]["data"] for kind in data}), hide_index=True)
+
+    column_config = {
+        "CMD_DB": {
+            "Code": st.column_config.NumberColumn(width="small", format="0x%04X"),
+            "Target": st.column_config.Column(width="small"),
+            "Comment": st.column_config.Column(width="small"),
+            "Num Params": st.column_config.NumberColumn(width="small", min_value=0, max_value=6),
+            "Param1 Type": st.column_config.Column(width="small"),
+            "Param2 Type": st.column_config.Column(width="small"),
+            "Param3 Type": st.column_config.Column(width="small"),
+            "Param4 Type": st.column_config.Column(width="small"),
+            "Param5 Type": st.column_config.Column(width="small"),
+            "Param6 Type": st.column_config.Column(width="small"),
+            "Danger Flag": st.column_config.Column(width="small"),
+            "Is Restricted": st.column_config.Column(width="small"),
+        },
+        "BCT": {
+            "BCID": st.column_config.Column(width="small"),
+            "ShortName": st.column_config.Column(width="small"),
+            "Alias Deploy": st.column_config.Column(width="small"),
+            "Alias SetBlockPosition": st.column_config.Column(width="small"),
+            "Alias Clear": st.column_config.Column(width="small"),
+            "Alias Activate": st.column_config.Column(width="small"),
+            "Alias Inactivate": st.column_config.Column(width="small"),
+            "Danger Flag": st.column_config.Column(width="small"),
+        },
+    }
+
+    option = st.selectbox("CMD TYPE", ["CMD_DB", "BCT"])
+
+    if option:
+        for word in data[option]["unknown"]:
+            st.error(f"'{word}' not found in settings.")
+        col1, col2, col3, col4 = st.columns(4)
+        # 編集中の表全体は session_state に持ち, st.data_editor には選んだ区間・範囲の行だけを渡す.
+        # CSV が変わったら (保存や外部での編集) 読み込み直す. 未保存の編集があるときに外部で書き換えられたら競合として知らせる
+        digest = caches[option].fingerprint(data[option]["path"])[3]
+        state = st.session_state.get(f"{option}_state")
+        conflict = state is not None and digest not in (state["digest"], state.get("written")) and has_unsaved_edits(state)
+        if not conflict and (state is None or state["digest"] != digest):
+            table = data[option]["data"]
+            # 自分で保存した内容の digest は, 監視の通知が遅れて届いても外部の変更と区別できるように引き継ぐ
+            written = state.get("written") if state else None
+            # version も引き継いで, 読み直した表の st.data_editor に前の key の編集が残らないようにする
+            version = state.get("version", 0) if state else 0
+            state = {"digest": digest, "table": table, "merged": table, "loaded": table, "window": None, "written": written, "version": version}
+            st.session_state[f"{option}_state"] = state
+            table_history(option, table)
+        if conflict:
+            st.warning(f"{data[option]['path'].name} was changed on disk while it has unsaved edits here.")
+            c1, c2 = st.columns(2)
+            if c1.button("Keep my edits (overwrite the file on Save)"):
+                state["digest"] = digest
+                st.experimental_rerun()
+            if c2.button("Load the file (discard my edits)"):
+                del st.session_state[f"{option}_state"]
+                st.experimental_rerun()
+
+        mode = st.radio("Rows", ["All", "Section", "Range", "Search"], horizontal=True, key=f"{option}_mode")
+        window = (mode,)
+        if mode == "Section":
+            names = cmddb.section_names(state["merged"])
+            section = st.selectbox("Section", list(names), format_func=lambda i: f"{i}: {names[i]}", key=f"{option}_section")
+            window = (mode, section, names.get(section))
+        elif mode == "Range":
+            c1, c2 = st.columns(2)
+            last_row = max(len(state["merged"]) - 1, 0)
+            start = c1.number_input("From row", 0, last_row, 0, key=f"{option}_from")
+            end = c2.number_input("To row", 0, last_row, min(99, last_row), key=f"{option}_to")
+            window = (mode, int(start), int(end))
+        elif mode == "Search":
+            window = (mode, st.text_input("Search", key=f"{option}_term"))
+
+        if state["window"] != window:
+            # 窓を切り替えるときに, それまでの編集を全体の表に反映してから新しい窓を切り出す. 編集がなければ共有の表のまま
+            table = state["merged"]
+            if table is not state["loaded"]:
+                with timer.stage(f"calc {option}"):
+                    table, _ = calc_table(settings.get("allocation", {}), option, table)
+            if mode == "Section":
+                labels = cmddb.window_labels(table, section=window[1]) if window[1] is not None else []
+            elif mode == "Range":
+                labels = cmddb.window_labels(table, rows=window[1:])
+            elif mode == "Search":
+                labels = cmddb.window_labels(table, term=window[1])
+            else:
+                labels = cmddb.window_labels(table)
+            state.update(table=table, merged=table, window=window, labels=labels, version=state.get("version", 0) + 1)
+
+        editor_key = f"{option}_editor_{state['version']}"
+        with timer.stage("data_editor"):
+            edited_df = st.data_editor(
+                state["table"].loc[state["labels"]].reset_index(drop=True),
+                column_config=column_config[option],
+                width=1600,
+                height=1000,
+                hide_index=False,
+                num_rows="dynamic",
+                key=editor_key,
+            )
+        # 全体の表の版. 窓の表と st.data_editor の編集の状態で決まるので, 表を hash せずに前の rerun と同じかが分かる
+        editor_state = st.session_state.get(editor_key, {})
+        revision = st.session_state.setdefault("cmd_revisions", dbstore.Revisions()).observe(editor_key, editor_state)
+        token = (editor_key, revision.number)
+        # 窓に編集があるときだけ全体の表をコピーして反映する (copy-on-write). 前の rerun と同じ版なら反映済みの表をそのまま使う
+        if any(editor_state.get(k) for k in ["edited_rows", "added_rows", "deleted_rows"]):
+            if state.get("token") != token:
+                with timer.stage("merge"):
+                    state["merged"] = cmddb.merge_window(state["table"], state["labels"], edited_df)
+        else:
+            state["merged"] = state["table"]
+        state["token"] = token
+        with timer.stage("history"):
+            changes = st.session_state.get(f"{option}_history") or table_history(option, state["loaded"])
+            # 行の追加・削除がなければ, 窓の行の位置は全体の表の行の位置 (labels) になる
+            rows = None if revision.rows is None else [state["labels"][row] for row in revision.rows]
+            changes.update(state["merged"], token, (editor_key, revision.previous), rows)
+        st.caption(f"Editing {len(state['labels'])} of {len(state['table'])} rows")
+
+        if option == "CMD_DB":
+            with timer.stage("allocation report"):
+                reports = state.setdefault("report", dbstore.TokenCache())
+                report = reports.get(token, lambda: cmddb.allocation_report(settings.get("allocation", {}), state["merged"]))
+            problems = report[report["Status"] != "ok"]
+            for _, row in problems.iterrows():
+                st.warning(f"{row['Section']}: {row['Status']} (used {row['Used']} / allocated {row['Allocated']})")
+            with st.expander("Code allocation", expanded=not problems.empty):
+                st.dataframe(report, hide_index=True, width=1600)
+        # 書き込みはバックグラウンドのスレッドで行う. Save は明示的な操作なので書き終わるまで待って結果を出す
+        csv_writer = get_writer(selected_project, settings)
+        if col1.button("Save", disabled=conflict):
+            table = calc_table(settings.get("allocation", {}), option, state["merged"])[0]
+            csv_writer.submit(data[option]["path"], functools.partial(save_table, caches[option], {**data[option], "data": table}))
+            result = csv_writer.flush([data[option]["path"]])[0]
+            if result.error:
+                st.error(f"Failed to save {data[option]['path'].name}: {result.error}")
+            else:
+                state["written"] = result.value
+                st.experimental_rerun()
 
         if col2.button("Edit on CSV Editor"):
             os.system("open " + str(data[option]["path"]))
-    if option == "CMD_DB":
-        edited_df = st.data_editor(
-            data[option]["data"],
-            column_config={
-                "BCID": st.column_config.Column(width="small"),
-                "ShortName": st.column_config.Column(width="small"),
-                "Alias Deploy": st.column_config.Column(width="small"),
-                "Alias SetBlockPosition": st.column_config.Column(width="small"),
-                "Alias Clear": st.column_config.Column(width="small"),
-                "Alias Activate": st.column_config.Column(width="small"),
-                "Alias Inactivate": st.column_config.Column(width="small"),
-                "Danger Flag": st.column_config.Column(width="small"),
-            },
-            width=1600,
-            height=1000,
-            hide_index=False,
-            num_rows="dynamic"
-        )
-        if col1.button("Save"):
-            st.cache_data.clear()
-            save(data[option])
+        # 戻した表を全体の表にして, 窓を切り出し直す (st.data_editor も新しい key で作り直す)
+        if col3.button(f"Undo ({len(changes.undo_stack)})", disabled=conflict or not changes.undo_stack):
+            state.update(merged=changes.undo(), window=None)
+            st.experimental_rerun()
+        if col4.button(f"Redo ({len(changes.redo_stack)})", disabled=conflict or not changes.redo_stack):
+            state.update(merged=changes.redo(), window=None)
             st.experimental_rerun()
 
-        if col2.button("Edit on CSV Editor"):
-            os.system("open " + str(data[option]["path"]))
+        rows = csv_writer.rows()
+        with st.sidebar.expander("Writes", expanded=any(row["Error"] for row in rows)):
+            st.dataframe(rows, hide_index=True, column_config={"ms": st.column_config.NumberColumn(format="%.1f")})
+        with st.sidebar.expander("Lint"):
+            # 保存済みの CSV を検査する. 変わっていなければ前の結果を使う
+            if st.checkbox("Check CMD_DB and BCT", key="cmd_lint"):
+                with timer.stage("lint"):
+                    dblint.lint_panel(get_linter(selected_project, settings), dblint.table_jobs(settings, selected_project))
+
+    profiling.finish_rerun("cmd", timer, capture, settings.get("timing_log"), app="cmddb", project=selected_project, table=option)
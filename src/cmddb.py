@@ -0,0 +1,281 @@
+import csv
+import typing
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import tlmdb
+from memory import intern_columns
+
+dict_index = {}
+dict_index["BCT"] = {
+    "num_start_line": 3,
+    0: "Comment",
+    1: "Name",
+    2: "ShortName",
+    3: "BCID",
+    4: "Alias Deploy",
+    5: "Alias SetBlockPosition",
+    6: "Alias Clear",
+    7: "Alias Activate",
+    8: "Alias Inactivate",
+    9: "Danger Flag",
+    10: "Description",
+    11: "Note",
+}
+dict_index["CMD_DB"] = {
+    "num_start_line": 4,
+    0: "Comment",
+    1: "Name",
+    2: "Target",
+    3: "Code",
+    4: "Num Params",
+    5: "Param1 Type",
+    6: "Param1 Description",
+    7: "Param2 Type",
+    8: "Param2 Description",
+    9: "Param3 Type",
+    10: "Param3 Description",
+    11: "Param4 Type",
+    12: "Param4 Description",
+    13: "Param5 Type",
+    14: "Param5 Description",
+    15: "Param6 Type",
+    16: "Param6 Description",
+    17: "Danger Flag",
+    18: "Is Restricted",
+    19: "Description",
+    20: "Note",
+}
+
+
+code_dtype = pd.Int32Dtype()
+num_params_dtype = pd.Int8Dtype()
+
+
+def parse_code(values: pd.Series) -> pd.Series:
+    """Code の "0x0010" のような 16 進数の文字列を整数にする. 空欄や 16 進数でない値は <NA>."""
+    if pd.api.types.is_integer_dtype(values.dtype):
+        return values.astype(code_dtype)
+    text = values.astype(object).fillna("").astype(str)
+    is_hex = text.str.fullmatch("0[xX][0-9A-Fa-f]+")
+    return text.where(is_hex).map(lambda value: int(value, 16), na_action="ignore").astype(code_dtype)
+
+
+def parse_num_params(values: pd.Series) -> pd.Series:
+    values = values.astype(object)
+    return pd.to_numeric(values.where(values != ""), errors="coerce").astype(num_params_dtype)
+
+
+def format_code(values: pd.Series) -> pd.Series:
+    # CSV と画面の検索では C2A と同じ "0x0010" の形にする
+    return values.astype(object).map(lambda value: "" if pd.isna(value) else f"0x{int(value):04X}")
+
+
+def load_cmd_db(csv_path: Path) -> dict:
+    data = {}
+    with open(csv_path, "r", errors="ignore") as csv_file:
+        data["path"] = csv_path
+        rows = list(csv.reader(csv_file, delimiter=","))
+        data["Component"] = rows[1][0]
+        data["init_rows"] = rows[: dict_index["CMD_DB"]["num_start_line"]]
+        rows = rows[dict_index["CMD_DB"]["num_start_line"] :]
+        df = pd.DataFrame([{dict_index["CMD_DB"][i]: col for i, col in enumerate(row) if i in dict_index["CMD_DB"]} for row in rows])
+        for _type in ["Param1 Type", "Param2 Type", "Param3 Type", "Param4 Type", "Param5 Type", "Param6 Type"]:
+            df[_type] = df[_type].astype(
+                pd.CategoricalDtype(["", "int8_t", "int16_t", "int32_t", "uint8_t", "uint16_t", "uint32_t", "float", "double", "raw"])
+            )
+        # Code と Num Params は空欄を <NA> にした整数. 保存するときに文字列に戻す
+        df["Code"] = parse_code(df["Code"])
+        df["Num Params"] = parse_num_params(df["Num Params"])
+        df["Danger Flag"] = df["Danger Flag"].astype(pd.CategoricalDtype(["", "danger"]))
+        df["Is Restricted"] = df["Is Restricted"].astype(pd.CategoricalDtype(["", "restricted"]))
+
+        data["data"] = intern_columns(df, df.columns[df.dtypes == object])
+    return data
+
+
+def load_bct(csv_path: Path) -> dict:
+    data = {}
+    with open(csv_path, "r", errors="ignore") as csv_file:
+        data["path"] = csv_path
+        rows = list(csv.reader(csv_file, delimiter=","))
+        data["init_rows"] = rows[: dict_index["BCT"]["num_start_line"]]
+        rows = rows[dict_index["BCT"]["num_start_line"] :]
+        df = pd.DataFrame([{dict_index["BCT"][i]: col for i, col in enumerate(row) if i in dict_index["BCT"]} for row in rows])
+        df["Danger Flag"] = df["Danger Flag"].astype(pd.CategoricalDtype(["", "danger"]))
+        data["data"] = intern_columns(df, df.columns[df.dtypes == object])
+    return data
+
+
+param_type_columns = [f"Param{i} Type" for i in range(1, 7)]
+
+
+def code_sections(allocation: dict, df: pd.DataFrame) -> tuple:
+    """ "* CATEGORY" のコメント行で区切られた区間ごとに, 各コマンドの Code の番号を求める.
+
+    区間の先頭の番号はそれより前の区間の allocation の合計で, 区間内のコマンドに順に番号を振る.
+    allocation にない区間 (NONORDER など) は次の区間と同じ番号から始まり, 後ろの区間の位置をずらさない.
+    """
+    allocation = {k.upper(): v for k, v in allocation.items()}
+    comment = df["Comment"].fillna("").astype(str)
+    is_cmd = (comment == "") & (df["Name"].fillna("").astype(str) != "")
+    is_section = comment.str.startswith("* ")
+    words = comment[is_section].str[2:].str.upper()
+    sizes = words.map(allocation).fillna(0).astype(int)
+    section_id = is_section.cumsum()
+    # section_id 0 は最初の区間より前の行
+    section_start = pd.Series([0] + (sizes.cumsum() - sizes).tolist(), index=range(len(sizes) + 1))
+    code = section_id.map(section_start) + is_cmd.groupby(section_id).cumsum() - 1
+    return is_cmd, code, section_id, words, sizes
+
+
+def calc_cmd_db(allocation: dict, df: pd.DataFrame) -> tuple:
+    """Num Params と Code を振り直した df と, allocation にない区間名の list を返す."""
+    params = df[param_type_columns]
+    num_params = (params.notna() & (params != "")).sum(axis=1)
+    has_target = (df["Target"] != "").to_numpy()
+    df["Num Params"] = parse_num_params(df["Num Params"])
+    df.loc[has_target, "Num Params"] = num_params[has_target].to_numpy()
+    for _type in param_type_columns:
+        df[_type] = df[_type].fillna("")
+
+    is_cmd, code, _, words, _ = code_sections(allocation, df)
+    df["Code"] = parse_code(df["Code"])
+    df.loc[is_cmd, "Code"] = code[is_cmd].to_numpy()
+    allocation = {k.upper() for k in allocation}
+    unknown = [word for word in words if word not in allocation and word != "NONORDER"]
+    return df, unknown
+
+
+def allocation_report(allocation: dict, df: pd.DataFrame) -> pd.DataFrame:
+    """ "* CATEGORY" の区間ごとの Code の使用状況.
+
+    Used / Allocated / Free と最初と最後の Code を求め, 割り当てを超えた区間 (overflow) と
+    他の区間と Code が重なる区間 (collision) に印を付ける.
+    """
+    is_cmd, code, section_id, words, sizes = code_sections(allocation, df)
+    known = {k.upper() for k in allocation}
+    cmd_codes = code[is_cmd]
+    cmd_sections = section_id[is_cmd]
+    collided = set(cmd_sections[cmd_codes.duplicated(keep=False)])
+    grouped = cmd_codes.groupby(cmd_sections)
+    used = grouped.size()
+    first = grouped.min()
+    last = grouped.max()
+
+    names = ["(before first section)"] + words.tolist()
+    allocated = [0] + [size if word in known else None for word, size in zip(words, sizes)]
+    starts = [0] + (sizes.cumsum() - sizes).tolist()
+    report = []
+    for i, (name, size, start) in enumerate(zip(names, allocated, starts)):
+        n = int(used.get(i, 0))
+        if i == 0 and n == 0:
+            continue
+        status = []
+        if size is not None and n > size:
+            status.append("overflow")
+        if i in collided:
+            status.append("collision")
+        if size is None and name != "NONORDER":
+            status.append("not in allocation")
+        report.append(
+            {
+                "Section": name,
+                "Start": f"0x{start:04X}",
+                "Allocated": size,
+                "Used": n,
+                "Free": None if size is None else size - n,
+                "First Code": f"0x{int(first[i]):04X}" if n else "",
+                "Last Code": f"0x{int(last[i]):04X}" if n else "",
+                "Status": ", ".join(status) or "ok",
+            }
+        )
+    report = pd.DataFrame(report, columns=["Section", "Start", "Allocated", "Used", "Free", "First Code", "Last Code", "Status"])
+    return report.astype({"Allocated": "Int64", "Free": "Int64"})
+
+
+def section_names(df: pd.DataFrame) -> dict:
+    """ "* CATEGORY" のコメント行の index と区間名."""
+    comment = df["Comment"].fillna("").astype(str)
+    return comment[comment.str.startswith("* ")].str[2:].to_dict()
+
+
+def window_labels(
+    df: pd.DataFrame,
+    section: typing.Optional[int] = None,
+    rows: typing.Optional[typing.Tuple[int, int]] = None,
+    term: str = "",
+) -> list:
+    """編集する窓に含める行の index を返す. 何も指定しなければ全行.
+
+    section はその区間のコメント行から次の区間のコメント行の手前まで, rows は位置で [start, end],
+    term はいずれかのセルに (大文字小文字を区別せず) term を含む行.
+    """
+    if section is not None:
+        is_section = df["Comment"].fillna("").astype(str).str.startswith("* ").to_numpy()
+        start = df.index.get_loc(section)
+        following = np.flatnonzero(is_section[start + 1 :])
+        end = start + 1 + following[0] if len(following) else len(df)
+        return df.index[start:end].tolist()
+    if rows is not None:
+        return df.index[rows[0] : rows[1] + 1].tolist()
+    if term:
+        cells = df.astype(object).fillna("").astype(str)
+        if "Code" in cells:
+            cells["Code"] = format_code(df["Code"])
+        found = np.zeros(len(df), dtype=bool)
+        for col in cells.columns:
+            found |= cells[col].str.contains(term, case=False, regex=False).to_numpy()
+        return df.index[found].tolist()
+    return df.index.tolist()
+
+
+def merge_window(df: pd.DataFrame, labels: list, edited: pd.DataFrame) -> pd.DataFrame:
+    """窓 (df.loc[labels] を振り直した 0..n-1 の index で st.data_editor に渡したもの) の編集を全体の表に戻す.
+
+    index が n 未満の行は labels の行の編集結果, n 以上の行は追加された行で, 窓の最後の行の直後に入れる.
+    edited にない行は削除されたものとする. 戻り値の index は 0 から振り直す.
+    """
+    n = len(labels)
+    labels = np.asarray(labels)
+    position = edited.index.to_numpy()
+    is_kept = position < n
+    kept = edited[is_kept].copy()
+    kept.index = labels[position[is_kept].astype(int)]
+    added = edited[~is_kept]
+    merged = df.drop(index=np.setdiff1d(labels, kept.index))
+    for col in kept.columns.intersection(merged.columns):
+        merged.loc[kept.index, col] = kept[col]
+    if len(added):
+        insert_at = int(df.index.get_indexer(labels).max()) + 1 if n else len(df)
+        # 削除された行の分だけ挿入位置を前にずらす
+        insert_at -= int(np.isin(df.index[:insert_at], labels).sum()) - int(np.isin(df.index[:insert_at], kept.index).sum())
+        added = added.reindex(columns=merged.columns)
+        added.index = range(len(df), len(df) + len(added))
+        merged = pd.concat([merged.iloc[:insert_at], added, merged.iloc[insert_at:]])
+    return merged.reset_index(drop=True)
+
+
+def render(data: dict) -> str:
+    # 読み込んだときの先頭の行 (init_rows) と表をそのまま "," でつなぐ
+    rows = list(data["init_rows"])
+    df = data["data"].astype(object)
+    if "Code" in df:
+        df["Code"] = format_code(data["data"]["Code"])
+    rows.extend(df.fillna("").values.tolist())
+    return "".join(",".join(map(str, row)) + "\n" for row in rows)
+
+
+def save(data: dict) -> None:
+    # TLM DB と同じく一時ファイルに書いてから置き換えるので, 途中で止まっても書きかけの CSV が残らない
+    tlmdb.atomic_write(data["path"], render(data).encode("utf-8"))
+
+
+loaders = {"CMD_DB": load_cmd_db, "BCT": load_bct}
+path_keys = {"CMD_DB": "path_cmd_db", "BCT": "path_bct"}
+
+
+def process_csv_files(settings: dict) -> dict:
+    return {kind: loaders[kind](settings[path_keys[kind]]) for kind in loaders}
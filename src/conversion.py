@@ -0,0 +1,110 @@
+"""TLM DB の ConvType / ConvInfo で, 生の値の列を工学値にまとめて変換する.
+
+POLY は a0 + a1 x + ... + a5 x^5 の多項式, STATUS は "値=ラベル" の対応表.
+NONE と HEX は表示の違いだけなので値は変えない.
+"""
+
+import functools
+import itertools
+import typing
+
+import numpy as np
+import pandas as pd
+
+from tlmdb import poly_coeffs
+
+# STATUS の値がこの範囲に収まれば, 値をそのまま添字にする表を作る
+dense_status_limit = 1 << 16
+
+
+class Poly:
+    def __init__(self, coeffs: typing.Sequence[float]):
+        self.coeffs = np.asarray(coeffs, dtype=np.float64)
+
+    def __call__(self, raw: np.ndarray) -> np.ndarray:
+        # float の field の NaN や大きな値はそのまま NaN / inf にする
+        with np.errstate(invalid="ignore", over="ignore"):
+            return np.polynomial.polynomial.polyval(np.asarray(raw, dtype=np.float64), self.coeffs)
+
+
+class Status:
+    """値からラベルへの表. 表にない値は値そのものを文字列にする."""
+
+    def __init__(self, table: typing.Dict[int, str]):
+        self.keys = np.array(sorted(table), dtype=np.int64)
+        self.labels = np.array([table[key] for key in self.keys], dtype=object)
+        self.lut = None
+        if len(self.keys) and self.keys[0] >= 0 and self.keys[-1] < dense_status_limit:
+            self.lut = np.full(self.keys[-1] + 1, None, dtype=object)
+            self.lut[self.keys] = self.labels
+            self.defined = np.zeros(self.keys[-1] + 1, dtype=bool)
+            self.defined[self.keys] = True
+
+    def __call__(self, raw: np.ndarray) -> np.ndarray:
+        raw = np.asarray(raw)
+        with np.errstate(invalid="ignore"):
+            values = raw.astype(np.int64)
+        known = values == raw if raw.dtype.kind == "f" else np.ones(len(values), dtype=bool)
+        if self.lut is not None:
+            known &= (values >= 0) & (values < len(self.lut))
+            index = np.where(known, values, 0)
+            known &= self.defined[index]
+            labels = self.lut[index]
+        elif len(self.keys):
+            index = np.minimum(np.searchsorted(self.keys, values), len(self.keys) - 1)
+            known &= self.keys[index] == values
+            labels = self.labels[index]
+        else:
+            labels = np.empty(len(values), dtype=object)
+            known[:] = False
+        if not known.all():
+            # 表にない値は同じ値が繰り返し現れることが多いので, 異なる値ごとに 1 回だけ文字列にする
+            unique, inverse = np.unique(raw[~known], return_inverse=True)
+            labels[~known] = unique.astype(str).astype(object)[inverse]
+        return labels
+
+
+def parse_status(conv_info: str) -> typing.Dict[int, str]:
+    # "0=OFF,1=ON" -> {0: "OFF", 1: "ON"}. 値は 0x.. の 16 進数も受け付ける
+    table = {}
+    for item in conv_info.split(","):
+        if not item.strip():
+            continue
+        key, sep, label = item.partition("=")
+        if not sep:
+            raise ValueError(f"invalid STATUS entry {item!r}")
+        try:
+            table[int(key.strip(), 0)] = label.strip()
+        except ValueError:
+            table[int(key.strip(), 10)] = label.strip()
+    return table
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_conversion(conv_type: str, conv_info: str) -> typing.Optional[typing.Callable[[np.ndarray], np.ndarray]]:
+    """ConvType と ConvInfo の文字列から変換関数を作る. 同じ文字列は一度しか解釈しない. 値を変えないときは None."""
+    if conv_type == "POLY":
+        coeffs = list(itertools.takewhile(bool, poly_coeffs(conv_info)))
+        return Poly([float(coeff) for coeff in coeffs]) if coeffs else None
+    if conv_type == "STATUS":
+        return Status(parse_status(conv_info))
+    return None
+
+
+def converters(df: pd.DataFrame) -> typing.Dict[str, typing.Callable[[np.ndarray], np.ndarray]]:
+    # packet の各 field の変換関数. 値を変えない field は含まない
+    result = {}
+    for name, conv_type, conv_info in zip(df["Name"], df["ConvType"].astype(object), df["ConvInfo"].fillna("").astype(str)):
+        try:
+            converter = compile_conversion(str(conv_type), conv_info)
+        except ValueError as e:
+            raise ValueError(f"{name}: {e}") from None
+        if converter is not None:
+            result[name] = converter
+    return result
+
+
+def convert(df: pd.DataFrame, columns: typing.Dict[str, np.ndarray]) -> typing.Dict[str, np.ndarray]:
+    """decoder で復号した field ごとの生の値を工学値にする. df はその packet の TLM DB."""
+    table = converters(df)
+    return {name: table[name](values) if name in table else values for name, values in columns.items()}
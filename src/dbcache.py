@@ -0,0 +1,113 @@
+import copy
+import hashlib
+import pickle
+import threading
+import typing
+from collections import OrderedDict
+from pathlib import Path
+
+CACHE_VERSION = 3
+
+
+class FileCache:
+    """CSV ファイル単位のパース結果のキャッシュ.
+
+    (path, mtime, size) が変わったファイルだけ内容のハッシュを取り直し, ハッシュが変わったファイルだけ再度パースする.
+    メモリ上の entry は maxsize 件を超えると古いものから捨てる (LRU).
+    cache_dir を指定するとパース結果を pickle で保存し, 再起動後も変更のないファイルは読み直さない.
+    """
+
+    def __init__(
+        self,
+        load: typing.Callable[[Path], typing.Any],
+        maxsize: int = 512,
+        cache_dir: typing.Optional[Path] = None,
+        namespace: str = "",
+    ):
+        self._load = load
+        self.maxsize = maxsize
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.namespace = namespace
+        self._entries: "OrderedDict[typing.Tuple[str, str], typing.Any]" = OrderedDict()
+        self._stats: typing.Dict[str, typing.Tuple[int, int, str]] = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def fingerprint(self, path: Path) -> typing.Tuple[str, int, int, str]:
+        path = Path(path)
+        stat = path.stat()
+        key = str(path)
+        with self._lock:
+            known = self._stats.get(key)
+        if known is not None and known[:2] == (stat.st_mtime_ns, stat.st_size):
+            return (key, *known)
+        digest = hashlib.sha1(path.read_bytes()).hexdigest()
+        with self._lock:
+            self._stats[key] = (stat.st_mtime_ns, stat.st_size, digest)
+        return (key, stat.st_mtime_ns, stat.st_size, digest)
+
+    def _disk_stem(self, key: str) -> str:
+        return hashlib.sha1(f"{CACHE_VERSION}:{self.namespace}:{key}".encode()).hexdigest()[:16]
+
+    def _load_disk(self, key: str, digest: str) -> typing.Any:
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self.cache_dir / f"{self._disk_stem(key)}-{digest}.pkl", "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+
+    def _store_disk(self, key: str, digest: str, value: typing.Any) -> None:
+        if self.cache_dir is None:
+            return
+        stem = self._disk_stem(key)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        for old in self.cache_dir.glob(f"{stem}-*.pkl"):
+            old.unlink()
+        tmp_path = self.cache_dir / f"{stem}-{digest}.pkl.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp_path.replace(self.cache_dir / f"{stem}-{digest}.pkl")
+
+    def warm(self, path: Path) -> typing.Any:
+        key, _, _, digest = self.fingerprint(path)
+        with self._lock:
+            if (key, digest) in self._entries:
+                self._entries.move_to_end((key, digest))
+                self.hits += 1
+                return self._entries[(key, digest)]
+        value = self._load_disk(key, digest)
+        if value is None:
+            value = self._load(Path(path))
+            self._store_disk(key, digest, value)
+        with self._lock:
+            self.misses += 1
+            for old in [k for k in self._entries if k[0] == key]:
+                del self._entries[old]
+            self._entries[(key, digest)] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def get(self, path: Path) -> typing.Any:
+        # 呼び出し側で書き換えられてもキャッシュが壊れないようにコピーを返す
+        return copy.deepcopy(self.warm(path))
+
+    def items(self) -> typing.List[typing.Tuple[str, typing.Any]]:
+        """メモリ上にある (path, パース結果) の一覧. パース結果は書き換えてはいけない."""
+        with self._lock:
+            return [(key, value) for (key, _), value in self._entries.items()]
+
+    def discard(self, path: Path) -> None:
+        key = str(Path(path))
+        with self._lock:
+            self._stats.pop(key, None)
+            for old in [k for k in self._entries if k[0] == key]:
+                del self._entries[old]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._stats.clear()
+            self._entries.clear()
@@ -0,0 +1,283 @@
+"""ベンチマークや動作確認用に, C2A と同じ形式の TLM DB / CMD DB をランダムに作る.
+
+    python src/dbgen.py OUT_DIR [--packets N] [--rows MIN MAX] [--commands N] [--seed N]
+
+OUT_DIR に TLM_DB/*.csv, CMD_DB/*.csv と, それを指す settings.toml を書く.
+"""
+
+import argparse
+import random
+import sys
+import typing
+from pathlib import Path
+
+import pandas as pd
+import toml
+
+import dblint
+import tlmdb
+from tlmdb import type2bit
+
+prefix = "SAMPLE_MOBC_TLM_DB_"
+cmd_db_name = "SAMPLE_MOBC_CMD_DB_CMD_DB.csv"
+bct_name = "SAMPLE_MOBC_CMD_DB_BCT.csv"
+
+# raw は可変長なので最後のパラメータにだけ使う
+param_types = list(type2bit)
+last_param_types = param_types + ["raw"]
+categories = ["CORE", "CDH", "POWER", "COMM", "MISSION", "PROP", "AOCS", "THERMAL", "Trajectory", "HILS", "Other"]
+components = ["AOBC", "EPS", "GS", "MM", "TLCD", "BCT", "DCU", "RTC", "UTIL", "SDM", "TDSP", "EL", "EH", "APP", "MODE"]
+
+# これを超える packet は dblint で error になる
+max_packet_bytes = dblint.default_max_packet_bytes
+
+# C2A の TLM packet の先頭にある Primary / Secondary Header (bitfield を多く含む)
+packet_header = [
+    ("PH.VER", "uint16_t", 3),
+    ("PH.TYPE", "||", 1),
+    ("PH.SH_FLAG", "||", 1),
+    ("PH.APID", "||", 11),
+    ("PH.SEQ_FLAG", "uint16_t", 2),
+    ("PH.SEQ_COUNT", "||", 14),
+    ("PH.PACKET_LEN", "uint16_t", 16),
+    ("SH.VER", "uint8_t", 8),
+    ("SH.TI", "uint32_t", 32),
+    ("SH.CATEGORY", "uint8_t", 8),
+    ("SH.PACKET_ID", "uint8_t", 8),
+    ("SH.DR_PARTITION", "uint8_t", 8),
+    ("SH.DEST_FLAGS", "uint8_t", 8),
+    ("SH.DEST_INFO", "uint8_t", 8),
+]
+
+
+def tlm_row(
+    name: str,
+    var_type: str,
+    var: str,
+    bitlen: typing.Optional[int],
+    conv_type: str = "NONE",
+    coeffs: typing.Sequence[str] = (),
+    status: str = "",
+    description: str = "",
+    comment: str = "",
+) -> list:
+    # bitlen を None にすると VarType から決まる BitLen の数式を書く
+    coeffs = list(coeffs) + [""] * (6 - len(coeffs))
+    return [
+        comment,
+        name,
+        var_type,
+        var,
+        "PACKET",
+        tlmdb.octpos_formula,
+        tlmdb.bitpos_formula,
+        tlmdb.bitlen_formula if bitlen is None else str(bitlen),
+        conv_type,
+        *coeffs,
+        status,
+        description,
+        "",
+    ]
+
+
+def bitfield_rows(rnd: random.Random, name: str, var: str) -> list:
+    var_type = rnd.choice(["uint8_t", "uint16_t", "uint32_t"])
+    left = type2bit[var_type]
+    rows = []
+    while left > 0:
+        # 先頭が型の幅をすべて使うと "||" の行のない bitfield になり, tlmdb.save は BitLen を数式で書き直すので, 先頭には 1 bit 以上残す
+        bitlen = left if len(rows) == 3 else rnd.randint(1, left - 1 if not rows else left)
+        rows.append(
+            tlm_row(
+                f"{name}.B{len(rows)}",
+                var_type if not rows else "||",
+                "" if rows else var,
+                bitlen,
+                "STATUS" if bitlen == 1 else "NONE",
+                status="0=OFF@@ 1=ON" if bitlen == 1 else "",
+            )
+        )
+        left -= bitlen
+    return rows
+
+
+def telemetry_rows(rnd: random.Random, num_rows: int, max_bytes: int = max_packet_bytes) -> list:
+    rows = [
+        tlm_row(name, var_type, "", bitlen if var_type == "||" or i == 0 or type2bit[var_type] != bitlen else None)
+        for i, (name, var_type, bitlen) in enumerate(packet_header)
+    ]
+    left = max_bytes * 8 - sum(bitlen for _, _, bitlen in packet_header)
+    while len(rows) < num_rows:
+        component = rnd.choice(components)
+        name = f"{component}.{rnd.choice(['STATUS', 'COUNT', 'TIME', 'MODE', 'ERR', 'VALUE'])}{len(rows)}"
+        var = f"{component.lower()}->{name.split('.')[1].lower()}"
+        if rnd.random() < 0.1:
+            field = bitfield_rows(rnd, name, var)
+            var_type = field[0][2]
+        else:
+            var_type = rnd.choice(list(type2bit))
+            field = []
+        # packet が max_bytes を超える field は入れずに打ち切る
+        if type2bit[var_type] > left:
+            break
+        left -= type2bit[var_type]
+        if field:
+            rows.extend(field)
+            continue
+        conv_type = rnd.choices(["NONE", "HEX", "POLY", "STATUS"], [5, 2, 2, 1])[0]
+        coeffs = [f"{rnd.uniform(-10, 10):.6g}" for _ in range(rnd.randint(1, 6))] if conv_type == "POLY" else []
+        status = "@@ ".join(f"{v}={component}_S{v}" for v in range(rnd.randint(2, 6))) if conv_type == "STATUS" else ""
+        comment = "*" if rnd.random() < 0.02 else ""
+        rows.append(tlm_row(name, var_type, var, None, conv_type, coeffs, status, f"{component} {name} telemetry", comment))
+    # 先頭行の位置は 0 固定. bitfield の途中で切らないので num_rows を少し超えることがある. max_bytes に達すると num_rows より少なくなる
+    rows[0][5:7] = ["0", "0"]
+    return rows
+
+
+def write_csv(path: Path, rows: list) -> None:
+    # tlmdb.save と同じく, 区切り文字などを含むセルだけを引用する
+    Path(path).write_text(tlmdb.render_rows(rows))
+
+
+def write_tlm_db(path: Path, packets: int = 432, rows: typing.Tuple[int, int] = (50, 800), seed: int = 0) -> list:
+    """packets 個の TLM DB の CSV を書き, そのパスの一覧を返す.
+
+    各 packet の行数は rows の範囲の一様乱数で, packet 長が max_packet_bytes を超える分は作らない.
+    ヘッダは tlmdb.save と同じものなので, 書いた CSV は読み込んで保存し直しても変わらない.
+    """
+    rnd = random.Random(seed)
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    csv_paths = []
+    for packet_id in range(packets):
+        header = pd.DataFrame(
+            [
+                {
+                    "Target": "OBC",
+                    "PacketID": f"0x{packet_id:02x}",
+                    "Local Var": "",
+                    "Enable/Disable": rnd.choice(["ENABLE", "ENABLE", "DISABLE"]),
+                    "IsRestricted": "FALSE",
+                }
+            ]
+        )
+        csv_path = path / f"{prefix}TLM{packet_id:03d}.csv"
+        write_csv(csv_path, tlmdb.make_header(header) + telemetry_rows(rnd, rnd.randint(*rows)))
+        csv_paths.append(csv_path)
+    return csv_paths
+
+
+def write_cmd_db(path_cmd_db: Path, path_bct: Path, commands: int = 5000, seed: int = 0) -> dict:
+    """commands 個のコマンドを持つ CMD_DB と BCT を書き, 全コマンドが収まる allocation を返す."""
+    rnd = random.Random(seed)
+    counts = [0] * len(categories)
+    for _ in range(commands):
+        counts[rnd.randrange(len(categories))] += 1
+    rows = [
+        [
+            "Component",
+            "Name",
+            "Target",
+            "Code",
+            "Num Params",
+            "Param1",
+            "",
+            "Param2",
+            "",
+            "Param3",
+            "",
+            "Param4",
+            "",
+            "Param5",
+            "",
+            "Param6",
+            "",
+            "Danger Flag",
+            "Is Restricted",
+            "Description",
+            "Note",
+        ],
+        ["MOBC", "", "", "", "", *["Type", "Description"] * 6, "", "", "", ""],
+        [""] * 21,
+        ["*", "EXAMPLE", "OBC", "", "2", "int32_t", "address", "double", "time [s]", *[""] * 12],
+    ]
+    for category, count in zip(categories, counts):
+        rows.append([f"* {category}", *[""] * 20])
+        for i in range(count):
+            num_params = rnd.choices(range(7), [4, 4, 3, 2, 1, 1, 1])[0]
+            params = []
+            for j in range(6):
+                types = last_param_types if j == num_params - 1 else param_types
+                params += [rnd.choice(types), f"param{j + 1}"] if j < num_params else ["", ""]
+            name = f"Cmd_{rnd.choice(components)}_{category.upper()}_{i}"
+            rows.append(
+                [
+                    "",
+                    name,
+                    "OBC",
+                    "",
+                    str(num_params),
+                    *params,
+                    "danger" if rnd.random() < 0.1 else "",
+                    "restricted" if rnd.random() < 0.05 else "",
+                    f"{name} command",
+                    "",
+                ]
+            )
+    write_csv(path_cmd_db, rows)
+
+    rows = [
+        ["Comment", "Name", "ShortName", "BCID", "エイリアス", "", "", "", "", "Danger Flag", "Description", "Note"],
+        ["", "", "", "", "Deploy", "SetBlockPosition", "Clear", "Activate", "Inactivate", "", "", ""],
+        [""] * 12,
+    ]
+    for bcid in range(max(commands // 20, 1)):
+        name = f"BC_{rnd.choice(components)}_{bcid}"
+        # 空の Alias は dblint が warning にするので全部埋める
+        aliases = [f"{name}_{alias}" for alias in ["DEPLOY", "SET", "CLEAR", "ACT", "INACT"]]
+        rows.append(["", name, f"BC{bcid}", str(bcid), *aliases, "danger" if rnd.random() < 0.05 else "", f"{name} block", ""])
+    write_csv(path_bct, rows)
+    # 余裕を持たせて 64 単位に切り上げる
+    return {category: (count * 5 // 4 // 64 + 1) * 64 for category, count in zip(categories, counts)}
+
+
+def generate(out_dir: Path, packets: int = 432, rows: typing.Tuple[int, int] = (50, 800), commands: int = 5000, seed: int = 0) -> Path:
+    """out_dir に TLM DB と CMD DB を書き, それを使う settings.toml のパスを返す."""
+    out_dir = Path(out_dir)
+    write_tlm_db(out_dir / "TLM_DB", packets, rows, seed)
+    (out_dir / "CMD_DB").mkdir(parents=True, exist_ok=True)
+    allocation = write_cmd_db(out_dir / "CMD_DB" / cmd_db_name, out_dir / "CMD_DB" / bct_name, commands, seed)
+    settings = {
+        "generated": {
+            "tlmdb": {
+                "is_main_obc": True,
+                "is_c2a_enable": True,
+                "prefix": prefix,
+                "path": "TLM_DB",
+                "dest_path": "TLM_DB/calced_data",
+                "max_tlm_num": max(packets, 432),
+            },
+            "cmddb": {"path_bct": f"CMD_DB/{bct_name}", "path_cmd_db": f"CMD_DB/{cmd_db_name}", "allocation": allocation},
+        }
+    }
+    settings_file = out_dir / "settings.toml"
+    with open(settings_file, "w") as f:
+        toml.dump(settings, f)
+    return settings_file
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Generate a synthetic C2A TLM DB / CMD DB.")
+    parser.add_argument("out_dir", type=Path)
+    parser.add_argument("--packets", type=int, default=432, help="number of TLM packets (default: 432)")
+    parser.add_argument("--rows", type=int, nargs=2, default=[50, 800], metavar=("MIN", "MAX"), help="rows per packet (default: 50 800)")
+    parser.add_argument("--commands", type=int, default=5000, help="number of commands in CMD_DB (default: 5000)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    settings_file = generate(args.out_dir, args.packets, tuple(args.rows), args.commands, args.seed)
+    print(f"wrote {settings_file}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
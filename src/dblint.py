@@ -0,0 +1,453 @@
+"""TLM DB の全 packet と CMD_DB / BCT の整合性を, エディタで開かずにまとめて検査する.
+
+    python src/dblint.py [project ...] [--settings FILE] [-j N] [--format text|json] [--fail-on error|warning]
+
+ファイルごとの検査はプロセスプールで並列に行い, packet をまたぐ検査 (PacketID の重複) はその結果から行う.
+結果は "ファイル:行: severity [check] message" の形か, --format json で Issue の list として出力する.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import typing
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import cmddb
+import conversion
+import project
+import tlmdb
+
+# C2A の TCP_MAX_LEN. settings の max_packet_bytes で変えられる
+default_max_packet_bytes = 432
+alias_columns = ["Alias Deploy", "Alias SetBlockPosition", "Alias Clear", "Alias Activate", "Alias Inactivate"]
+param_types = set(tlmdb.type2bit) | {"raw"}
+
+
+class Issue(typing.NamedTuple):
+    path: str
+    line: int  # CSV の行番号 (1 から). ファイル全体のときは 0
+    column: str
+    check: str
+    severity: str  # "error" / "warning"
+    message: str
+
+
+class Job(typing.NamedTuple):
+    kind: str  # "packet" / "CMD_DB" / "BCT"
+    path: Path
+    options: tuple  # packet: (max_packet_bytes, max_tlm_num), CMD_DB: allocation の items
+    project: str = ""  # packet をまたぐ検査は同じ project の中だけで行う
+
+
+class Result(typing.NamedTuple):
+    issues: typing.List[Issue]
+    key: typing.Optional[str]  # packet をまたぐ検査に使う値. packet の PacketID
+
+
+def read_table(csv_path: Path, columns: typing.List[str], start: int) -> typing.Tuple[list, pd.DataFrame, np.ndarray]:
+    # 型の変換をせずに文字列のまま読む. 型に合わない値もそのまま検査するため
+    with open(csv_path, "r", errors="ignore") as csv_file:
+        rows = list(csv.reader(csv_file, delimiter=","))
+    width = len(columns)
+    body = rows[start:]
+    df = pd.DataFrame([(row + [""] * (width - len(row)))[:width] for row in body], columns=columns)
+    return rows, df, np.arange(start + 1, start + 1 + len(body))
+
+
+class Report:
+    """1 つのファイルの Issue を, 行の mask から作る."""
+
+    def __init__(self, path: Path, lines: np.ndarray):
+        self.path = str(path)
+        self.lines = lines
+        self.issues: typing.List[Issue] = []
+
+    def add(self, line: int, column: str, check: str, severity: str, message: str) -> None:
+        self.issues.append(Issue(self.path, int(line), column, check, severity, message))
+
+    def rows(self, mask, column: str, check: str, severity: str, messages: typing.Iterable[str]) -> None:
+        positions = np.flatnonzero(np.asarray(mask))
+        for position, message in zip(positions, itertools.islice(messages, len(positions))):
+            self.add(self.lines[position], column, check, severity, message)
+
+    def duplicates(self, values: pd.Series, mask, column: str, check: str) -> None:
+        # 2 回目以降に現れた行に, 最初に現れた行を示して印を付ける
+        values = values[np.asarray(mask)]
+        first_line = pd.Series(self.lines[np.flatnonzero(np.asarray(mask))], index=values.index).groupby(values).transform("min")
+        repeated = values.duplicated(keep="first")
+        for index in values.index[repeated]:
+            self.add(self.lines[index], column, check, "error", f"{column} {values[index]!r} is also used on line {first_line[index]}")
+
+
+def lint_packet(csv_path: Path, max_packet_bytes: int, max_tlm_num: typing.Optional[int]) -> Result:
+    rows, df, lines = read_table(csv_path, list(tlmdb.dict_index.values()), tlmdb.num_start_line)
+    report = Report(csv_path, lines)
+    header = {row[1]: row[2] for row in rows[:4] if len(row) > 2}
+    packet_id = header.get("PacketID")
+    try:
+        value = int(packet_id, 0)
+        if max_tlm_num is not None and not 0 <= value < max_tlm_num:
+            report.add(2, "PacketID", "packet-id", "error", f"PacketID {packet_id} is out of range (0 to {max_tlm_num - 1})")
+    except (TypeError, ValueError):
+        report.add(2, "PacketID", "packet-id", "error", f"invalid PacketID {packet_id!r}")
+        packet_id = None
+
+    # Name が空の行は TLM の行ではない (tlmdb.make_table と同じ)
+    has_name = (df["Name"] != "").to_numpy()
+    df, report.lines = df[has_name].reset_index(drop=True), lines[has_name]
+    var_type = df["VarType"]
+    is_cont = var_type == "||"
+    is_head = ~is_cont & is_cont.shift(-1, fill_value=False)
+    width = var_type.map(tlmdb.type2bit)
+    unknown = ~is_cont & width.isna()
+    report.rows(unknown, "VarType", "var-type", "error", (f"unknown VarType {v!r}" for v in var_type[unknown]))
+    report.duplicates(df["Name"], np.ones(len(df), dtype=bool), "Name", "duplicate-name")
+
+    # bitfield の行 ("||" とその直前の行) は CSV の BitLen を使う
+    is_bitfield = is_cont | is_head
+    literal = pd.to_numeric(df["BitLen"], errors="coerce")
+    bad_bitlen = is_bitfield & ~(literal > 0)
+    report.rows(bad_bitlen, "BitLen", "bit-length", "error", (f"invalid bitfield BitLen {v!r}" for v in df["BitLen"][bad_bitlen]))
+    orphan = is_cont & ~is_bitfield.shift(1, fill_value=False)
+    report.rows(orphan, "VarType", "bitfield", "error", itertools.repeat("'||' without a preceding bitfield head"))
+    bits = literal.where(is_bitfield, width).where(~(unknown | bad_bitlen), 0).astype(np.int64)
+
+    # bitfield の合計が先頭の型の幅を超えると, 次の field と bit の範囲が重なる
+    group = (~is_cont).cumsum()
+    total = group.map(bits.groupby(group).sum()).to_numpy()
+    container = width.fillna(0).to_numpy(dtype=np.int64)
+    heads = (is_head & ~unknown).to_numpy()
+    over, under = heads & (total > container), heads & (total < container)
+    report.rows(
+        over,
+        "BitLen",
+        "bit-overlap",
+        "error",
+        (f"bitfield uses {t} bits but {v} has {c}; it overlaps the next field" for t, v, c in zip(total[over], var_type[over], container[over])),
+    )
+    report.rows(
+        under,
+        "BitLen",
+        "bitfield-padding",
+        "warning",
+        (f"bitfield uses {t} of the {c} bits of {v}" for t, v, c in zip(total[under], var_type[under], container[under])),
+    )
+
+    # OctPos / BitPos が数式でなく数値で書かれていれば, BitLen から求めた位置と比べる
+    offsets = np.concatenate([[0], np.cumsum(bits.to_numpy())])
+    octpos, bitpos = pd.to_numeric(df["OctPos"], errors="coerce"), pd.to_numeric(df["BitPos"], errors="coerce")
+    written = (octpos * 8 + bitpos).to_numpy()
+    has_pos = ~np.isnan(written)
+    overlap = has_pos & (written < offsets[:-1])
+    report.rows(
+        overlap,
+        "OctPos",
+        "bit-overlap",
+        "error",
+        (f"starts at bit {int(w)} but the previous field ends at bit {e}" for w, e in zip(written[overlap], offsets[:-1][overlap])),
+    )
+    moved = has_pos & (written > offsets[:-1])
+    report.rows(
+        moved,
+        "OctPos",
+        "position",
+        "warning",
+        (f"written position {int(w)} differs from the computed position {e}" for w, e in zip(written[moved], offsets[:-1][moved])),
+    )
+
+    # ConvType / ConvInfo が変換できるか. 同じ組み合わせは 1 回だけ調べる
+    converted = df[df["ConvType"].isin(["POLY", "STATUS"])]
+    conv = pd.DataFrame({"type": df["ConvType"], "info": tlmdb.fold_conv_info(converted).reindex(df.index, fill_value="")})
+    for (conv_type, info), positions in conv.groupby(["type", "info"], sort=False).indices.items():
+        if conv_type == "":
+            continue
+        if conv_type not in tlmdb.conv_type_dtype.categories:
+            column, message = "ConvType", f"unknown ConvType {conv_type!r}"
+        else:
+            try:
+                conversion.compile_conversion(conv_type, info)
+                continue
+            except ValueError as e:
+                column, message = "ConvInfo", str(e)
+        for position in positions:
+            report.add(report.lines[position], column, "conversion", "error", message)
+
+    limit = max_packet_bytes * 8
+    if offsets[-1] > limit:
+        position = int(np.searchsorted(offsets[1:], limit, side="right"))
+        report.add(
+            report.lines[position],
+            "BitLen",
+            "packet-size",
+            "error",
+            f"packet is {offsets[-1] // 8} bytes ({offsets[-1]} bits); this field crosses the limit of {max_packet_bytes} bytes",
+        )
+    elif offsets[-1] % 8:
+        report.add(0, "BitLen", "packet-size", "warning", f"packet is {offsets[-1]} bits, not a whole number of bytes")
+    return Result(report.issues, packet_id)
+
+
+def lint_cmd_db(csv_path: Path, allocation: dict) -> Result:
+    index = cmddb.dict_index["CMD_DB"]
+    _, df, lines = read_table(csv_path, [index[i] for i in range(len(index) - 1)], index["num_start_line"])
+    report = Report(csv_path, lines)
+    is_cmd, code, section_id, words, _ = cmddb.code_sections(allocation, df)
+    # section_id は 1 から始まる区間の番号 (0 は最初の区間より前)
+    is_cmd = is_cmd.to_numpy()
+    report.duplicates(df["Name"], is_cmd, "Name", "duplicate-name")
+    report.rows(is_cmd & (df["Target"] == "").to_numpy(), "Target", "target", "warning", itertools.repeat("command without a Target"))
+
+    types = df[cmddb.param_type_columns]
+    for column in cmddb.param_type_columns:
+        unknown = is_cmd & ~types[column].isin(param_types | {""}).to_numpy()
+        report.rows(unknown, column, "param-type", "error", (f"unknown parameter type {v!r}" for v in types[column][unknown]))
+    # raw は可変長なので最後のパラメータにしか使えない
+    is_raw = (types == "raw").to_numpy()
+    filled = (types != "").to_numpy()
+    after_raw = (np.cumsum(is_raw, axis=1) - is_raw > 0) & filled
+    report.rows(is_cmd & after_raw.any(axis=1), "Param1 Type", "param-type", "error", itertools.repeat("raw must be the last parameter"))
+
+    # Code は calc_cmd_db と同じ番号. allocation を超えた区間があると他の区間と同じ Code になる
+    # 区間があふれると後ろのコマンドがまとめて重なるので, 区間ごとに 1 つにまとめる
+    codes = code.to_numpy()[is_cmd]
+    positions = np.flatnonzero(is_cmd)
+    first = pd.Series(positions).groupby(codes).transform("min").to_numpy()
+    repeated = first != positions
+    for section in np.unique(section_id.to_numpy()[positions[repeated]]):
+        rows = repeated & (section_id.to_numpy()[positions] == section)
+        position, earlier = positions[rows][0], first[rows][0]
+        report.add(
+            lines[position],
+            "Code",
+            "duplicate-code",
+            "error",
+            f"{rows.sum()} command(s) in this section collide with earlier codes, starting with 0x{codes[rows][0]:04X} (also line {lines[earlier]})",
+        )
+    section_lines = lines[np.flatnonzero(df["Comment"].str.startswith("* ").to_numpy())]
+    used = pd.Series(is_cmd).groupby(section_id.to_numpy()).sum()
+    known = {key.upper(): size for key, size in allocation.items()}
+    for number, (word, line) in enumerate(zip(words, section_lines), 1):
+        if word == "NONORDER":
+            continue
+        if word not in known:
+            report.add(line, "Comment", "allocation", "warning", f"section {word} is not in the allocation of the settings")
+        elif used.get(number, 0) > known[word]:
+            report.add(line, "Comment", "allocation", "error", f"section {word} has {used.get(number, 0)} commands but {known[word]} are allocated")
+    return Result(report.issues, None)
+
+
+def lint_bct(csv_path: Path) -> Result:
+    index = cmddb.dict_index["BCT"]
+    _, df, lines = read_table(csv_path, [index[i] for i in range(len(index) - 1)], index["num_start_line"])
+    report = Report(csv_path, lines)
+    is_entry = ((df["Comment"] == "") & (df["Name"] != "")).to_numpy()
+    for column in ["Name", "ShortName", "BCID"]:
+        report.duplicates(df[column], is_entry & (df[column] != "").to_numpy(), column, f"duplicate-{column.lower()}")
+    bad_id = is_entry & pd.to_numeric(df["BCID"], errors="coerce").isna().to_numpy()
+    report.rows(bad_id, "BCID", "bcid", "error", (f"invalid BCID {v!r}" for v in df["BCID"][bad_id]))
+    missing = (df[alias_columns] == "").to_numpy()
+    has_missing = is_entry & missing.any(axis=1)
+    report.rows(
+        has_missing,
+        "Alias",
+        "missing-alias",
+        "warning",
+        ("missing " + ", ".join(c[len("Alias ") :] for c, m in zip(alias_columns, row) if m) for row in missing[has_missing]),
+    )
+    return Result(report.issues, None)
+
+
+def run_job(job: Job) -> Result:
+    try:
+        if job.kind == "packet":
+            return lint_packet(job.path, *job.options)
+        if job.kind == "CMD_DB":
+            return lint_cmd_db(job.path, dict(job.options))
+        return lint_bct(job.path)
+    except Exception as e:
+        return Result([Issue(str(job.path), 0, "", "read", "error", f"{type(e).__name__}: {e}")], None)
+
+
+def packet_jobs(settings: dict, name: str = "") -> typing.List[Job]:
+    options = (int(settings.get("max_packet_bytes", default_max_packet_bytes)), settings.get("max_tlm_num"))
+    return [Job("packet", csv_path, options, name) for csv_path in project.get_csv_paths(settings)]
+
+
+def table_jobs(settings: dict, name: str = "") -> typing.List[Job]:
+    allocation = tuple(sorted(settings.get("allocation", {}).items()))
+    return [Job(kind, Path(settings[cmddb.path_keys[kind]]), allocation if kind == "CMD_DB" else (), name) for kind in cmddb.loaders]
+
+
+def cross_packet(results: typing.Dict[Job, Result]) -> typing.List[Issue]:
+    # 同じ project の別の packet と同じ PacketID. project が違えば同じ PacketID を使ってよい
+    first: typing.Dict[typing.Tuple[str, int], Job] = {}
+    issues = []
+    for job, result in sorted(results.items(), key=lambda item: (item[0].project, str(item[0].path))):
+        if job.kind != "packet" or result.key is None:
+            continue
+        key = (job.project, int(result.key, 0))
+        if key in first:
+            issues.append(
+                Issue(str(job.path), 2, "PacketID", "duplicate-packet-id", "error", f"PacketID {result.key} is also used by {first[key].path.name}")
+            )
+        else:
+            first[key] = job
+    return issues
+
+
+class Linter:
+    """ファイルごとの検査結果を (mtime, size) と一緒に持ち, 変わったファイルだけを検査し直す.
+
+    run() は検査の終わったファイルから順に結果を返すので, 全体が終わる前に表示できる.
+    プロセスプールは最初に検査するときに作り, close() まで使い回す.
+    Streamlit はスクリプトを __main__ として実行するので, spawn のワーカーはエディタのスクリプトを読み直してしまい,
+    fork はサーバーのスレッドごと複製してしまう. エディタからは processes=False でスレッドを使う.
+    """
+
+    def __init__(self, max_workers: typing.Optional[int] = None, processes: bool = True):
+        self.max_workers = max_workers
+        self.processes = processes
+        self._executor: typing.Optional[Executor] = None
+        self._results: typing.Dict[Job, typing.Tuple[typing.Optional[typing.Tuple[int, int]], Result]] = {}
+        self._lock = threading.Lock()
+        # 実行中の run() が投入した Future. close() で残りを取り消す
+        self._submitted: typing.Set[Future] = set()
+
+    def executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                pool = ProcessPoolExecutor if self.processes else ThreadPoolExecutor
+                self._executor = pool(max_workers=self.max_workers)
+            return self._executor
+
+    def stale(self, jobs: typing.List[Job]) -> typing.List[Job]:
+        with self._lock:
+            return [job for job in jobs if self._results.get(job, (None,))[0] != file_stamp(job.path)]
+
+    def run(self, jobs: typing.List[Job]) -> typing.Iterator[typing.Tuple[Job, Result]]:
+        stale = set(self.stale(jobs))
+        with self._lock:
+            cached = [(job, self._results[job][1]) for job in jobs if job not in stale]
+        yield from cached
+        if not stale:
+            return
+        # 検査の前の (mtime, size) を記録するので, 検査中に書き換えられたファイルは次の run() で検査し直す
+        futures: typing.Dict[Future, typing.Tuple[Job, typing.Optional[typing.Tuple[int, int]]]] = {
+            self.executor().submit(run_job, job): (job, file_stamp(job.path)) for job in stale
+        }
+        with self._lock:
+            self._submitted.update(futures)
+        try:
+            for future in as_completed(futures):
+                job, stamp = futures[future]
+                result = future.result()
+                with self._lock:
+                    self._results[job] = (stamp, result)
+                yield job, result
+        finally:
+            # 途中でやめたとき (Streamlit の rerun で中断されたときなど) は残りを取り消す
+            for future in futures:
+                future.cancel()
+            with self._lock:
+                self._submitted.difference_update(futures)
+
+    def close(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+            submitted, self._submitted = self._submitted, set()
+        if executor is not None:
+            # shutdown(cancel_futures=True) は Python 3.9 からなので, 始まっていないものを自分で取り消す
+            for future in submitted:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+
+def file_stamp(path: Path) -> typing.Optional[typing.Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def issue_rows(results: typing.Dict[Job, Result]) -> typing.List[Issue]:
+    # ファイル名と行の順に並べ, packet をまたぐ検査の結果も加える
+    issues = [issue for result in results.values() for issue in result.issues] + cross_packet(results)
+    return sorted(issues, key=lambda issue: (issue.path, issue.line, issue.column))
+
+
+def lint_panel(linter: Linter, jobs: typing.List[Job], every: int = 20) -> None:
+    """Streamlit の画面に, 検査の終わったファイルから結果を表示する."""
+    # Streamlit は UI から呼ぶときだけ読み込む (CLI とワーカーのプロセスでは使わない)
+    import streamlit as st
+
+    progress = st.progress(0.0)
+    table = st.empty()
+    results: typing.Dict[Job, Result] = {}
+
+    def show() -> None:
+        issues = [issue._replace(path=Path(issue.path).name) for issue in issue_rows(results)]
+        errors = sum(issue.severity == "error" for issue in issues)
+        progress.progress(
+            len(results) / max(len(jobs), 1), text=f"{len(results)}/{len(jobs)} files: {errors} errors, {len(issues) - errors} warnings"
+        )
+        table.dataframe(pd.DataFrame(issues, columns=Issue._fields), hide_index=True)
+
+    for job, result in linter.run(jobs):
+        results[job] = result
+        if len(results) % every == 0:
+            show()
+    show()
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Check every TLM DB packet and the CMD DB tables for consistency errors.")
+    parser.add_argument("projects", nargs="*", help="project names (default: every [*.tlmdb] and [*.cmddb] section)")
+    parser.add_argument("--settings", type=Path, help="settings toml (default: same lookup as the editors)")
+    parser.add_argument("-j", "--jobs", type=int, help="number of worker processes")
+    parser.add_argument("--format", choices=["text", "json"], default="text", help="json prints a list of issues for CI")
+    parser.add_argument("--fail-on", choices=["error", "warning"], default="error", help="lowest severity that makes the exit status 1")
+    args = parser.parse_args(argv)
+
+    path_base, settings = project.load_settings(args.settings)
+    tlm_sections, cmd_sections = project.sections(settings, "tlmdb"), project.sections(settings, "cmddb")
+    unknown = [name for name in args.projects if name not in tlm_sections + cmd_sections]
+    if unknown:
+        parser.error(f"unknown project(s): {', '.join(unknown)} (choose from {', '.join(sorted(set(tlm_sections + cmd_sections)))})")
+    jobs = []
+    for name in args.projects or tlm_sections:
+        if name in tlm_sections:
+            jobs += packet_jobs(project.tlmdb_settings(path_base, settings, name), name)
+    for name in args.projects or cmd_sections:
+        if name in cmd_sections:
+            jobs += table_jobs(project.cmddb_settings(path_base, settings, name), name)
+
+    start = time.perf_counter()
+    linter = Linter(args.jobs)
+    results = dict(linter.run(jobs))
+    linter.close()
+    issues = issue_rows(results)
+    seconds = time.perf_counter() - start
+    if args.format == "json":
+        json.dump([issue._asdict() for issue in issues], sys.stdout, indent=1, ensure_ascii=False)
+        print()
+    else:
+        for issue in issues:
+            print(f"{issue.path}:{issue.line}: {issue.severity} [{issue.check}] {issue.column}: {issue.message}")
+    counts = {severity: sum(issue.severity == severity for issue in issues) for severity in ["error", "warning"]}
+    print(f"{len(jobs)} files checked in {seconds:.2f}s: {counts['error']} errors, {counts['warning']} warnings", file=sys.stderr)
+    failing = ["error"] if args.fail_on == "error" else ["error", "warning"]
+    return 1 if any(issue.severity in failing for issue in issues) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+import json
+import threading
+import typing
+
+
+class Snapshot(typing.NamedTuple):
+    key: typing.Hashable
+    version: int
+    digest: str
+    data: typing.Any  # 全 session で共有するので書き換えない
+
+
+class DBStore:
+    """1 つの project section の DB を, 全 session で共有する読み取り専用の版 (snapshot) として持つ.
+
+    key (packet 名や CMD_DB / BCT) ごとに, CSV の digest が変わったときだけ build で作り直し, 新しい version を振る.
+    version は store 全体で増え続けるので, 同じ version なら同じ内容. 古い snapshot は参照している session がなくなれば消える.
+    session は snapshot を参照するだけで, 編集は st.data_editor の差分か, 編集したときに作る自分のコピー (overlay) に持つ.
+    """
+
+    def __init__(self):
+        self._snapshots: typing.Dict[typing.Hashable, Snapshot] = {}
+        self._building: typing.Dict[typing.Hashable, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._version = 0
+
+    def get(self, key: typing.Hashable, digest: str, build: typing.Callable[[], typing.Any]) -> Snapshot:
+        """key の digest の snapshot. なければ build() で作る. 同時に来た session の分も 1 回だけ作る."""
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None and snapshot.digest == digest:
+                return snapshot
+            building = self._building.setdefault(key, threading.Lock())
+        with building:
+            with self._lock:
+                snapshot = self._snapshots.get(key)
+            if snapshot is not None and snapshot.digest == digest:
+                return snapshot
+            data = build()
+            with self._lock:
+                self._version += 1
+                snapshot = Snapshot(key, self._version, digest, data)
+                self._snapshots[key] = snapshot
+        return snapshot
+
+    def versions(self) -> typing.Dict[typing.Hashable, int]:
+        with self._lock:
+            return {key: snapshot.version for key, snapshot in self._snapshots.items()}
+
+    def discard(self, key: typing.Hashable) -> None:
+        with self._lock:
+            self._snapshots.pop(key, None)
+
+
+class Revision(typing.NamedTuple):
+    number: int
+    previous: typing.Optional[int]  # 前に見たときの number
+    rows: typing.Optional[typing.List[int]]  # previous から編集の変わった行. 行の追加・削除があるときは None
+
+
+class Revisions:
+    """st.data_editor の編集 (edited_rows / added_rows / deleted_rows) の版.
+
+    表そのものは hash せず, 編集の状態だけを前に見たものと比べて, 変わったときに番号を進める. 比べる手間は編集の数に比例する.
+    番号は増え続けるので, (snapshot の version, editor の key, number) を表の内容の token として使える.
+    """
+
+    def __init__(self):
+        self._seen: typing.Dict[str, typing.Tuple[dict, str, int]] = {}
+        self._number = 0
+
+    def observe(self, key: str, edits: dict) -> Revision:
+        edited = {int(row): json.dumps(cells, sort_keys=True, default=str) for row, cells in (edits.get("edited_rows") or {}).items()}
+        structure = json.dumps([edits.get("added_rows") or [], edits.get("deleted_rows") or []], sort_keys=True, default=str)
+        seen = self._seen.get(key)
+        if seen is not None and seen[:2] == (edited, structure):
+            return Revision(seen[2], seen[2], [])
+        self._number += 1
+        self._seen[key] = (edited, structure, self._number)
+        if seen is None:
+            return Revision(self._number, None, None)
+        rows = None
+        if structure == seen[1] == "[[], []]":
+            rows = sorted(row for row in edited.keys() | seen[0].keys() if edited.get(row) != seen[0].get(row))
+        return Revision(self._number, seen[2], rows)
+
+
+class TokenCache:
+    """token (版) が前と同じなら, 計算せずに前の結果を返す. 当たりの判定は token の比較だけなので表の大きさによらない."""
+
+    def __init__(self):
+        self.token: typing.Hashable = None
+        self.value: typing.Any = None
+
+    def get(self, token: typing.Hashable, compute: typing.Callable[[], typing.Any]) -> typing.Any:
+        if token is None or token != self.token:
+            self.value = compute()
+            self.token = token
+        return self.value
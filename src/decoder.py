@@ -0,0 +1,204 @@
+"""TLM DB の packet の定義から, 生のテレメトリのフレームをまとめて復号する.
+
+    python src/decoder.py PACKET DUMP [--project NAME] [--settings FILE] [--offset N] [--stride N] [--convert] [--out FILE.npz]
+
+DUMP は同じ packet のフレームを stride バイトごとに並べたファイル (先頭の offset バイトは読み飛ばす).
+C2A のテレメトリは big endian で詰められている.
+"""
+
+import argparse
+import sys
+import time
+import typing
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import conversion
+import project
+import tlmdb
+
+type2dtype = {
+    "int8_t": np.dtype("i1"),
+    "int16_t": np.dtype(">i2"),
+    "int32_t": np.dtype(">i4"),
+    "uint8_t": np.dtype("u1"),
+    "uint16_t": np.dtype(">u2"),
+    "uint32_t": np.dtype(">u4"),
+    "float": np.dtype(">f4"),
+    "double": np.dtype(">f8"),
+}
+
+
+class FieldTable(typing.NamedTuple):
+    # 出力の型が同じ field をまとめたもの. 各行が 1 つの field
+    dtype: np.dtype  # 出力の型 (native endian)
+    names: typing.List[str]
+    index: np.ndarray  # 型どおりの field: 読むバイトの位置 (field, バイト). bitfield: 読む word の番号 (field,)
+    shift: typing.Optional[np.ndarray] = None
+    mask: typing.Optional[np.ndarray] = None
+    sign: typing.Optional[np.ndarray] = None  # 符号付きのときは符号 bit の値, 符号なしは 0
+
+
+class DecodePlan:
+    """1 つの packet の復号手順.
+
+    バイト境界に揃った型どおりの長さの field は, 型ごとに全 field のバイトをまとめて集めて big endian として読む.
+    bitfield などそれ以外の field は, それを含む (最大 8 バイトの) word をまとめて読み, (shift, mask, sign) の表で取り出す.
+    どちらもフレームの数によらず型ごとに数回の NumPy の演算で済む.
+    Comment が "*" の行は場所は取るが出力しない.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        var_type = df["VarType"].astype(object).where(df["VarType"].astype(object) != "||").ffill()
+        offsets = df["OctPos"].astype(np.int64).to_numpy() * 8 + df["BitPos"].astype(np.int64).to_numpy()
+        bitlen = df["BitLen"].astype(np.int64).to_numpy()
+        self.length = int(-(-(offsets + bitlen).max(initial=0) // 8))
+        self.names: typing.List[str] = []
+        aligned: typing.Dict[str, typing.List[typing.Tuple[str, int]]] = {}
+        words: typing.Dict[typing.Tuple[int, int], int] = {}
+        bits: typing.Dict[str, typing.List[tuple]] = {}
+        for i, (comment, name, raw_type, field_type) in enumerate(zip(df["Comment"], df["Name"], df["VarType"], var_type)):
+            if comment == "*" or bitlen[i] == 0:
+                continue
+            if field_type not in type2dtype:
+                raise ValueError(f"{name}: unknown VarType {field_type!r}")
+            dtype = type2dtype[field_type]
+            offset, length = int(offsets[i]), int(bitlen[i])
+            if raw_type != "||" and offset % 8 == 0 and length == dtype.itemsize * 8:
+                aligned.setdefault(field_type, []).append((name, offset // 8))
+            else:
+                start, end = offset // 8, (offset + length - 1) // 8
+                if end - start >= 8 or (dtype.kind == "f" and length != dtype.itemsize * 8):
+                    raise ValueError(f"{name}: cannot extract {length} bits of {field_type} at bit {offset}")
+                word = words.setdefault((start, end - start + 1), len(words))
+                sign = 1 << (length - 1) if dtype.kind == "i" else 0
+                bits.setdefault(field_type, []).append((name, word, (end + 1) * 8 - offset - length, (1 << length) - 1, sign))
+            self.names.append(name)
+        # 同じ名前の field は出力の dict で上書きされて 1 つ消えてしまう
+        names = pd.Series(self.names, dtype=object)
+        duplicated = sorted(set(names[names.duplicated()]))
+        if duplicated:
+            raise ValueError(f"duplicate field name(s): {', '.join(duplicated)}")
+
+        self.aligned = [
+            FieldTable(
+                type2dtype[t].newbyteorder("="),
+                [name for name, _ in items],
+                np.array([position for _, position in items])[:, None] + np.arange(type2dtype[t].itemsize),
+            )
+            for t, items in aligned.items()
+        ]
+        # 各 word の 8 バイトの位置. 8 バイトに満たない word の先頭は, フレームの末尾に足す 0 のバイト (位置 length) で埋める
+        self.words = np.full((len(words), 8), self.length, dtype=np.int64)
+        for (start, nbytes), word in words.items():
+            self.words[word, 8 - nbytes :] = np.arange(start, start + nbytes)
+        self.bits = [
+            FieldTable(
+                type2dtype[t].newbyteorder("="),
+                [item[0] for item in items],
+                np.array([item[1] for item in items]),
+                np.array([item[2] for item in items], dtype=np.uint64),
+                np.array([item[3] for item in items], dtype=np.uint64),
+                np.array([item[4] for item in items], dtype=np.int64),
+            )
+            for t, items in bits.items()
+        ]
+
+    def output_dtype(self, name: str) -> np.dtype:
+        return next(table.dtype for table in self.aligned + self.bits if name in table.names)
+
+    def decode(
+        self, buffer: typing.Any, offset: int = 0, stride: typing.Optional[int] = None, count: typing.Optional[int] = None, chunk_bytes: int = 1 << 20
+    ) -> typing.Dict[str, np.ndarray]:
+        """buffer (bytes, np.memmap など) の offset バイト目から stride バイトごとに並んだフレームを復号し, field ごとの配列を返す.
+
+        途中の配列が大きくならないように chunk_bytes 程度のフレームずつ処理する.
+        """
+        stride = stride or self.length
+        if stride < self.length:
+            raise ValueError(f"stride {stride} is shorter than the packet length {self.length}")
+        raw = np.frombuffer(buffer, dtype=np.uint8)
+        available = (len(raw) - offset - self.length) // stride + 1 if len(raw) - offset >= self.length else 0
+        count = max(available if count is None else min(count, available), 0)
+        # 同じ型の field は 1 つの 2 次元配列の行にする
+        outputs = [np.empty((len(table.names), count), dtype=table.dtype) for table in self.aligned + self.bits]
+        columns = {name: output[i] for table, output in zip(self.aligned + self.bits, outputs) for i, name in enumerate(table.names)}
+        if count == 0:
+            return {name: columns[name] for name in self.names}
+        frames = np.ndarray((count, self.length), dtype=np.uint8, buffer=raw, offset=offset, strides=(stride, 1))
+        step = max(chunk_bytes // stride, 1)
+        for begin in range(0, count, step):
+            end = min(begin + step, count)
+            # stride の間のバイトを除いて連続にしておくと, バイトを集める take が速い
+            part = np.ascontiguousarray(frames[begin:end])
+            for table, output in zip(self.aligned, outputs):
+                values = part.take(table.index.ravel(), axis=1).view(table.dtype.newbyteorder(">"))
+                output[:, begin:end] = values.T
+            if not self.bits:
+                continue
+            padded = np.zeros((end - begin, self.length + 1), dtype=np.uint8)
+            padded[:, :-1] = part
+            words = padded.take(self.words.ravel(), axis=1).view(">u8").astype(np.uint64)
+            for table, output in zip(self.bits, outputs[len(self.aligned) :]):
+                values = (words[:, table.index] >> table.shift) & table.mask
+                if table.dtype.kind == "f":
+                    values = values.astype(np.uint32 if table.dtype.itemsize == 4 else np.uint64).view(table.dtype)
+                else:
+                    # 符号付きは符号 bit で符号を拡張する. 符号なしは sign が 0 なので値は変わらない
+                    values = (values.astype(np.int64) ^ table.sign) - table.sign
+                output[:, begin:end] = values.T
+        return {name: columns[name] for name in self.names}
+
+
+def decode_file(plan: DecodePlan, path: Path, offset: int = 0, stride: typing.Optional[int] = None) -> typing.Dict[str, np.ndarray]:
+    # ファイル全体を読み込まずに memory map で渡す. 空のファイルは memory map できない
+    if Path(path).stat().st_size == 0:
+        return plan.decode(b"", offset, stride)
+    return plan.decode(np.memmap(path, dtype=np.uint8, mode="r"), offset, stride)
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Decode a dump of raw telemetry frames with the layout of a TLM DB packet.")
+    parser.add_argument("packet", help="packet name (CSV file name without the prefix)")
+    parser.add_argument("dump", type=Path, help="file of frames laid out every --stride bytes")
+    parser.add_argument("--project", help="project section (default: the only [*.tlmdb] section)")
+    parser.add_argument("--settings", type=Path, help="settings toml (default: same lookup as the editors)")
+    parser.add_argument("--offset", type=int, default=0, help="bytes to skip before the first frame")
+    parser.add_argument("--stride", type=int, help="bytes from one frame to the next (default: the packet length)")
+    parser.add_argument("--convert", action="store_true", help="apply the POLY / STATUS conversions of the TLM DB")
+    parser.add_argument("--out", type=Path, help="write the decoded columns to this .npz file")
+    args = parser.parse_args(argv)
+
+    path_base, settings = project.load_settings(args.settings)
+    sections = project.sections(settings, "tlmdb")
+    if args.project is None and len(sections) != 1:
+        parser.error(f"choose a project with --project ({', '.join(sections)})")
+    tlm_settings = project.tlmdb_settings(path_base, settings, args.project or sections[0])
+    csv_paths = {project.packet_name(csv_path, tlm_settings): csv_path for csv_path in project.get_csv_paths(tlm_settings)}
+    if args.packet not in csv_paths:
+        parser.error(f"unknown packet: {args.packet}")
+
+    df = tlmdb.extract_data(csv_paths[args.packet], tlm_settings)["data"]
+    plan = DecodePlan(df)
+    start = time.perf_counter()
+    columns = decode_file(plan, args.dump, args.offset, args.stride)
+    seconds = time.perf_counter() - start
+    frames = len(next(iter(columns.values()), []))
+    size = frames * (args.stride or plan.length)
+    print(
+        f"{args.packet}: {frames} frames x {len(columns)} fields ({plan.length} bytes/frame) in {seconds:.3f}s ({size / 1e6 / max(seconds, 1e-9):.0f} MB/s)"
+    )
+    if args.convert:
+        start = time.perf_counter()
+        columns = conversion.convert(df, columns)
+        print(f"converted in {time.perf_counter() - start:.3f}s")
+    if args.out:
+        # STATUS のラベルは object の配列なので, pickle なしで読めるように文字列の配列にする
+        np.savez(args.out, **{name: values.astype(str) if values.dtype == object else values for name, values in columns.items()})
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
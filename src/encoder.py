@@ -0,0 +1,183 @@
+"""CMD_DB のパラメータの型から, コマンドの列をまとめてバイト列にする.
+
+    python src/encoder.py SEQUENCE.csv [--project NAME] [--settings FILE] [--out FILE.bin]
+
+SEQUENCE.csv は 1 行 1 コマンドで, コマンド名とパラメータを並べる. 整数は 0x.. の 16 進数も書け, raw は 16 進数のバイト列.
+各コマンドは Code (uint16) とパラメータを big endian で詰めたもの. Code は calc_cmd_db と同じ番号になる.
+"""
+
+import argparse
+import csv
+import struct
+import sys
+import time
+import typing
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import cmddb
+import project
+
+type2format = {
+    "int8_t": "b",
+    "int16_t": "h",
+    "int32_t": "i",
+    "uint8_t": "B",
+    "uint16_t": "H",
+    "uint32_t": "I",
+    "float": "f",
+    "double": "d",
+}
+code_format = "H"
+
+
+class CommandLayout(typing.NamedTuple):
+    name: str
+    code: int
+    target: str
+    param_types: typing.List[str]
+    packer: struct.Struct  # Code と raw 以外のパラメータ
+    raw: bool  # 最後のパラメータが可変長の raw
+
+
+class Encoded(typing.NamedTuple):
+    data: bytes
+    offsets: np.ndarray  # i 番目のコマンドは data[offsets[i]:offsets[i + 1]]
+
+
+class CommandEncoder:
+    """CMD_DB の各コマンドの struct のレイアウトと, 名前からの索引.
+
+    Code は cmddb.code_sections で求めるので, allocation が同じならエディタの calc_cmd_db と一致する.
+    """
+
+    def __init__(self, allocation: dict, df: pd.DataFrame):
+        is_cmd, code, _, _, _ = cmddb.code_sections(allocation, df)
+        self.commands: typing.Dict[str, CommandLayout] = {}
+        # 編集中の DB でも他のコマンドは使えるように, 詰められないコマンドは使われたときにエラーにする
+        self.invalid: typing.Dict[str, str] = {}
+        rows = df[is_cmd.to_numpy()]
+        for (_, row), cmd_code in zip(rows.iterrows(), code[is_cmd]):
+            name = row["Name"]
+            param_types = [str(row[column]) for column in cmddb.param_type_columns if str(row[column]) not in ("", "nan")]
+            raw = param_types[-1:] == ["raw"]
+            fixed = param_types[:-1] if raw else param_types
+            unknown = [t for t in fixed if t not in type2format]
+            if name in self.commands or name in self.invalid:
+                self.commands.pop(name, None)
+                self.invalid[name] = "duplicate command name"
+            elif unknown:
+                self.invalid[name] = "raw must be the last parameter" if "raw" in unknown else f"unknown parameter type {unknown[0]!r}"
+            else:
+                self.commands[name] = CommandLayout(
+                    name,
+                    int(cmd_code),
+                    str(row["Target"]),
+                    param_types,
+                    struct.Struct(">" + code_format + "".join(type2format[t] for t in fixed)),
+                    raw,
+                )
+
+    def layout(self, name: str) -> CommandLayout:
+        layout = self.commands.get(name)
+        if layout is None:
+            raise ValueError(f"{name}: {self.invalid.get(name, 'unknown command')}")
+        return layout
+
+    def encode(self, commands: typing.Iterable[typing.Tuple[str, typing.Sequence[typing.Any]]]) -> Encoded:
+        """(コマンド名, パラメータ) の列を 1 つのバイト列に続けて詰める."""
+        items = []
+        sizes = []
+        for name, params in commands:
+            layout = self.layout(name)
+            params = list(params)
+            if len(params) != len(layout.param_types):
+                raise ValueError(f"{name}: expected {len(layout.param_types)} parameters, got {len(params)}")
+            raw = bytes(params.pop()) if layout.raw else b""
+            items.append((layout, params, raw))
+            sizes.append(layout.packer.size + len(raw))
+        offsets = np.zeros(len(items) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        data = bytearray(int(offsets[-1]))
+        for i, (layout, params, raw) in enumerate(items):
+            try:
+                layout.packer.pack_into(data, offsets[i], layout.code, *params)
+            except struct.error as e:
+                raise ValueError(f"command {i} ({layout.name}): {e}") from None
+            if raw:
+                data[offsets[i] + layout.packer.size : offsets[i + 1]] = raw
+        return Encoded(bytes(data), offsets)
+
+    def encode_columns(self, name: str, params: typing.Sequence[typing.Any]) -> Encoded:
+        """同じコマンドを, パラメータごとの配列 (長さは揃える) の値で繰り返す. raw のないコマンドだけ."""
+        layout = self.layout(name)
+        if layout.raw:
+            raise ValueError(f"{name}: commands with a raw parameter cannot be encoded by columns")
+        if len(params) != len(layout.param_types):
+            raise ValueError(f"{name}: expected {len(layout.param_types)} parameters, got {len(params)}")
+        columns = [np.asarray(column) for column in params]
+        count = len(columns[0]) if columns else 0
+        dtype = np.dtype([("code", ">" + code_format)] + [(f"p{i}", ">" + type2format[t]) for i, t in enumerate(layout.param_types)])
+        records = np.empty(count, dtype=dtype)
+        records["code"] = layout.code
+        for i, (param_type, column) in enumerate(zip(layout.param_types, columns)):
+            if len(column) != count:
+                raise ValueError(f"{name}: parameter {i + 1} has {len(column)} values, expected {count}")
+            if np.dtype(type2format[param_type]).kind in "iu" and count:
+                info = np.iinfo(np.dtype(type2format[param_type]))
+                if column.min() < info.min or column.max() > info.max:
+                    raise ValueError(f"{name}: parameter {i + 1} is out of range for {param_type}")
+            records[f"p{i}"] = column
+        return Encoded(records.tobytes(), np.arange(count + 1, dtype=np.int64) * dtype.itemsize)
+
+
+def parse_param(param_type: str, text: str) -> typing.Any:
+    if param_type == "raw":
+        return bytes.fromhex(text)
+    if param_type in ("float", "double"):
+        return float(text)
+    return int(text, 0)
+
+
+def read_sequence(encoder: CommandEncoder, csv_path: Path) -> list:
+    commands = []
+    with open(csv_path, "r") as csv_file:
+        for line, row in enumerate(csv.reader(csv_file), 1):
+            if not row or not row[0] or row[0].startswith("#"):
+                continue
+            layout = encoder.layout(row[0])
+            texts = row[1 : len(layout.param_types) + 1]
+            try:
+                commands.append((row[0], [parse_param(t, text) for t, text in zip(layout.param_types, texts)]))
+            except ValueError as e:
+                raise ValueError(f"{csv_path}:{line}: {e}") from None
+    return commands
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Encode a sequence of commands with the parameter types of CMD_DB.")
+    parser.add_argument("sequence", type=Path, help="CSV with one command per line: name, param1, param2, ...")
+    parser.add_argument("--project", help="project section (default: the only [*.cmddb] section)")
+    parser.add_argument("--settings", type=Path, help="settings toml (default: same lookup as the editors)")
+    parser.add_argument("--out", type=Path, help="write the encoded commands to this file")
+    args = parser.parse_args(argv)
+
+    path_base, settings = project.load_settings(args.settings)
+    sections = project.sections(settings, "cmddb")
+    if args.project is None and len(sections) != 1:
+        parser.error(f"choose a project with --project ({', '.join(sections)})")
+    cmd_settings = project.cmddb_settings(path_base, settings, args.project or sections[0])
+    encoder = CommandEncoder(cmd_settings["allocation"], cmddb.load_cmd_db(cmd_settings["path_cmd_db"])["data"])
+    commands = read_sequence(encoder, args.sequence)
+    start = time.perf_counter()
+    encoded = encoder.encode(commands)
+    print(f"{len(commands)} commands, {len(encoded.data)} bytes in {time.perf_counter() - start:.3f}s")
+    if args.out:
+        args.out.write_bytes(encoded.data)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+import collections
+import typing
+
+import numpy as np
+import pandas as pd
+
+
+class Delta(typing.NamedTuple):
+    """前の表から後の表への変更. 行の位置 (0 から) で表す.
+
+    行数が変わらないときは変わったセルだけを cells (列 -> (行, 前の値, 後の値)) に持つ.
+    行の挿入・削除があるときは, start 行からの removed の行を inserted の行に置き換える.
+    """
+
+    start: int
+    removed: typing.Optional[pd.DataFrame]
+    inserted: typing.Optional[pd.DataFrame]
+    cells: typing.Dict[str, typing.Tuple[np.ndarray, np.ndarray, np.ndarray]]
+
+    def rows(self) -> int:
+        if self.cells:
+            return len(set().union(*(rows.tolist() for rows, _, _ in self.cells.values())))
+        return max(len(self.removed), len(self.inserted))
+
+    def reversed(self) -> "Delta":
+        cells = {column: (rows, new, old) for column, (rows, old, new) in self.cells.items()}
+        return Delta(self.start, self.inserted, self.removed, cells)
+
+
+def row_hashes(df: pd.DataFrame, columns: typing.List[str]) -> np.ndarray:
+    # 空欄 ("" と NaN) は同じ値として扱う
+    frame = df.reindex(columns=columns).astype(object).where(lambda x: x.notna(), "")
+    return pd.util.hash_pandas_object(frame, index=False).to_numpy()
+
+
+def same_values(old: np.ndarray, new: np.ndarray) -> np.ndarray:
+    # row_hashes と同じく, 空欄 ("" と NaN) は同じ値として扱う
+    old_blank = pd.isna(old) | (old == "")
+    new_blank = pd.isna(new) | (new == "")
+    return (old == new) | (old_blank & new_blank)
+
+
+def cell_delta(before: pd.DataFrame, after: pd.DataFrame, columns: typing.List[str], changed: np.ndarray) -> typing.Optional[Delta]:
+    # 行数の同じ表の, changed の行のうち値の変わったセル. 変わったセルがなければ None
+    if not len(changed):
+        return None
+    cells = {}
+    for column in columns:
+        old = before[column].iloc[changed].to_numpy(dtype=object) if column in before else np.full(len(changed), None)
+        new = after[column].iloc[changed].to_numpy(dtype=object) if column in after else np.full(len(changed), None)
+        differs = ~same_values(old, new)
+        if differs.any():
+            cells[column] = (changed[differs], old[differs], new[differs])
+    if not cells:
+        return None
+    return Delta(int(min(rows.min() for rows, _, _ in cells.values())), None, None, cells)
+
+
+def diff(
+    before: pd.DataFrame, after: pd.DataFrame, columns: typing.List[str], hashes: typing.Optional[typing.Tuple[np.ndarray, np.ndarray]] = None
+) -> typing.Optional[Delta]:
+    """before から after への変更. columns の列だけを比べる. 変更がなければ None. hashes は計算済みの両方の row_hashes."""
+    old_hashes, new_hashes = hashes if hashes is not None else (row_hashes(before, columns), row_hashes(after, columns))
+    if len(before) == len(after):
+        return cell_delta(before, after, columns, np.flatnonzero(old_hashes != new_hashes))
+    # 先頭と末尾の同じ行を除いた範囲を置き換える
+    n = min(len(before), len(after))
+    mismatch = np.flatnonzero(old_hashes[:n] != new_hashes[:n])
+    start = int(mismatch[0]) if len(mismatch) else n
+    tail = np.flatnonzero(old_hashes[::-1][: n - start] != new_hashes[::-1][: n - start])
+    common = int(tail[0]) if len(tail) else n - start
+    removed = before.iloc[start : len(before) - common].copy()
+    inserted = after.iloc[start : len(after) - common].reindex(columns=before.columns).copy()
+    return Delta(start, removed, inserted, {})
+
+
+def apply(df: pd.DataFrame, delta: Delta, inplace: bool = False) -> pd.DataFrame:
+    """df に delta を適用する. セルの変更は変わったセルだけを書き換え, inplace なら df そのものを書き換える."""
+    if delta.cells:
+        if not inplace:
+            df = df.copy()
+        for column, (rows, _, new) in delta.cells.items():
+            dtype = df[column].dtype
+            df.iloc[rows, df.columns.get_loc(column)] = new.astype(dtype) if isinstance(dtype, np.dtype) and dtype.kind in "biuf" else new
+        return df
+    # 行の挿入・削除は行の位置がずれるので表を作り直す
+    end = delta.start + len(delta.removed)
+    return pd.concat([df.iloc[: delta.start], delta.inserted, df.iloc[end:]], ignore_index=True)
+
+
+class History:
+    """1 つの表の undo / redo の履歴. 表は最新のもの (current) だけを持ち, 履歴は変更 (Delta) を maxlen 件まで持つ.
+
+    columns は比べる列で, OctPos や Code など他の列から計算される列は含めない.
+    update() に表の版 (token) を渡すと, 前と同じ版の表は比べずに済ませる.
+    """
+
+    def __init__(self, table: pd.DataFrame, columns: typing.List[str], maxlen: int = 100):
+        self.columns = columns
+        self.current = table
+        self._hashes: typing.Optional[np.ndarray] = None  # current の row_hashes
+        self.token: typing.Hashable = None  # current の版
+        self.undo_stack: typing.Deque[Delta] = collections.deque(maxlen=maxlen)
+        self.redo_stack: typing.Deque[Delta] = collections.deque(maxlen=maxlen)
+        # current を undo / redo で作ったときは自分のものなので, 次の undo / redo はその場で書き換えてよい
+        self._owned = False
+
+    def hashes(self) -> np.ndarray:
+        if self._hashes is None:
+            self._hashes = row_hashes(self.current, self.columns)
+        return self._hashes
+
+    def matches(self, table: pd.DataFrame) -> bool:
+        return len(table) == len(self.current) and bool((row_hashes(table, self.columns) == self.hashes()).all())
+
+    def update(
+        self, table: pd.DataFrame, token: typing.Hashable = None, since: typing.Hashable = None, rows: typing.Optional[typing.List[int]] = None
+    ) -> typing.Optional[Delta]:
+        """編集後の表を記録する. 変更があれば履歴に積み, redo の履歴は捨てる.
+
+        token が current の版と同じなら何もしない. current が since の版で, 変わりうる行 (rows) が分かっているときはその行だけを比べる.
+        """
+        if table is self.current or (token is not None and token == self.token):
+            return None
+        if rows is not None and since is not None and since == self.token and len(table) == len(self.current):
+            # row_hashes は表が小さくても手間がかかるので, 変わりうる行のセルを直接比べる. current の row_hashes は必要になったときに計算し直す
+            delta = cell_delta(self.current, table, self.columns, np.asarray(rows, dtype=np.int64))
+            hashes = None
+        else:
+            # 表は rerun ごとに作り直されるので, 前の表の row_hashes は覚えておいて新しい表の分だけ計算する
+            hashes = row_hashes(table, self.columns)
+            delta = diff(self.current, table, self.columns, (self.hashes(), hashes))
+        self.token = token
+        if delta is None:
+            return None
+        self.current = table
+        self._hashes = hashes
+        self._owned = False
+        self.undo_stack.append(delta)
+        self.redo_stack.clear()
+        return delta
+
+    def _step(self, source: typing.Deque[Delta], target: typing.Deque[Delta], reverse: bool) -> pd.DataFrame:
+        delta = source.pop()
+        self.current = apply(self.current, delta.reversed() if reverse else delta, inplace=self._owned)
+        self._hashes = None
+        self.token = None
+        self._owned = True
+        target.append(delta)
+        return self.current
+
+    def undo(self) -> pd.DataFrame:
+        return self._step(self.undo_stack, self.redo_stack, reverse=True)
+
+    def redo(self) -> pd.DataFrame:
+        return self._step(self.redo_stack, self.undo_stack, reverse=False)
+
+    def changed_rows(self) -> int:
+        # 履歴が持っている行の数. メモリの目安
+        return sum(delta.rows() for delta in self.undo_stack) + sum(delta.rows() for delta in self.redo_stack)
@@ -0,0 +1,62 @@
+import sys
+import typing
+
+import pandas as pd
+
+
+def intern_columns(df: pd.DataFrame, columns: typing.Iterable[str]) -> pd.DataFrame:
+    # 同じ文字列が何度も出てくる列は 1 つの str オブジェクトを共有させる
+    for col in columns:
+        df[col] = df[col].map(lambda v: sys.intern(v) if type(v) is str else v)
+    return df
+
+
+def frame_bytes(df: pd.DataFrame, seen: typing.Optional[set] = None) -> int:
+    """df が使っているメモリ. 複数の行や表で共有されている str は seen を使って一度だけ数える."""
+    seen = set() if seen is None else seen
+    total = int(df.index.memory_usage())
+    for col in df.columns:
+        series = df[col]
+        if series.dtype != object:
+            total += int(series.memory_usage(index=False, deep=True))
+            continue
+        values = series.to_numpy()
+        total += values.nbytes
+        for value in values:
+            if id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+    return total
+
+
+def memory_report(frames: typing.Dict[str, pd.DataFrame], dropped: typing.Optional[typing.Dict[str, str]] = None) -> pd.DataFrame:
+    """表ごとのメモリ使用量と合計.
+
+    Bytes はそれより前の表と共有している str を含まない増分で, Naive bytes は共有を考えない pandas の見積もり.
+    dropped は読み込み時に持たないことにした列 (列名 -> その値を畳み込んだ列) で, Not stored に書く.
+    その列の分は小さく持ったのではなく数えていないだけなので, 全列を持つ表と比べるときは注意する.
+    """
+    seen: set = set()
+    folded: typing.Dict[str, list] = {}
+    for column, into in (dropped or {}).items():
+        folded.setdefault(into, []).append(column)
+    not_stored = "; ".join(f"{', '.join(columns)} (folded into {into})" for into, columns in folded.items())
+    rows = [
+        {
+            "Name": name,
+            "Rows": len(df),
+            "Bytes": frame_bytes(df, seen),
+            "Naive bytes": int(df.memory_usage(deep=True).sum()),
+            "Not stored": not_stored,
+        }
+        for name, df in frames.items()
+    ]
+    report = pd.DataFrame(rows, columns=["Name", "Rows", "Bytes", "Naive bytes", "Not stored"])
+    total = {
+        "Name": "(total)",
+        "Rows": report["Rows"].sum(),
+        "Bytes": report["Bytes"].sum(),
+        "Naive bytes": report["Naive bytes"].sum(),
+        "Not stored": not_stored,
+    }
+    return pd.concat([report, pd.DataFrame([total])], ignore_index=True)
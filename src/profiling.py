@@ -0,0 +1,116 @@
+import contextlib
+import cProfile
+import io
+import json
+import marshal
+import pstats
+import time
+import tracemalloc
+import typing
+from pathlib import Path
+
+import streamlit as st
+
+
+class RerunTimer:
+    """Streamlit の 1 回の rerun の中で, 段階ごとの時間を測る. 同じ名前の段階は合計する."""
+
+    def __init__(self):
+        self.stages: typing.Dict[str, float] = {}
+        self._start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> typing.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def total(self) -> float:
+        return time.perf_counter() - self._start
+
+    def rows(self) -> list:
+        total = self.total()
+        rows = [{"Stage": name, "ms": seconds * 1000} for name, seconds in self.stages.items()]
+        rows.append({"Stage": "(other)", "ms": (total - sum(self.stages.values())) * 1000})
+        rows.append({"Stage": "(total)", "ms": total * 1000})
+        return rows
+
+    def log(self, path: Path, **fields: typing.Any) -> None:
+        # 1 rerun を 1 行の JSON として追記する
+        record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), **fields, "total_ms": round(self.total() * 1000, 3)}
+        record["stages"] = {name: round(seconds * 1000, 3) for name, seconds in self.stages.items()}
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "a") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+class Capture:
+    """1 回の rerun の cProfile と tracemalloc の結果を取る."""
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+        self._tracing = tracemalloc.is_tracing()
+        self._result: typing.Optional[typing.Dict[str, bytes]] = None
+
+    def start(self) -> None:
+        if not self._tracing:
+            tracemalloc.start()
+        self._profile.enable()
+
+    def stop(self, limit: int = 50) -> typing.Dict[str, bytes]:
+        """ダウンロード用に, ファイル名と内容を返す. .prof は snakeviz などで開ける pstats の形式. 2 回目からは同じ結果を返す."""
+        if self._result is not None:
+            return self._result
+        self._profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        if not self._tracing:
+            tracemalloc.stop()
+        # pstats.Stats は profile から stats を取り出して空にするので, 先に .prof の内容を作る
+        self._profile.create_stats()
+        prof = marshal.dumps(self._profile.stats)
+        text = io.StringIO()
+        pstats.Stats(self._profile, stream=text).sort_stats("cumulative").print_stats(limit)
+        memory = "\n".join(str(stat) for stat in snapshot.statistics("lineno")[:limit])
+        self._result = {
+            "rerun.prof": prof,
+            "rerun-profile.txt": text.getvalue().encode(),
+            "rerun-tracemalloc.txt": memory.encode(),
+        }
+        return self._result
+
+
+def start_rerun(key: str) -> typing.Tuple[RerunTimer, typing.Optional[Capture]]:
+    # "Profile next rerun" がチェックされていたら, この rerun 全体の profile を取ってチェックを外す
+    capture = None
+    if st.session_state.pop(f"{key}_profile", False):
+        capture = Capture()
+        capture.start()
+    return RerunTimer(), capture
+
+
+@contextlib.contextmanager
+def rerun(key: str) -> typing.Iterator[typing.Tuple[RerunTimer, typing.Optional[Capture]]]:
+    """スクリプトの本体を囲む. st.stop() や st.experimental_rerun() で finish_rerun の前に終わっても, cProfile と tracemalloc を止める."""
+    timer, capture = start_rerun(key)
+    try:
+        yield timer, capture
+    finally:
+        if capture is not None:
+            st.session_state[f"{key}_capture"] = capture.stop()
+
+
+def finish_rerun(
+    key: str, timer: RerunTimer, capture: typing.Optional[Capture], log_path: typing.Optional[Path] = None, **fields: typing.Any
+) -> None:
+    """サイドバーに段階ごとの時間を表示し, log_path があれば記録する."""
+    if capture is not None:
+        st.session_state[f"{key}_capture"] = capture.stop()
+    if log_path:
+        timer.log(log_path, **fields)
+    with st.sidebar.expander("Timing"):
+        st.dataframe(timer.rows(), hide_index=True, column_config={"ms": st.column_config.NumberColumn(format="%.1f")})
+        st.checkbox("Profile next rerun", key=f"{key}_profile", help="Capture cProfile and tracemalloc for one full rerun")
+        for name, content in st.session_state.get(f"{key}_capture", {}).items():
+            st.download_button(name, content, file_name=name, key=f"{key}_{name}")
@@ -0,0 +1,53 @@
+import json
+from pathlib import Path
+
+import toml
+
+
+def find_settings_file() -> Path:
+    for parent in [Path(__file__).parents[i] for i in range(4)]:
+        for file_name in ["tlm_cmd_db_editor_config.toml", "settings.toml"]:
+            path = parent / file_name
+            if path.is_file():
+                return path
+    raise FileNotFoundError("settings.toml / tlm_cmd_db_editor_config.toml is not found.")
+
+
+def load_settings(settings_file: Path = None) -> tuple:
+    settings_file = Path(settings_file) if settings_file else find_settings_file()
+    settings = json.loads(json.dumps(toml.load(settings_file)))
+    return settings_file.parent, settings
+
+
+def resolve_paths(path_base: Path, settings: dict, path_names: list) -> dict:
+    # 設定ファイルからの相対パスを絶対パスにする. 任意の項目は書かれていなければそのまま
+    settings = dict(settings)
+    for path_name in path_names:
+        if path_name in settings:
+            settings[path_name] = path_base / settings[path_name]
+    return settings
+
+
+def tlmdb_settings(path_base: Path, settings: dict, project: str) -> dict:
+    return resolve_paths(path_base, settings[project]["tlmdb"], ["path", "dest_path", "cache_dir", "timing_log"])
+
+
+def cmddb_settings(path_base: Path, settings: dict, project: str) -> dict:
+    return resolve_paths(path_base, settings[project]["cmddb"], ["path_bct", "path_cmd_db", "cache_dir", "timing_log"])
+
+
+def sections(settings: dict, kind: str) -> list:
+    return [key for key in settings.keys() if kind in settings[key]]
+
+
+def packet_name(csv_path: Path, settings: dict) -> str:
+    return csv_path.stem.replace(f'{settings["prefix"]}', "")
+
+
+def get_csv_paths(settings: dict) -> list:
+    db_prefix = settings["prefix"]
+    p = Path(settings["path"])
+    p_list = list(p.glob("*.csv"))
+    if db_prefix is not None:
+        p_list = [p for p in p_list if db_prefix in str(p)]
+    return p_list
@@ -0,0 +1,140 @@
+import bisect
+import re
+import threading
+import typing
+
+import pandas as pd
+
+token_pattern = re.compile(r"[0-9a-z_]+")
+
+
+class Hit(typing.NamedTuple):
+    packet: str
+    row: int
+    name: str
+    field: str
+    value: str
+
+
+def status_labels(conv_info: str) -> list:
+    # "0=OFF,1=ON" -> ["OFF", "ON"]
+    return [item.split("=", 1)[1] for item in conv_info.split(",") if "=" in item]
+
+
+def tokenize(value: str) -> set:
+    # セル全体, 英数字と "_" の並び, さらに "_" で区切った語をそれぞれ token にする
+    value = value.lower()
+    tokens = set(token_pattern.findall(value))
+    tokens.update(part for token in list(tokens) for part in token.split("_") if part)
+    if value:
+        tokens.add(value)
+    return tokens
+
+
+class SearchIndex:
+    """全 packet を横断する Name / VarOrFunc / Description / STATUS のラベルの転置インデックス.
+
+    token ごとに (packet, 行, 列) の集合を持ち, 前方一致は整列した token 列の二分探索で, 部分一致は token の走査で引く.
+    packet 単位で入れ替えられるので, 保存された packet だけを更新できる.
+    """
+
+    fields = ["Name", "VarOrFunc", "Description", "ConvInfo"]
+
+    def __init__(self):
+        self._postings: typing.Dict[str, typing.Set[typing.Tuple[str, int, str]]] = {}
+        self._packets: typing.Dict[str, typing.Dict[typing.Tuple[int, str], str]] = {}
+        self._digests: typing.Dict[str, str] = {}
+        self._tokens: typing.Optional[list] = None
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._packets)
+
+    def remove(self, packet: str) -> None:
+        with self._lock:
+            for (row, field), value in self._packets.pop(packet, {}).items():
+                for token in self._field_tokens(field, value):
+                    postings = self._postings.get(token)
+                    if postings is None:
+                        continue
+                    postings.discard((packet, row, field))
+                    if not postings:
+                        del self._postings[token]
+                        self._tokens = None
+            self._digests.pop(packet, None)
+
+    def update(self, packet: str, df: pd.DataFrame, digest: str = "") -> None:
+        entries = {}
+        is_status = (df["ConvType"] == "STATUS").to_numpy() if "ConvType" in df else None
+        for field in self.fields:
+            values = df[field].fillna("").astype(str).to_numpy()
+            for row, value in enumerate(values):
+                if not value or (field == "ConvInfo" and (is_status is None or not is_status[row])):
+                    continue
+                entries[(row, field)] = value
+        with self._lock:
+            self.remove(packet)
+            self._packets[packet] = entries
+            self._digests[packet] = digest
+            for (row, field), value in entries.items():
+                for token in self._field_tokens(field, value):
+                    if token not in self._postings:
+                        self._postings[token] = set()
+                        self._tokens = None
+                    self._postings[token].add((packet, row, field))
+
+    def sync(self, loader: typing.Any) -> None:
+        # CSV の内容が変わった packet だけを読み直す
+        for packet, csv_path in loader.index.items():
+            digest = loader.cache.fingerprint(csv_path)[3]
+            if self._digests.get(packet) == digest:
+                continue
+            try:
+                data = loader.get(packet, copy=False)
+            except Exception:
+                # 読めない packet は検索対象から外す
+                self.remove(packet)
+                continue
+            self.update(packet, data["data"], digest)
+        for packet in set(self._packets) - set(loader.index):
+            self.remove(packet)
+
+    def _field_tokens(self, field: str, value: str) -> set:
+        if field == "ConvInfo":
+            return set().union(*[tokenize(label) for label in status_labels(value)])
+        return tokenize(value)
+
+    def _sorted_tokens(self) -> list:
+        if self._tokens is None:
+            self._tokens = sorted(self._postings)
+        return self._tokens
+
+    def _match(self, term: str, substring: bool) -> typing.Set[typing.Tuple[str, int, str]]:
+        tokens = self._sorted_tokens()
+        if substring:
+            matched = [token for token in tokens if term in token]
+        else:
+            start = bisect.bisect_left(tokens, term)
+            end = bisect.bisect_left(tokens, term + "\uffff")
+            matched = tokens[start:end]
+        return set().union(*[self._postings[token] for token in matched])
+
+    def search(self, query: str, substring: bool = True, limit: int = 100) -> typing.List[Hit]:
+        """空白で区切った語をすべて含む行を返す. substring=False のときは前方一致."""
+        terms = query.lower().split()
+        if not terms:
+            return []
+        with self._lock:
+            rows = None
+            for term in terms:
+                matched = self._match(term, substring)
+                found = {(packet, row) for packet, row, _ in matched}
+                rows = found if rows is None else rows & found
+                if not rows:
+                    return []
+            hits = []
+            for packet, row in sorted(rows)[:limit]:
+                values = {field: self._packets[packet].get((row, field), "") for field in self.fields}
+                field = next((f for f in self.fields if any(term in values[f].lower() for term in terms)), "Name")
+                hits.append(Hit(packet, row, values["Name"], field, values[field]))
+            return hits
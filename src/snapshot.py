@@ -0,0 +1,315 @@
+"""TLM DB の全 packet と CMD_DB / BCT を, 地上系のツールがそのまま読める列指向の snapshot に書き出す.
+
+    python src/snapshot.py [project ...] [--settings FILE] [--out DIR] [--format arrow|parquet|json] [--force] [-j N]
+
+snapshot は DIR の tlm.<ext> / cmd_db.<ext> / bct.<ext>. OctPos / BitPos / Code / Num Params は計算した値で, ConvInfo は "," 区切りに揃える.
+arrow と parquet は packet ごとに 1 つの record batch / row group を書き, packet の索引を metadata の packet_index に持つ.
+arrow (IPC file) は memory map して 1 つの packet だけを copy なしで読める (read_packet). arrow と parquet は pyarrow が必要.
+前回の snapshot から内容の変わった CSV だけを読み直し, 残りの packet は前回の snapshot のものをそのまま使う.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import project
+
+SNAPSHOT_VERSION = 1
+extensions = {"arrow": "arrow", "parquet": "parquet", "json": "json"}
+tlm_header_columns = ["Target", "PacketID", "Enable/Disable", "IsRestricted", "Local Var"]
+tlm_int_columns = {"OctPos": "int32", "BitPos": "int8", "BitLen": "int32"}
+cmd_int_columns = {"Code": "int32", "Num Params": "int8"}
+
+
+def digest_of(content: bytes) -> str:
+    return hashlib.sha1(content).hexdigest()
+
+
+def import_pyarrow(fmt: str) -> typing.Any:
+    try:
+        import pyarrow
+        import pyarrow.ipc  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+    except ImportError:
+        raise RuntimeError(f"--format {fmt} needs pyarrow (pip install pyarrow); --format json works without it") from None
+    return pyarrow
+
+
+# パース (ワーカープロセスで行う)
+
+
+def parse_packet(csv_path: Path, settings: dict, digest: str) -> typing.Tuple[dict, typing.Any]:
+    """1 つの packet の索引の項目と, 全部の列を文字列か整数にした表."""
+    # pandas の import は重いので, 読み直す packet があるときだけ読み込む
+    import tlmdb
+
+    data = tlmdb.extract_data(csv_path, settings)
+    df = data["data"]
+    entry = {column: str(data.get(column, "")) for column in tlm_header_columns}
+    entry.update({"Packet": data["name"], "Source": csv_path.name, "Digest": digest, "Rows": len(df)})
+    entry["Bytes"] = -(-tlmdb.Layout(df["BitLen"]).length // 8)
+    df = df.astype({column: str for column in df.columns if column not in tlm_int_columns})
+    df.insert(0, "Packet", data["name"])
+    return entry, df
+
+
+def parse_table(kind: str, path: Path, allocation: dict) -> typing.Tuple[dict, typing.Any]:
+    """CMD_DB / BCT の表. Code と Num Params は整数にし, コマンドでない行は -1 にする."""
+    import cmddb
+
+    data = cmddb.loaders[kind](path)
+    df = data["data"]
+    if kind == "CMD_DB":
+        df, _ = cmddb.calc_cmd_db(allocation, df.copy())
+        df["Code"] = df["Code"].fillna(-1)
+        df["Num Params"] = df["Num Params"].fillna(-1)
+    df = df.astype({column: cmd_int_columns.get(column, str) for column in df.columns})
+    return {"Source": Path(path).name, "Component": data.get("Component", ""), "Rows": len(df)}, df
+
+
+# 書き出し
+
+
+def to_arrow(pyarrow: typing.Any, df: typing.Any) -> typing.Any:
+    # 空の表でも列の型が変わらないよう, 文字列の列は string 型に決めて変換する
+    types = {column: pyarrow.string() if dtype == object else pyarrow.from_numpy_dtype(dtype) for column, dtype in df.dtypes.items()}
+    schema = pyarrow.schema(list(types.items()))
+    return pyarrow.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+
+class ArrowFormat:
+    """packet ごとに 1 つの record batch の Arrow IPC file. 索引は schema の metadata に持つ."""
+
+    def __init__(self, pyarrow: typing.Any):
+        self.pa = pyarrow
+
+    def read_meta(self, path: Path) -> typing.Optional[dict]:
+        try:
+            with self.pa.memory_map(str(path)) as source:
+                metadata = self.pa.ipc.open_file(source).schema.metadata or {}
+        except (OSError, self.pa.ArrowInvalid):
+            return None
+        return json.loads(metadata[b"snapshot"]) if b"snapshot" in metadata else None
+
+    def previous(self, path: Path) -> typing.Callable[[int], typing.Any]:
+        # 前回の snapshot の i 番目の packet. memory map したものなので読み込みは起きない
+        reader = self.pa.ipc.open_file(self.pa.memory_map(str(path)))
+        return reader.get_batch
+
+    def write(self, path: Path, meta: dict, parts: typing.Iterable[typing.Any]) -> None:
+        writer = None
+        with open(path, "wb") as sink:
+            for part in parts:
+                batch = part if isinstance(part, self.pa.RecordBatch) else to_arrow(self.pa, part).combine_chunks().to_batches()[0]
+                if writer is None:
+                    schema = batch.schema.with_metadata({"snapshot": json.dumps(meta)})
+                    writer = self.pa.ipc.new_file(sink, schema)
+                writer.write_batch(batch)
+            if writer is not None:
+                writer.close()
+            sink.flush()
+            os.fsync(sink.fileno())
+
+
+class ParquetFormat:
+    """packet ごとに 1 つの row group の Parquet. 索引は file の metadata に持つ."""
+
+    def __init__(self, pyarrow: typing.Any):
+        self.pa = pyarrow
+
+    def read_meta(self, path: Path) -> typing.Optional[dict]:
+        try:
+            metadata = self.pa.parquet.read_schema(str(path)).metadata or {}
+        except (OSError, self.pa.ArrowInvalid):
+            return None
+        return json.loads(metadata[b"snapshot"]) if b"snapshot" in metadata else None
+
+    def previous(self, path: Path) -> typing.Callable[[int], typing.Any]:
+        parquet_file = self.pa.parquet.ParquetFile(str(path), memory_map=True)
+        return parquet_file.read_row_group
+
+    def write(self, path: Path, meta: dict, parts: typing.Iterable[typing.Any]) -> None:
+        writer = None
+        try:
+            for part in parts:
+                table = part if isinstance(part, self.pa.Table) else to_arrow(self.pa, part)
+                if writer is None:
+                    writer = self.pa.parquet.ParquetWriter(str(path), table.schema.with_metadata({"snapshot": json.dumps(meta)}))
+                writer.write_table(table, row_group_size=max(len(table), 1))
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+class JsonFormat:
+    """pyarrow のない環境向け. {"snapshot": 索引, "parts": [列名 -> 値の list, ...]}."""
+
+    def read_meta(self, path: Path) -> typing.Optional[dict]:
+        try:
+            with open(path) as f:
+                return json.load(f)["snapshot"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def previous(self, path: Path) -> typing.Callable[[int], typing.Any]:
+        with open(path) as f:
+            return json.load(f)["parts"].__getitem__
+
+    def write(self, path: Path, meta: dict, parts: typing.Iterable[typing.Any]) -> None:
+        columns = [part if isinstance(part, dict) else part.to_dict(orient="list") for part in parts]
+        with open(path, "w") as f:
+            json.dump({"snapshot": meta, "parts": columns}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def make_format(fmt: str) -> typing.Any:
+    if fmt == "json":
+        return JsonFormat()
+    pyarrow = import_pyarrow(fmt)
+    return ArrowFormat(pyarrow) if fmt == "arrow" else ParquetFormat(pyarrow)
+
+
+def write_atomic(writer: typing.Any, path: Path, meta: dict, parts: typing.Iterable[typing.Any]) -> None:
+    # 書き込み途中の snapshot を読ませないよう, 一時ファイルに書いてから置き換える
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    try:
+        writer.write(tmp_path, meta, parts)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if tmp_path.exists():
+            os.unlink(tmp_path)
+        raise
+
+
+def build_tlm(settings: dict, out: Path, fmt: str, force: bool = False, jobs: typing.Optional[int] = None) -> typing.Tuple[int, int, list]:
+    """tlm.<ext> を作り直し, (packet 数, 読み直した packet 数, エラー) を返す. 変更がなければ書かない."""
+    writer = make_format(fmt)
+    path = out / f"tlm.{extensions[fmt]}"
+    csv_paths = sorted(project.get_csv_paths(settings), key=lambda csv_path: project.packet_name(csv_path, settings))
+    digests = {csv_path: digest_of(csv_path.read_bytes()) for csv_path in csv_paths}
+    meta = None if force else writer.read_meta(path)
+    if meta is not None and meta.get("version") != SNAPSHOT_VERSION:
+        meta = None
+    known = {entry["Source"]: (i, entry) for i, entry in enumerate(meta["packet_index"])} if meta else {}
+    stale = [csv_path for csv_path in csv_paths if known.get(csv_path.name, (0, {}))[1].get("Digest") != digests[csv_path]]
+    if meta is not None and not stale and len(known) == len(csv_paths):
+        return len(csv_paths), 0, []
+
+    errors = []
+    parsed = {}
+    if stale:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {csv_path: executor.submit(parse_packet, csv_path, settings, digests[csv_path]) for csv_path in stale}
+            for csv_path, future in futures.items():
+                try:
+                    parsed[csv_path] = future.result()
+                except Exception as e:
+                    errors.append(f"{csv_path.name}: {type(e).__name__}: {e}")
+    previous = writer.previous(path) if meta is not None and len(stale) < len(csv_paths) else None
+
+    index, parts, offset = [], [], 0
+    for csv_path in csv_paths:
+        if csv_path in parsed:
+            entry, part = parsed[csv_path]
+        elif csv_path.name in known and csv_path not in stale:
+            i, entry = known[csv_path.name]
+            part = previous(i)
+        else:
+            continue  # 読めなかった packet は snapshot に含めない
+        index.append({**entry, "Batch": len(parts), "Offset": offset})
+        parts.append(part)
+        offset += entry["Rows"]
+    write_atomic(writer, path, {"version": SNAPSHOT_VERSION, "kind": "tlm", "packet_index": index}, parts)
+    return len(csv_paths), len(stale), errors
+
+
+def build_tables(settings: dict, out: Path, fmt: str, force: bool = False) -> typing.List[str]:
+    """cmd_db.<ext> と bct.<ext> のうち, CSV (CMD_DB は allocation も) が変わったものを作り直し, 作り直したものを返す."""
+    import cmddb
+
+    writer = make_format(fmt)
+    allocation = settings.get("allocation", {})
+    built = []
+    for kind in cmddb.loaders:
+        source = Path(settings[cmddb.path_keys[kind]])
+        path = out / f"{kind.lower()}.{extensions[fmt]}"
+        key = source.read_bytes() + (json.dumps(allocation, sort_keys=True).encode() if kind == "CMD_DB" else b"")
+        digest = digest_of(key)
+        meta = None if force else writer.read_meta(path)
+        if meta is not None and meta.get("version") == SNAPSHOT_VERSION and meta.get("Digest") == digest:
+            continue
+        table_meta, df = parse_table(kind, source, allocation)
+        write_atomic(writer, path, {"version": SNAPSHOT_VERSION, "kind": kind, "Digest": digest, **table_meta}, [df])
+        built.append(kind)
+    return built
+
+
+# 読み込み
+
+
+def read_index(out: Path, fmt: str = "arrow") -> list:
+    """tlm.<ext> の packet の索引 (Packet, PacketID, Batch, Offset, Rows, Bytes, Digest など)."""
+    meta = make_format(fmt).read_meta(Path(out) / f"tlm.{extensions[fmt]}")
+    if meta is None:
+        raise FileNotFoundError(f"no snapshot in {out}")
+    return meta["packet_index"]
+
+
+def read_packet(out: Path, name: str, fmt: str = "arrow") -> typing.Any:
+    """1 つの packet. arrow は memory map した file の record batch (copy なし), parquet はその row group の pyarrow.Table."""
+    entries = {entry["Packet"]: entry for entry in read_index(out, fmt)}
+    if name not in entries:
+        raise KeyError(name)
+    return make_format(fmt).previous(Path(out) / f"tlm.{extensions[fmt]}")(entries[name]["Batch"])
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Write the parsed TLM DB and CMD DB as a columnar snapshot for ground tools.")
+    parser.add_argument("projects", nargs="*", help="project names (default: every [*.tlmdb] and [*.cmddb] section)")
+    parser.add_argument("--settings", type=Path, help="settings toml (default: same lookup as the editors)")
+    parser.add_argument("--out", type=Path, help="output directory (default: snapshot/<project> next to the settings file)")
+    parser.add_argument("--format", choices=list(extensions), default="arrow", help="arrow and parquet need pyarrow")
+    parser.add_argument("--force", action="store_true", help="re-parse every file even if the snapshot is up to date")
+    parser.add_argument("-j", "--jobs", type=int, help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    path_base, settings = project.load_settings(args.settings)
+    tlm_sections = project.sections(settings, "tlmdb")
+    cmd_sections = project.sections(settings, "cmddb")
+    names = args.projects or list(dict.fromkeys(tlm_sections + cmd_sections))
+    unknown = [name for name in names if name not in tlm_sections and name not in cmd_sections]
+    if unknown:
+        parser.error(f"unknown project(s): {', '.join(unknown)} (choose from {', '.join(dict.fromkeys(tlm_sections + cmd_sections))})")
+    if args.out is not None and len(names) > 1:
+        parser.error("--out needs a single project")
+
+    failed = False
+    for name in names:
+        out = args.out or path_base / "snapshot" / name
+        out.mkdir(parents=True, exist_ok=True)
+        start = time.perf_counter()
+        try:
+            if name in tlm_sections:
+                total, parsed, errors = build_tlm(project.tlmdb_settings(path_base, settings, name), out, args.format, args.force, args.jobs)
+                print(f"{name}: tlm {total - len(errors)}/{total} packets ({parsed} re-parsed)")
+                for error in errors:
+                    print(f"  {error}", file=sys.stderr)
+                failed = failed or bool(errors)
+            if name in cmd_sections:
+                built = build_tables(project.cmddb_settings(path_base, settings, name), out, args.format, args.force)
+                print(f"{name}: {', '.join(built) if built else 'CMD_DB and BCT'} {'rebuilt' if built else 'up to date'}")
+        except RuntimeError as e:
+            parser.error(str(e))
+        print(f"{name}: {out} in {time.perf_counter() - start:.2f}s")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
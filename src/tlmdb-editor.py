@@ -1,13 +1,23 @@
-import csv
-import json
+import functools
+import hashlib
 import os
 import sys
+import time
 import typing
-from pathlib import Path
 
-import pandas as pd
 import streamlit as st
-import toml
+
+import dblint
+import dbstore
+import history
+import memory
+import profiling
+import project
+import search
+import tlmdb
+import watcher
+import writer
+from tlmdb import export, save
 
 st.set_page_config(layout="wide")
 st.title("TLM DB")
@@ -23,396 +33,297 @@ button:not([title="View fullscreen"]) {
     unsafe_allow_html=True,
 )
 
-# グローバル変数の定義
-dict_index = {
-    0: "Comment",
-    1: "Name",
-    2: "VarType",
-    3: "VarOrFunc",
-    4: "ExtType",
-    5: "OctPos",
-    6: "BitPos",
-    7: "BitLen",
-    8: "ConvType",
-    9: "a0",
-    10: "a1",
-    11: "a2",
-    12: "a3",
-    13: "a4",
-    14: "a5",
-    15: "ConvInfo",
-    16: "Description",
-    17: "Note",
-}
 
-type2bit = {
-    "int8_t": 8,
-    "int16_t": 16,
-    "int32_t": 32,
-    "uint8_t": 8,
-    "uint16_t": 16,
-    "uint32_t": 32,
-    "float": 32,
-    "double": 64,
-}
+@st.cache_data
+def load_settings():
+    return project.load_settings()
 
-num_start_line = 8
 
+# settings はプロセスの間変わらない (load_settings はキャッシュする) ので, rerun ごとに settings を hash しないよう project 名で引く
+@st.cache_resource
+def get_loader(name: str, _settings: dict) -> tlmdb.PacketLoader:
+    loader = tlmdb.PacketLoader(_settings)
+    loader.prewarm()
+    return loader
 
-def find_settings_file():
-    for parent in [Path(__file__).parents[i] for i in range(4)]:
-        for file_name in ["tlm_cmd_db_editor_config.toml", "settings.toml"]:
-            path = parent / file_name
-            if path.is_file():
-                return path
-    raise FileNotFoundError("settings.toml / tlm_cmd_db_editor_config.toml is not found.")
 
+@st.cache_resource
+def get_store(name: str, _settings: dict) -> dbstore.DBStore:
+    return dbstore.DBStore()
 
-@st.cache_data
-def load_settings():
-    settings_file = find_settings_file()
-    settings = json.loads(json.dumps(toml.load(settings_file)))
-    return settings_file.parent, settings
-
-
-@ st.cache_data
-def extract_data(csv_path: Path, settings: dict):
-    data = {"path": Path(), "name": "", "data": pd.DataFrame()}
-    with open(csv_path, "r", errors="ignore") as csv_file:
-        data["path"] = csv_path
-        data["name"] = csv_path.stem.replace(f'{settings["prefix"]}', "")
-        rows = list(csv.reader(csv_file, delimiter=","))
-        data.update({rows[i][1]: rows[i][2] for i in range(4)})
-        data[rows[0][3]] = rows[1][3]
-        rows = rows[num_start_line:]
-        df = pd.DataFrame([{dict_index[i]: col for i, col in enumerate(row) if i in dict_index}
-                           for row in rows if row[1]])
-
-        bitlen_pre = 0
-        bitlen_pre_init = True
-        for index, row in df.iterrows():
-            index = typing.cast(int, index)
-            if row["VarType"] == "||":
-                if bitlen_pre_init:
-                    df.at[index - 1, "BitLen"] = bitlen_pre
-                    bitlen_pre_init = False
-            else:
-                bitlen_pre, bitlen_pre_init = row["BitLen"], True
-                df.at[index, "BitLen"] = type2bit[row["VarType"]]
-            if row["ConvType"] == "POLY":
-                for i in range(6):
-                    if row[f"a{i}"] == "":
-                        break
-                    df.at[index, "ConvInfo"] += f"a{i}=" + row[f"a{i}"] + ","
-                if df.at[index, "ConvInfo"][-1] == ",":
-                    df.at[index, "ConvInfo"] = df.at[index, "ConvInfo"][:-1]
-
-        df["VarType"] = df["VarType"].astype(
-            pd.CategoricalDtype(["||", "int8_t", "int16_t", "int32_t", "uint8_t",
-                                "uint16_t", "uint32_t", "float", "double"])
-        )
-        df["ExtType"] = df["ExtType"].astype(pd.CategoricalDtype(["PACKET", "TC_FRAME"]))
-        df["BitLen"] = df["BitLen"].astype(int)
-        df["ConvType"] = df["ConvType"].astype(pd.CategoricalDtype(["NONE", "HEX", "POLY", "STATUS"]))
-        df["ConvInfo"] = df["ConvInfo"].str.replace("@@ ", ",").str.replace("@@", ",")
-        data["data"] = df
+
+def build_packet(loader: tlmdb.PacketLoader, name: str) -> dict:
+    # キャッシュのパース結果は extract_data で OctPos/BitPos まで計算済みなので, コピーせずに layout だけ足す
+    data = dict(loader.get(name, copy=False))
+    data["layout"] = tlmdb.Layout(data["data"]["BitLen"].astype(int))
     return data
 
 
-def make_header(df: pd.DataFrame):
-    header = [
-        ["", "Target", df.loc[0, "Target"], "Local Var", "",
-            "", "", "", "", "", "", "", "", "", "", "", "", ""],
-        ["", "PacketID", df.loc[0, "PacketID"], df.loc[0, "Local Var"],
-            "", "", "", "", "", "", "", "", "", "", "", "", "", ""],
-        ["", "Enable/Disable", df.loc[0, "Enable/Disable"], "", "", "", "", "", "", "", "", "", "", "", "", "", "", ""],
-        ["", "IsRestricted", df.loc[0, "IsRestricted"], "", "", "", "", "", "", "", "", "", "", "", "", "", "", ""],
-        ["", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", ""],
-        [
-            "Comment",
-            "TLM Entry",
-            "Onboard Software Info.",
-            "",
-            "Extraction Info.",
-            "",
-            "",
-            "",
-            "Conversion Info.",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "Description",
-            "Note",
-        ],
-        [
-            "",
-            "Name",
-            "Var.%%##Type",
-            "Variable or Function Name",
-            "Ext.%%##Type",
-            "Pos. Desiginator",
-            "",
-            "",
-            "Conv.%%##Type",
-            "Poly (Σa_i * x^i)",
-            "",
-            "",
-            "",
-            "",
-            "",
-            "Status",
-            "",
-            "",
-        ],
-        ["", "", "", "", "", "Octet%%##Pos.", "bit%%##Pos.", "bit%%##Len.",
-            "", "a0", "a1", "a2", "a3", "a4", "a5", "", "", ""],
-    ]
-    return header
-
-
-def export(df: pd.DataFrame, data: dict, settings: dict) -> None:
-    save(df, data, settings)
-    data_to_write = make_header(df)
-    for index, row in data["data"].iterrows():
-        if row["VarType"] == "||":
-            row["VarType"] = ""
-        if row["ConvType"] == "STATUS":
-            status = row["ConvInfo"].replace(",", "@@")
-            a0, a1, a2, a3, a4, a5 = "", "", "", "", "", ""
-        elif row["ConvType"] == "POLY":
-            status = ""
-            params = row["ConvInfo"].split(",")
-            for i in range(6 - len(params)):
-                params.append("")
-            a0, a1, a2, a3, a4, a5 = [param.split("=")[1] if len(param) > 1 else "" for param in params]
-        else:
-            status = ""
-            a0, a1, a2, a3, a4, a5 = "", "", "", "", "", ""
-        data_to_write.append(
-            [
-                row["Comment"],
-                row["Name"],
-                row["VarType"],
-                row["VarOrFunc"],
-                row["ExtType"],
-                row["OctPos"],
-                row["BitPos"],
-                row["BitLen"],
-                row["ConvType"],
-                a0,
-                a1,
-                a2,
-                a3,
-                a4,
-                a5,
-                status,
-                row["Description"],
-                row["Note"],
-            ]
-        )
-    with open(settings["dest_path"] / data["path"].name, mode="w") as csv_file:
-        for row in data_to_write:
-            csv_file.write(",".join(map(str, row)) + "\n")
-
-
-def save(df: pd.DataFrame, data: dict, settings: dict) -> None:
-    data_to_write = make_header(df)
-    for index, row in data["data"].iterrows():
-        if index == 0:
-            data_to_write.append(
-                [
-                    row["Comment"],
-                    row["Name"],
-                    row["VarType"],
-                    row["VarOrFunc"],
-                    row["ExtType"],
-                    "0",
-                    "0",
-                    row["BitLen"],
-                    row["ConvType"],
-                    "",
-                    "",
-                    "",
-                    "",
-                    "",
-                    "",
-                    "",
-                    row["Description"],
-                    row["Note"],
-                ]
-            )
-        else:
-            if row["VarType"] == "||":
-                bitlen = row["BitLen"]
-            elif row["BitLen"] != type2bit[row["VarType"]]:
-                bitlen = row["BitLen"]
-            else:
-                bitlen = """=IF(OR(EXACT(RC[-5]@@"uint8_t")@@EXACT(RC[-5]@@"int8_t"))@@8@@IF(OR(EXACT(RC[-5]@@"uint16_t")@@EXACT(RC[-5]@@"int16_t"))@@16@@IF(OR(EXACT(RC[-5]@@"uint32_t")@@EXACT(RC[-5]@@"int32_t")@@EXACT(RC[-5]@@"float"))@@32@@IF(EXACT(RC[-5]@@"double")@@64))))"""
-
-            if row["ConvType"] == "STATUS":
-                status = row["ConvInfo"].replace(",", "@@ ")
-                a0, a1, a2, a3, a4, a5 = "", "", "", "", "", ""
-            elif row["ConvType"] == "POLY":
-                status = ""
-                params = row["ConvInfo"].split(",")
-                for i in range(6 - len(params)):
-                    params.append("")
-                a0, a1, a2, a3, a4, a5 = [param.split("=")[1] if len(param) > 1 else "" for param in params]
-            else:
-                status = ""
-                a0, a1, a2, a3, a4, a5 = "", "", "", "", "", ""
-
-            data_to_write.append(
-                [
-                    row["Comment"],
-                    row["Name"],
-                    row["VarType"],
-                    row["VarOrFunc"],
-                    row["ExtType"],
-                    "=R[-1]C+INT((R[-1]C[1]+R[-1]C[2])/8)",
-                    "=MOD((R[-1]C+R[-1]C[1])@@8)",
-                    bitlen,
-                    row["ConvType"],
-                    a0,
-                    a1,
-                    a2,
-                    a3,
-                    a4,
-                    a5,
-                    status,
-                    row["Description"],
-                    row["Note"],
-                ]
-            )
-    with open(data["path"], mode="w") as csv_file:
-        for row in data_to_write:
-            csv_file.write(",".join(map(str, row)) + "\n")
+@st.cache_resource
+def get_writer(name: str, _settings: dict) -> writer.WriteBehind:
+    return writer.WriteBehind()
 
 
-@ st.cache_data
-def process_csv_files(settings: dict):
-    csv_path_list = get_csv_paths(settings)
-    return [extract_data(csv_path, settings) for csv_path in csv_path_list]
+def save_packet(df, data: dict, settings: dict, digest: str) -> typing.Optional[str]:
+    # 書き込んだときは, 自分の書き込みを外部の変更と区別するための書き込み後の digest を返す.
+    # 予約してから書くまでの間に CSV が外部で書き換えられていたら (digest でも自分の書き込みでもなければ) 上書きしない.
+    # file_digest() で比べると記録が書き換わって watcher から外部の変更が見えなくなるので, 記録を使わずに比べる
+    if tlmdb.changed_on_disk(data["path"]) and hashlib.sha1(data["path"].read_bytes()).hexdigest() != digest:
+        raise RuntimeError("the file was changed on disk before the auto-save ran")
+    return tlmdb.file_digest(data["path"]) if save(df, data, settings) else None
 
 
-@ st.cache_data
-def get_csv_paths(settings: dict):
-    db_prefix = settings["prefix"]
-    p = Path(settings["path"])
-    p_list = list(p.glob("*.csv"))
-    if db_prefix is not None:
-        p_list = [p for p in p_list if db_prefix in str(p)]
-    return p_list
+def collect_write() -> typing.Optional[writer.WriteResult]:
+    # 予約した自動保存が終わっていれば結果を返し, その digest を base に記録する
+    write = st.session_state.get("tlm_write")
+    if write is None or not write["future"].done():
+        return None
+    del st.session_state["tlm_write"]
+    result = write["future"].result()
+    if result.error is None:
+        # 同じ版の表は次の rerun で保存し直さない
+        st.session_state.tlm_saved = write["token"]
+    base = st.session_state.get("tlm_base")
+    if result.value and base is not None and base["name"] == write["name"]:
+        base["written"] = result.value
+    return result
 
 
-@ st.cache_data
-def calc_data(df: pd.DataFrame) -> pd.DataFrame:
-    cumsum = df["BitLen"].astype(int)[:-1].cumsum().tolist()
-    octpos = [_ // 8 for _ in cumsum]
-    bitpos = [_ % 8 for _ in cumsum]
-    df["OctPos"] = [0] + octpos
-    df["BitPos"] = [0] + bitpos
-    df = df.reindex(
-        columns=["Comment", "Name", "VarType", "VarOrFunc", "ExtType", "OctPos",
-                 "BitPos", "BitLen", "ConvType", "ConvInfo", "Description", "Note"]
-    )
-    return df
+def write_status(name: str, result: typing.Optional[writer.WriteResult]) -> str:
+    if result is None:
+        return f"◐ Saving {name} ..."
+    if result.error:
+        return f"⚠ Failed to save {name}: {result.error}"
+    if result.value:
+        return f"● Modified: saved {name} at {time.strftime('%H:%M:%S', time.localtime(result.finished))} ({result.seconds * 1000:.0f} ms)"
+    return f"○ Clean: {name} is up to date"
 
 
-# メインアプリケーションの実行
+def packet_history(name: str, table) -> history.History:
+    # packet ごとの undo / redo. 前に編集したときの最後の内容と違えば (外部で書き換えられたなど), 履歴は使えないので作り直す
+    histories = st.session_state.setdefault("tlm_history", {})
+    packet = histories.get(name)
+    if packet is None or not packet.matches(table):
+        packet = histories[name] = history.History(table, [column for column in tlmdb.editor_columns if column not in ("OctPos", "BitPos")])
+    return packet
 
 
-path_base, settings = load_settings()
-sections = list(settings.keys())
-sections = [key for key in sections if "tlmdb" in settings[key]]
-selected_project = None
-if "selected_project" not in st.session_state:
-    st.session_state.selected_project = None
-
-if len(sys.argv) > 1 and sys.argv[1] in sections:
-    st.session_state.selected_project = sys.argv[1]
-    selected_project = st.session_state.selected_project
-elif len(sections) == 1:
-    st.session_state.selected_project = sections[0]
-    selected_project = st.session_state.selected_project
-elif st.session_state.selected_project:
-    selected_project = st.session_state.selected_project
-else:
-    selected_project = st.selectbox("Select a project:", sections)
-    if st.button("Select"):
-        st.session_state.selected_project = selected_project
-        st.experimental_rerun()
-    st.stop()
-
-settings = settings[selected_project]["tlmdb"]
-settings["path"] = path_base / settings["path"]
-settings["dest_path"] = path_base / settings["dest_path"]
-
-data = process_csv_files(settings)
-
-option = st.selectbox("TLM NAME", [d["name"] for d in data])
-
-if option:
-    selected_data = next(d for d in data if d["name"] == option)
-
-    selected_columns = ["Target", "PacketID", "Enable/Disable", "IsRestricted", "Local Var"]
-    df = pd.DataFrame({col: [selected_data.get(col, "")] for col in selected_columns})
-    df["Target"] = df["Target"].astype(pd.CategoricalDtype(categories=["OBC"]))
-    df["Enable/Disable"] = df["Enable/Disable"].astype(pd.CategoricalDtype(categories=["ENABLE", "DISABLE"]))
-    df["IsRestricted"] = df["IsRestricted"].astype(pd.CategoricalDtype(categories=["TRUE", "FALSE"]))
-
-    selected_data["data"] = calc_data(selected_data["data"])
-    edited_df = st.data_editor(
-        df,
-        column_config={
-            "Target": st.column_config.Column(width="small"),
-            "PacketID": st.column_config.Column(width="small"),
-            "Enable/Disable": st.column_config.Column(width="small"),
-            "IsRestricted": st.column_config.Column(width="small"),
-        },
-        width=1600,
-        hide_index=True,
-    )
-    col1, col2, col3, col4 = st.columns(4)
-    edited_data = {}
-    edited_data["data"] = st.data_editor(
-        selected_data["data"],
-        num_rows="dynamic",
-        column_config={
-            "Comment": st.column_config.Column(width="small"),
-            "Name": st.column_config.Column(width="medium"),
-            "VarType": st.column_config.Column(width="small"),
-            "VarOrFunc": st.column_config.Column(width="medium"),
-            "ExtType": st.column_config.Column(width="small"),
-            "BitLen": st.column_config.Column(width="small"),
-            "ConvType": st.column_config.Column(width="small"),
-            "ConvInfo": st.column_config.Column(width="medium"),
-            "Description": st.column_config.Column(width="medium"),
-            "Note": st.column_config.Column(width="medium"),
-        },
-        height=1000,
-        width=1600,
-        hide_index=True,
-    )
-    edited_data["path"] = selected_data["path"]
-
-    edited_data["data"] = calc_data(edited_data["data"])
-    save(edited_df, edited_data, settings)
-    if col1.button("Save"):
-        st.cache_data.clear()
-        edited_data["data"] = calc_data(edited_data["data"])
-        save(edited_df, edited_data, settings)
-    if col2.button("Edit on CSV Editor"):
-        os.system("open " + str(selected_data["path"]))
-    if col3.button("Reload"):
-        st.cache_data.clear()
-        st.experimental_rerun()
-    if col4.button("Export"):
-        st.cache_data.clear()
-        edited_data["data"] = calc_data(edited_data["data"])
-        export(edited_df, edited_data, settings)
-        st.experimental_rerun()
+def restore(base: dict, table) -> None:
+    # undo / redo で戻した表を base にし, st.data_editor を新しい key で作り直して編集の差分を空にする
+    layout = tlmdb.Layout(table["BitLen"].astype(int))
+    base["data"] = {**base["data"], "data": tlmdb.calc_data(table, layout), "layout": layout}
+    st.session_state.tlm_generation = st.session_state.get("tlm_generation", 0) + 1
+
+
+@st.cache_resource
+def get_search_index(name: str, _settings: dict) -> search.SearchIndex:
+    return search.SearchIndex()
+
+
+@st.cache_resource
+def get_linter(name: str, _settings: dict) -> dblint.Linter:
+    return dblint.Linter(max_workers=2, processes=False)
+
+
+@st.cache_resource
+def get_watcher(name: str, _settings: dict) -> watcher.FileWatcher:
+    return watcher.FileWatcher([_settings["path"]])
+
+
+# メインアプリケーションの実行
+
+with profiling.rerun("tlm") as (timer, capture):
+    path_base, settings = load_settings()
+    sections = project.sections(settings, "tlmdb")
+    selected_project = None
+    if "selected_project" not in st.session_state:
+        st.session_state.selected_project = None
+
+    if len(sys.argv) > 1 and sys.argv[1] in sections:
+        st.session_state.selected_project = sys.argv[1]
+        selected_project = st.session_state.selected_project
+    elif len(sections) == 1:
+        st.session_state.selected_project = sections[0]
+        selected_project = st.session_state.selected_project
+    elif st.session_state.selected_project:
+        selected_project = st.session_state.selected_project
+    else:
+        selected_project = st.selectbox("Select a project:", sections)
+        if st.button("Select"):
+            st.session_state.selected_project = selected_project
+            st.experimental_rerun()
+        st.stop()
+
+    settings = project.tlmdb_settings(path_base, settings, selected_project)
+
+    with timer.stage("loader"):
+        loader = get_loader(selected_project, settings)
+        store = get_store(selected_project, settings)
+        csv_writer = get_writer(selected_project, settings)
+
+    # 外部で書き換えられた CSV だけを読み直す. save() で自分が書いたものは除く
+    with timer.stage("watch"):
+        # watcher は全 session で共有するので, 変更は session ごとの cursor から後のものを取り出す
+        cursor_key = f"tlm_watch_{selected_project}"
+        st.session_state[cursor_key], changed = get_watcher(selected_project, settings).changes(st.session_state.get(cursor_key))
+        if any(csv_path not in loader.index.values() or not csv_path.exists() for csv_path in changed):
+            loader.refresh()
+        external = sorted(name for name, csv_path in loader.index.items() if csv_path in changed and tlmdb.changed_on_disk(csv_path))
+        loader.prewarm(external)
+    if external:
+        st.info(f"{len(external)} packet(s) changed on disk: {', '.join(external[:10])}" + (" ..." if len(external) > 10 else ""))
+
+    with st.sidebar:
+        query = st.text_input("Search TLM DB", placeholder="Name / VarOrFunc / Description / Status")
+        if query:
+            with timer.stage("search"):
+                index = get_search_index(selected_project, settings)
+                index.sync(loader)
+                hits = index.search(query)
+            st.caption(f"{len(hits)} hits" + (" (first 100)" if len(hits) == 100 else ""))
+            for hit in hits:
+                if st.button(f"{hit.packet} #{hit.row} {hit.name}", help=f"{hit.field}: {hit.value}", key=f"hit_{hit.packet}_{hit.row}"):
+                    st.session_state.tlm_name = hit.packet
+                    st.session_state.search_hit = hit
+                    st.experimental_rerun()
+        with st.expander("Memory"):
+            # 全 packet の str を数えるので重い. 見るときだけ計算する
+            if st.checkbox("Measure", key="tlm_memory"):
+                with timer.stage("memory report"):
+                    frames = loader.frames()
+                    st.caption(f"{len(frames)} of {len(loader.index)} packets loaded, {len(store.versions())} shared by all sessions")
+                    st.dataframe(memory.memory_report(frames, tlmdb.dropped_columns), hide_index=True)
+
+    option = st.selectbox("TLM NAME", loader.names(), key="tlm_name")
+
+    if option:
+        # 編集は読み込んだ時点の内容 (base) に対する差分として st.data_editor が持つので, 自動保存しても base は読み直さない.
+        # base は全 session で共有する snapshot を参照するだけで, session ごとにはコピーしない.
+        # 外部で CSV が書き換えられたら, 編集がなければ読み直し, 編集があれば競合として自動保存を止める
+        editor_key = f"tlm_data_{option}_{st.session_state.get('tlm_generation', 0)}"
+        has_edits = any(st.session_state.get(editor_key, {}).get(k) for k in ["edited_rows", "added_rows", "deleted_rows"])
+        with timer.stage("load packet"):
+            # 自動保存は書き込みを待たずに次へ進むので, 前の rerun の書き込みの結果はここで受け取る
+            written = collect_write()
+            writing = "tlm_write" in st.session_state and st.session_state.tlm_write["name"] == option
+            disk_digest = loader.cache.fingerprint(loader.index[option])[3]
+            base = st.session_state.get("tlm_base")
+            if base is None or base["name"] != option or (disk_digest not in (base["digest"], base["written"]) and not has_edits and not writing):
+                snapshot = store.get(option, disk_digest, lambda: build_packet(loader, option))
+                base = {"name": option, "digest": disk_digest, "written": None, "data": snapshot.data, "version": snapshot.version}
+                st.session_state.tlm_base = base
+                packet_history(option, snapshot.data["data"])
+        selected_data = dict(base["data"])
+        layout = selected_data.pop("layout")
+        # 書き込み中の自分の保存は, 終わるまで外部の変更かどうか分からないので競合にしない
+        conflict = disk_digest not in (base["digest"], base["written"]) and not writing
+        if written is not None and written.error:
+            st.error(f"Failed to save {written.path.name}: {written.error}")
+        if conflict:
+            st.warning(f"{selected_data['path'].name} was changed on disk while it has unsaved edits here. Auto-save is paused.")
+            c1, c2 = st.columns(2)
+            if c1.button("Keep my edits (overwrite the file)"):
+                base["digest"] = disk_digest
+                st.experimental_rerun()
+            if c2.button("Load the file (discard my edits)"):
+                st.session_state.pop(editor_key, None)
+                st.session_state.tlm_base = None
+                st.experimental_rerun()
+
+        df = tlmdb.make_header_frame(selected_data)
+        hit = st.session_state.get("search_hit")
+        if hit is not None and hit.packet == option:
+            st.info(f"Row {hit.row}: {hit.name} ({hit.field}: {hit.value})")
+
+        with timer.stage("data_editor"):
+            edited_df = st.data_editor(
+                df,
+                column_config={
+                    "Target": st.column_config.Column(width="small"),
+                    "PacketID": st.column_config.Column(width="small"),
+                    "Enable/Disable": st.column_config.Column(width="small"),
+                    "IsRestricted": st.column_config.Column(width="small"),
+                },
+                width=1600,
+                hide_index=True,
+            )
+        col1, col2, col3, col4, col5, col6 = st.columns(6)
+        edited_data = {}
+        with timer.stage("data_editor"):
+            edited_data["data"] = st.data_editor(
+                selected_data["data"],
+                num_rows="dynamic",
+                column_config={
+                    "Comment": st.column_config.Column(width="small"),
+                    "Name": st.column_config.Column(width="medium"),
+                    "VarType": st.column_config.Column(width="small"),
+                    "VarOrFunc": st.column_config.Column(width="medium"),
+                    "ExtType": st.column_config.Column(width="small"),
+                    "BitLen": st.column_config.Column(width="small"),
+                    "ConvType": st.column_config.Column(width="small"),
+                    "ConvInfo": st.column_config.Column(width="medium"),
+                    "Description": st.column_config.Column(width="medium"),
+                    "Note": st.column_config.Column(width="medium"),
+                },
+                height=1000,
+                width=1600,
+                hide_index=True,
+                key=editor_key,
+            )
+        edited_data["path"] = selected_data["path"]
+        # 編集後の表の版. 表は base と st.data_editor の編集の状態で決まるので, 表を hash せずに前の rerun と同じかが分かる
+        revision = st.session_state.setdefault("tlm_revisions", dbstore.Revisions()).observe(editor_key, st.session_state.get(editor_key, {}))
+        token = (base["version"], editor_key, revision.number)
+        with timer.stage("history"):
+            packet_changes = st.session_state.get("tlm_history", {}).get(option) or packet_history(option, selected_data["data"])
+            packet_changes.update(edited_data["data"], token, (base["version"], editor_key, revision.previous), revision.rows)
+
+        # 編集後の layout は変更のあった行以降だけ計算する
+        with timer.stage("calc_data"):
+            start = tlmdb.first_changed_row(st.session_state[editor_key], len(layout))
+            edited_layout = layout.updated(edited_data["data"]["BitLen"].astype(int), start)
+            edited_data["data"] = tlmdb.calc_data(edited_data["data"], edited_layout)
+        st.caption(f"Packet length: {edited_layout.length // 8} bytes ({edited_layout.length} bits)")
+        # 保存はバックグラウンドで行い, 同じファイルへの続けての保存は最後のものだけを書く
+        name = selected_data["path"].name
+        # 前の rerun で保存した版から変わっていなければ, CSV を作り直さない. 競合で上書きを選んだときは base の digest が変わるので保存する
+        save_token = (token, tuple(edited_df.astype(str).iloc[0]), base["digest"])
+        pending = st.session_state.get("tlm_write")
+        if not conflict and save_token not in (st.session_state.get("tlm_saved"), pending and pending["token"]):
+            future = csv_writer.submit(selected_data["path"], functools.partial(save_packet, edited_df, edited_data, settings, base["digest"]))
+            st.session_state.tlm_write = {"name": option, "future": future, "token": save_token}
+        # 書き込みは待たない. 結果は次の rerun の collect_write() で受け取り, それまでは書き込み待ち / 書き込み中と表示する
+        last = csv_writer.last.get(selected_data["path"])
+        if conflict:
+            st.caption(f"⚠ Conflict: {name} is not saved")
+        elif csv_writer.busy(selected_data["path"]):
+            st.caption(write_status(name, None))
+        else:
+            st.caption(write_status(name, last) if last is not None else f"○ Clean: {name} is up to date")
+        if col1.button("Save", disabled=conflict):
+            csv_writer.flush([selected_data["path"]])
+        if col2.button("Edit on CSV Editor"):
+            os.system("open " + str(selected_data["path"]))
+        if col3.button("Reload"):
+            loader.refresh()
+            st.experimental_rerun()
+        if col4.button("Export", disabled=conflict):
+            csv_writer.submit(settings["dest_path"] / name, functools.partial(export, edited_df, edited_data, settings, save_source=False))
+        if col5.button(f"Undo ({len(packet_changes.undo_stack)})", disabled=conflict or not packet_changes.undo_stack):
+            restore(base, packet_changes.undo())
+            st.experimental_rerun()
+        if col6.button(f"Redo ({len(packet_changes.redo_stack)})", disabled=conflict or not packet_changes.redo_stack):
+            restore(base, packet_changes.redo())
+            st.experimental_rerun()
+
+    with st.sidebar:
+        rows = csv_writer.rows()
+        with st.expander("Writes", expanded=any(row["Error"] for row in rows)):
+            st.dataframe(rows, hide_index=True, column_config={"ms": st.column_config.NumberColumn(format="%.1f")})
+        with st.expander("Lint"):
+            # 全 packet を検査するので, 見るときだけ実行する. 2 回目からは変わったファイルだけを検査し直す
+            if st.checkbox("Check all packets", key="tlm_lint"):
+                with timer.stage("lint"):
+                    dblint.lint_panel(get_linter(selected_project, settings), dblint.packet_jobs(settings, selected_project))
+
+    profiling.finish_rerun("tlm", timer, capture, settings.get("timing_log"), app="tlmdb", project=selected_project, packet=option)
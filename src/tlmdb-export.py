@@ -0,0 +1,107 @@
+"""TLM DB を Streamlit を使わずにまとめて export する.
+
+    python src/tlmdb-export.py [project ...] [--settings FILE] [--force] [-j N]
+
+各 packet は export 済みのファイルより新しいか, 前回 export したときから内容が変わった場合だけ作り直す.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import project
+
+manifest_name = ".tlmdb-export.json"
+
+
+def file_digest(path: Path) -> str:
+    return hashlib.sha1(path.read_bytes()).hexdigest()
+
+
+def is_up_to_date(csv_path: Path, settings: dict, manifest: dict) -> bool:
+    dest = Path(settings["dest_path"]) / csv_path.name
+    if not dest.exists():
+        return False
+    if csv_path.stat().st_mtime <= dest.stat().st_mtime:
+        return True
+    # git checkout などで mtime だけが新しくなった場合は内容で判定する
+    return manifest.get(csv_path.name) == file_digest(csv_path)
+
+
+def export_packet(csv_path: Path, settings: dict) -> str:
+    # pandas の import は重いので, 作り直す packet があるときだけ読み込む
+    import tlmdb
+
+    digest = file_digest(csv_path)
+    data = tlmdb.extract_data(csv_path, settings)
+    data["data"] = tlmdb.calc_data(data["data"])
+    tlmdb.export(tlmdb.make_header_frame(data), data, settings, save_source=False)
+    return digest
+
+
+def load_manifest(dest_path: Path) -> dict:
+    try:
+        with open(dest_path / manifest_name) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(dest_path: Path, manifest: dict) -> None:
+    tmp_path = dest_path / f"{manifest_name}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, dest_path / manifest_name)
+
+
+def build(settings: dict, force: bool = False, jobs: int = None) -> tuple:
+    dest_path = Path(settings["dest_path"])
+    dest_path.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(dest_path)
+    csv_paths = project.get_csv_paths(settings)
+    stale = [csv_path for csv_path in csv_paths if force or not is_up_to_date(csv_path, settings, manifest)]
+    errors = []
+    if stale:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {csv_path: executor.submit(export_packet, csv_path, settings) for csv_path in stale}
+            for csv_path, future in futures.items():
+                try:
+                    manifest[csv_path.name] = future.result()
+                except Exception as e:
+                    errors.append(f"{csv_path.name}: {type(e).__name__}: {e}")
+        save_manifest(dest_path, manifest)
+    return len(csv_paths), len(stale), errors
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Export every TLM DB packet without the Streamlit UI.")
+    parser.add_argument("projects", nargs="*", help="project sections to export (default: every [*.tlmdb] section)")
+    parser.add_argument("--settings", type=Path, help="settings toml (default: same lookup as the editors)")
+    parser.add_argument("--force", action="store_true", help="export every packet even if it is up to date")
+    parser.add_argument("-j", "--jobs", type=int, help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    path_base, settings = project.load_settings(args.settings)
+    sections = project.sections(settings, "tlmdb")
+    unknown = [name for name in args.projects if name not in sections]
+    if unknown:
+        parser.error(f"unknown project(s): {', '.join(unknown)} (choose from {', '.join(sections)})")
+
+    failed = False
+    for name in args.projects or sections:
+        start = time.perf_counter()
+        total, exported, errors = build(project.tlmdb_settings(path_base, settings, name), force=args.force, jobs=args.jobs)
+        print(f"{name}: exported {exported - len(errors)}/{total} packets in {time.perf_counter() - start:.2f}s")
+        for error in errors:
+            print(f"  {error}", file=sys.stderr)
+        failed = failed or bool(errors)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
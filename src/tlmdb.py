@@ -0,0 +1,475 @@
+import csv
+import functools
+import hashlib
+import itertools
+import os
+import re
+import shutil
+import tempfile
+import threading
+import typing
+from concurrent import futures
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dbcache import FileCache
+from memory import intern_columns
+from project import get_csv_paths, packet_name
+
+# グローバル変数の定義
+dict_index = {
+    0: "Comment",
+    1: "Name",
+    2: "VarType",
+    3: "VarOrFunc",
+    4: "ExtType",
+    5: "OctPos",
+    6: "BitPos",
+    7: "BitLen",
+    8: "ConvType",
+    9: "a0",
+    10: "a1",
+    11: "a2",
+    12: "a3",
+    13: "a4",
+    14: "a5",
+    15: "ConvInfo",
+    16: "Description",
+    17: "Note",
+}
+
+type2bit = {
+    "int8_t": 8,
+    "int16_t": 16,
+    "int32_t": 32,
+    "uint8_t": 8,
+    "uint16_t": 16,
+    "uint32_t": 32,
+    "float": 32,
+    "double": 64,
+}
+
+num_start_line = 8
+
+poly_columns = [f"a{i}" for i in range(6)]
+# パース後の表に持たない CSV の列と, その値を畳み込んだ列
+dropped_columns = {col: "ConvInfo" for col in poly_columns}
+
+var_type_dtype = pd.CategoricalDtype(["||", "int8_t", "int16_t", "int32_t", "uint8_t", "uint16_t", "uint32_t", "float", "double"])
+ext_type_dtype = pd.CategoricalDtype(["PACKET", "TC_FRAME"])
+conv_type_dtype = pd.CategoricalDtype(["NONE", "HEX", "POLY", "STATUS"])
+editor_columns = ["Comment", "Name", "VarType", "VarOrFunc", "ExtType", "OctPos", "BitPos", "BitLen", "ConvType", "ConvInfo", "Description", "Note"]
+# 同じ値が多い文字列の列
+interned_columns = ["Comment", "VarOrFunc", "ConvInfo", "Description", "Note"]
+
+
+def read_rows(csv_path: Path) -> list:
+    with open(csv_path, "r", errors="ignore") as csv_file:
+        return list(csv.reader(csv_file, delimiter=","))
+
+
+def make_table(rows: list) -> pd.DataFrame:
+    # 列数の足りない行は空文字で埋め, Name が空の行は読み飛ばす
+    width = len(dict_index)
+    records = [(row + [""] * (width - len(row)))[:width] for row in rows if len(row) > 1 and row[1]]
+    return pd.DataFrame(records, columns=list(dict_index.values()))
+
+
+def fold_bitlen(df: pd.DataFrame) -> pd.Series:
+    # 通常の行は VarType から BitLen を決める.
+    # "||" の行とその直前の行 (bitfield の先頭) は CSV に書かれた BitLen をそのまま使う.
+    is_cont = df["VarType"] == "||"
+    is_head = ~is_cont & is_cont.shift(-1, fill_value=False)
+    bitlen = df["VarType"].map(type2bit)
+    unknown = ~is_cont & bitlen.isna()
+    if unknown.any():
+        raise KeyError(df.loc[unknown, "VarType"].iloc[0])
+    return bitlen.where(~(is_cont | is_head), df["BitLen"]).astype(int)
+
+
+def fold_conv_info(df: pd.DataFrame) -> pd.Series:
+    # POLY は a0..a5 を最初の空欄まで "a0=..,a1=.." の形で ConvInfo に畳み込む
+    coeffs = df[poly_columns]
+    present = (coeffs != "").cumprod(axis=1).astype(bool)
+    poly = pd.Series("", index=df.index, dtype=object)
+    for col in poly_columns:
+        poly += (f"{col}=" + coeffs[col] + ",").where(present[col], "")
+    is_poly = df["ConvType"] == "POLY"
+    conv_info = df["ConvInfo"].where(~is_poly, (df["ConvInfo"] + poly).str.replace(",$", "", regex=True))
+    # STATUS の "@@" 区切りは "," に揃える
+    return conv_info.str.replace("@@ ", ",", regex=False).str.replace("@@", ",", regex=False)
+
+
+def extract_data(csv_path: Path, settings: dict) -> dict:
+    data = {"path": csv_path, "name": packet_name(csv_path, settings), "data": pd.DataFrame()}
+    rows = read_rows(csv_path)
+    data.update({rows[i][1]: rows[i][2] for i in range(4)})
+    data[rows[0][3]] = rows[1][3]
+
+    df = make_table(rows[num_start_line:])
+    df["BitLen"] = fold_bitlen(df)
+    df["ConvInfo"] = fold_conv_info(df)
+    df["VarType"] = df["VarType"].astype(var_type_dtype)
+    df["ExtType"] = df["ExtType"].astype(ext_type_dtype)
+    df["ConvType"] = df["ConvType"].astype(conv_type_dtype)
+    data["data"] = compact(df)
+    return data
+
+
+def compact(df: pd.DataFrame) -> pd.DataFrame:
+    # a0..a5 は ConvInfo に畳み込み済みなので持たない.
+    # CSV の OctPos/BitPos は Excel の数式の文字列なので, BitLen から求めた整数にする
+    df = df.reindex(columns=editor_columns)
+    df["BitLen"] = df["BitLen"].astype(np.int32)
+    df = calc_data(df)
+    return intern_columns(df, interned_columns)
+
+
+class Layout:
+    """BitLen の累積和 (各行の先頭の bit 位置) と packet 長を持つ.
+
+    updated() は start 行より前が変わっていないものとして, start 行以降の累積和だけを計算し直す.
+    """
+
+    def __init__(self, bitlen: typing.Iterable[int]):
+        self.bitlen = np.asarray(bitlen, dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.bitlen)))
+
+    def __len__(self) -> int:
+        return len(self.bitlen)
+
+    @property
+    def length(self) -> int:
+        return int(self.offsets[-1])
+
+    def updated(self, bitlen: typing.Iterable[int], start: int) -> "Layout":
+        layout = Layout.__new__(Layout)
+        layout.bitlen = np.asarray(bitlen, dtype=np.int64)
+        start = min(start, len(self), len(layout))
+        layout.offsets = np.empty(len(layout) + 1, dtype=np.int64)
+        layout.offsets[: start + 1] = self.offsets[: start + 1]
+        layout.offsets[start + 1 :] = self.offsets[start] + np.cumsum(layout.bitlen[start:])
+        return layout
+
+
+def first_changed_row(editor_state: dict, num_rows: int) -> int:
+    # st.data_editor の編集状態から, BitLen が変わりうる最初の行を求める. 追加行は末尾に付く
+    rows = [int(i) for i, cells in editor_state.get("edited_rows", {}).items() if "BitLen" in cells]
+    rows += [int(i) for i in editor_state.get("deleted_rows", [])]
+    if editor_state.get("added_rows"):
+        rows.append(num_rows)
+    return min(rows, default=num_rows)
+
+
+def calc_data(df: pd.DataFrame, layout: typing.Optional[Layout] = None) -> pd.DataFrame:
+    if layout is None:
+        layout = Layout(df["BitLen"].astype(int))
+    df["OctPos"] = (layout.offsets[:-1] // 8).astype(np.int32)
+    df["BitPos"] = (layout.offsets[:-1] % 8).astype(np.int8)
+    return df.reindex(columns=editor_columns)
+
+
+def make_header_frame(data: dict) -> pd.DataFrame:
+    selected_columns = ["Target", "PacketID", "Enable/Disable", "IsRestricted", "Local Var"]
+    df = pd.DataFrame({col: [data.get(col, "")] for col in selected_columns})
+    df["Target"] = df["Target"].astype(pd.CategoricalDtype(categories=["OBC"]))
+    df["Enable/Disable"] = df["Enable/Disable"].astype(pd.CategoricalDtype(categories=["ENABLE", "DISABLE"]))
+    df["IsRestricted"] = df["IsRestricted"].astype(pd.CategoricalDtype(categories=["TRUE", "FALSE"]))
+    return df
+
+
+def make_header(df: pd.DataFrame) -> list:
+    header = [
+        ["", "Target", df.loc[0, "Target"], "Local Var", "", "", "", "", "", "", "", "", "", "", "", "", "", ""],
+        ["", "PacketID", df.loc[0, "PacketID"], df.loc[0, "Local Var"], "", "", "", "", "", "", "", "", "", "", "", "", "", ""],
+        ["", "Enable/Disable", df.loc[0, "Enable/Disable"], "", "", "", "", "", "", "", "", "", "", "", "", "", "", ""],
+        ["", "IsRestricted", df.loc[0, "IsRestricted"], "", "", "", "", "", "", "", "", "", "", "", "", "", "", ""],
+        ["", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", "", ""],
+        [
+            "Comment",
+            "TLM Entry",
+            "Onboard Software Info.",
+            "",
+            "Extraction Info.",
+            "",
+            "",
+            "",
+            "Conversion Info.",
+            "",
+            "",
+            "",
+            "",
+            "",
+            "",
+            "",
+            "Description",
+            "Note",
+        ],
+        [
+            "",
+            "Name",
+            "Var.%%##Type",
+            "Variable or Function Name",
+            "Ext.%%##Type",
+            "Pos. Desiginator",
+            "",
+            "",
+            "Conv.%%##Type",
+            "Poly (Σa_i * x^i)",
+            "",
+            "",
+            "",
+            "",
+            "",
+            "Status",
+            "",
+            "",
+        ],
+        ["", "", "", "", "", "Octet%%##Pos.", "bit%%##Pos.", "bit%%##Len.", "", "a0", "a1", "a2", "a3", "a4", "a5", "", "", ""],
+    ]
+    return header
+
+
+bitlen_formula = """=IF(OR(EXACT(RC[-5]@@"uint8_t")@@EXACT(RC[-5]@@"int8_t"))@@8@@IF(OR(EXACT(RC[-5]@@"uint16_t")@@EXACT(RC[-5]@@"int16_t"))@@16@@IF(OR(EXACT(RC[-5]@@"uint32_t")@@EXACT(RC[-5]@@"int32_t")@@EXACT(RC[-5]@@"float"))@@32@@IF(EXACT(RC[-5]@@"double")@@64))))"""
+octpos_formula = "=R[-1]C+INT((R[-1]C[1]+R[-1]C[2])/8)"
+bitpos_formula = "=MOD((R[-1]C+R[-1]C[1])@@8)"
+
+
+def to_str(s: pd.Series) -> np.ndarray:
+    return s.astype(object).astype(str).to_numpy(dtype=object)
+
+
+def quote_field(field: str) -> str:
+    # 区切り文字や改行を含むセルと '"' で始まるセルだけを RFC 4180 に従って囲む.
+    # Excel の数式セルは途中に '"' を含むが, 囲まなくても csv.reader でそのまま読めるので既存の CSV と同じ出力になる
+    if any(c in field for c in ",\r\n") or field.startswith('"'):
+        return '"' + field.replace('"', '""') + '"'
+    return field
+
+
+def render_rows(rows: list) -> str:
+    return "".join(",".join(quote_field(str(col)) for col in row) + "\n" for row in rows)
+
+
+cell_sep = "\x1f"
+line_sep = "\x1e"
+needs_quote = re.compile(f'[,\r\n]|^"|[{cell_sep}{line_sep}]"')
+
+
+def render_table(columns: list, num_rows: int) -> str:
+    # 列単位の配列 (定数列は str) を行ごとに一度に連結し, 囲む必要のあるセルがある行だけを組み直す
+    if num_rows == 0:
+        return ""
+    cells = [itertools.repeat(col, num_rows) if isinstance(col, str) else col for col in columns]
+    lines = list(map(cell_sep.join, zip(*cells)))
+    body = line_sep.join(lines)
+    if needs_quote.search(body):
+        body = line_sep.join(cell_sep.join(map(quote_field, line.split(cell_sep))) if needs_quote.search(line) else line for line in lines)
+    return (body + line_sep).replace(line_sep, "\n").replace(cell_sep, ",")
+
+
+def poly_coeffs(conv_info: str) -> list:
+    # "a0=1,a1=2" -> ["1", "2", "", "", "", ""]
+    params = (conv_info.split(",") + [""] * 6)[:6]
+    return [param.split("=")[1] if len(param) > 1 and "=" in param else "" for param in params]
+
+
+def expand_conv_info(df: pd.DataFrame, status_sep: str) -> typing.Tuple[np.ndarray, np.ndarray]:
+    # ConvInfo を POLY は a0..a5 の係数に, STATUS は status_sep 区切りの文字列に戻す
+    conv_info = df["ConvInfo"].fillna("").astype(str).to_numpy(dtype=object)
+    conv_type = df["ConvType"].astype(object).to_numpy()
+    is_status = conv_type == "STATUS"
+    is_poly = conv_type == "POLY"
+    status = np.full(len(df), "", dtype=object)
+    status[is_status] = [info.replace(",", status_sep) for info in conv_info[is_status]]
+    coeffs = np.full((6, len(df)), "", dtype=object)
+    if is_poly.any():
+        coeffs[:, is_poly] = np.array([poly_coeffs(info) for info in conv_info[is_poly]], dtype=object).T
+    return coeffs, status
+
+
+def export(df: pd.DataFrame, data: dict, settings: dict, save_source: bool = True) -> bool:
+    if save_source:
+        save(df, data, settings)
+    tlm = data["data"]
+    coeffs, status = expand_conv_info(tlm, "@@")
+    var_type = to_str(tlm["VarType"])
+    var_type[var_type == "||"] = ""
+    columns = [
+        to_str(tlm["Comment"]),
+        to_str(tlm["Name"]),
+        var_type,
+        to_str(tlm["VarOrFunc"]),
+        to_str(tlm["ExtType"]),
+        to_str(tlm["OctPos"]),
+        to_str(tlm["BitPos"]),
+        to_str(tlm["BitLen"]),
+        to_str(tlm["ConvType"]),
+        *coeffs,
+        status,
+        to_str(tlm["Description"]),
+        to_str(tlm["Note"]),
+    ]
+    content = render_rows(make_header(df)) + render_table(columns, len(tlm))
+    return write_if_changed(settings["dest_path"] / data["path"].name, content.encode("utf-8"))
+
+
+def render_source(df: pd.DataFrame, data: dict) -> bytes:
+    # 編集用の CSV (save で書く内容). df はヘッダの表
+    tlm = data["data"]
+    # 先頭行の位置は 0 固定で, それ以降の OctPos/BitPos は Excel の R1C1 形式の数式で書く
+    is_first = tlm.index.to_numpy() == 0
+    coeffs, status = expand_conv_info(tlm, "@@ ")
+    coeffs[:, is_first] = ""
+    status[is_first] = ""
+    # VarType から決まる BitLen は数式で, bitfield など明示された BitLen は値で書く
+    var_type = tlm["VarType"].astype(object)
+    is_explicit = ((var_type == "||") | (tlm["BitLen"] != var_type.map(type2bit))).to_numpy()
+    bitlen = np.where(is_explicit | is_first, to_str(tlm["BitLen"]), bitlen_formula)
+    columns = [
+        to_str(tlm["Comment"]),
+        to_str(tlm["Name"]),
+        to_str(tlm["VarType"]),
+        to_str(tlm["VarOrFunc"]),
+        to_str(tlm["ExtType"]),
+        np.where(is_first, "0", octpos_formula).astype(object),
+        np.where(is_first, "0", bitpos_formula).astype(object),
+        bitlen,
+        to_str(tlm["ConvType"]),
+        *coeffs,
+        status,
+        to_str(tlm["Description"]),
+        to_str(tlm["Note"]),
+    ]
+    content = render_rows(make_header(df)) + render_table(columns, len(tlm))
+    return content.encode("utf-8")
+
+
+def save(df: pd.DataFrame, data: dict, settings: dict) -> bool:
+    return write_if_changed(data["path"], render_source(df, data))
+
+
+def write_temp(path: Path, content: bytes) -> str:
+    """path と同じディレクトリの一時ファイルに content を書き, そのファイル名を返す. 権限は path に揃える."""
+    path = Path(path)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if path.exists():
+            shutil.copymode(path, tmp_name)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_name, 0o666 & ~umask)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+    return tmp_name
+
+
+def atomic_write(path: Path, content: bytes) -> None:
+    # 同じディレクトリの一時ファイルに書いてから置き換えるので, 書き込み途中の CSV が残らない
+    tmp_name = write_temp(path, content)
+    try:
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+_written: typing.Dict[str, typing.Tuple[int, int, str]] = {}
+
+
+def file_digest(path: Path) -> typing.Optional[str]:
+    path = Path(path)
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    known = _written.get(str(path))
+    if known is None or known[:2] != (stat.st_mtime_ns, stat.st_size):
+        known = (stat.st_mtime_ns, stat.st_size, hashlib.sha1(path.read_bytes()).hexdigest())
+        _written[str(path)] = known
+    return known[2]
+
+
+def changed_on_disk(path: Path) -> bool:
+    """最後に file_digest() で見た / write_if_changed() で書いた後に, ほかのプログラムが path を書き換えたか."""
+    known = _written.get(str(path))
+    try:
+        stat = Path(path).stat()
+    except FileNotFoundError:
+        return known is not None
+    return known is None or known[:2] != (stat.st_mtime_ns, stat.st_size)
+
+
+def write_if_changed(path: Path, content: bytes) -> bool:
+    """内容が変わったときだけ書き込む. 書き込んだら True を返す."""
+    digest = hashlib.sha1(content).hexdigest()
+    if file_digest(path) == digest:
+        return False
+    atomic_write(path, content)
+    stat = Path(path).stat()
+    _written[str(path)] = (stat.st_mtime_ns, stat.st_size, digest)
+    return True
+
+
+def process_csv_files(settings: dict) -> list:
+    return [extract_data(csv_path, settings) for csv_path in get_csv_paths(settings)]
+
+
+class PacketLoader:
+    """ファイル名だけで TLM の一覧を作り, 各 packet の CSV は必要になった時点で読む.
+
+    パース結果はファイル単位の FileCache に持ち, 変更のあった CSV だけを読み直す.
+    prewarm() を呼ぶと残りの packet をバックグラウンドのスレッドで先読みする.
+    """
+
+    def __init__(self, settings: dict, max_workers: typing.Optional[int] = None, maxsize: int = 512):
+        self.settings = settings
+        self.cache = FileCache(
+            functools.partial(extract_data, settings=settings),
+            maxsize=maxsize,
+            cache_dir=settings.get("cache_dir"),
+            namespace=f'tlmdb:{settings["prefix"]}',
+        )
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tlmdb-loader")
+        self._futures: typing.Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self) -> None:
+        self.index = {packet_name(csv_path, self.settings): csv_path for csv_path in get_csv_paths(self.settings)}
+
+    def names(self) -> list:
+        return list(self.index)
+
+    def prewarm(self, names: typing.Optional[typing.Iterable[str]] = None) -> None:
+        with self._lock:
+            for name in self.index if names is None else names:
+                if name not in self._futures or self._futures[name].done():
+                    self._futures[name] = self._executor.submit(self.cache.warm, self.index[name])
+
+    def get(self, name: str, copy: bool = True) -> dict:
+        """copy=False のときはキャッシュそのものを返すので, 書き換えてはいけない."""
+        with self._lock:
+            future = self._futures.pop(name, None)
+        if future is not None and not future.cancel():
+            # 先読み中の packet はそれが終わるのを待つ. 順番待ちのものは取り消してこのスレッドで読む
+            futures.wait([future])
+        csv_path = self.index[name]
+        return self.cache.get(csv_path) if copy else self.cache.warm(csv_path)
+
+    def frames(self) -> typing.Dict[str, pd.DataFrame]:
+        # 読み込み済みの packet の表. メモリ使用量の表示用
+        names = {str(csv_path): name for name, csv_path in self.index.items()}
+        return {names[key]: data["data"] for key, data in self.cache.items() if key in names}
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,142 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import typing
+from pathlib import Path
+
+# <sys/inotify.h>
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+event_header = struct.Struct("iIII")
+watch_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class FileWatcher:
+    """ディレクトリ内の CSV と個別のファイルの変更をバックグラウンドのスレッドで集める.
+
+    Linux では inotify を使い, 使えない環境では interval 秒ごとに (mtime, size) を比べるポーリングにする.
+    os.replace で書き換えられても追えるように, ファイルはそれがあるディレクトリごと監視する.
+    変更には通し番号を振り, 各パスの最後の変更の番号を持つ. 複数の session で共有するので, 取り出しても消さない.
+    呼び出し側は自分の cursor (前回の changes() が返した番号) を持ち, changes(cursor) でそれより後の変更を取り出す.
+    自分で書いたファイルも含まれるので, 区別は呼び出し側で内容を見て行う.
+    """
+
+    def __init__(self, paths: typing.Iterable[Path], pattern: str = "*.csv", interval: float = 1.0, use_inotify: bool = True):
+        # ディレクトリは pattern に合うファイルを, ファイルはそれ自身だけを監視する
+        self._targets: typing.Dict[Path, typing.Optional[typing.Set[str]]] = {}
+        for path in map(Path, paths):
+            if path.is_dir():
+                self._targets[path] = None
+            else:
+                names = self._targets.setdefault(path.parent, set())
+                if names is not None:
+                    names.add(path.name)
+        self.pattern = pattern
+        self.interval = interval
+        self._changed: typing.Dict[Path, int] = {}
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._fd = self._init_inotify() if use_inotify else None
+        self.backend = "inotify" if self._fd is not None else "polling"
+        self._stats = self._scan() if self._fd is None else {}
+        self._thread = threading.Thread(target=self._run_inotify if self._fd is not None else self._run_polling, daemon=True, name="file-watcher")
+        self._thread.start()
+
+    def _matches(self, directory: Path, name: str) -> bool:
+        names = self._targets.get(directory)
+        return Path(name).match(self.pattern) if names is None else name in names
+
+    def _init_inotify(self) -> typing.Optional[int]:
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        self._watches: typing.Dict[int, Path] = {}
+        for directory in self._targets:
+            wd = libc.inotify_add_watch(fd, os.fsencode(directory), watch_mask)
+            if wd < 0:
+                # 監視数の上限などで追加できなければポーリングにする
+                os.close(fd)
+                return None
+            self._watches[wd] = directory
+        return fd
+
+    def _run_inotify(self) -> None:
+        while not self._closed.is_set():
+            readable, _, _ = select.select([self._fd], [], [], self.interval)
+            if not readable:
+                continue
+            try:
+                buffer = os.read(self._fd, 65536)
+            except BlockingIOError:
+                continue
+            except OSError:
+                break
+            changed = set()
+            offset = 0
+            while offset < len(buffer):
+                wd, _, _, length = event_header.unpack_from(buffer, offset)
+                name = os.fsdecode(buffer[offset + event_header.size : offset + event_header.size + length].rstrip(b"\0"))
+                offset += event_header.size + length
+                directory = self._watches.get(wd)
+                if directory is not None and name and self._matches(directory, name):
+                    changed.add(directory / name)
+            self._record(changed)
+
+    def _scan(self) -> typing.Dict[Path, typing.Tuple[int, int]]:
+        stats = {}
+        for directory, names in self._targets.items():
+            paths = directory.glob(self.pattern) if names is None else (directory / name for name in names)
+            for path in paths:
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                stats[path] = (stat.st_mtime_ns, stat.st_size)
+        return stats
+
+    def _run_polling(self) -> None:
+        while not self._closed.wait(self.interval):
+            stats = self._scan()
+            changed = {path for path in stats.keys() | self._stats.keys() if stats.get(path) != self._stats.get(path)}
+            self._stats = stats
+            self._record(changed)
+
+    def _record(self, changed: typing.Set[Path]) -> None:
+        if not changed:
+            return
+        with self._lock:
+            self._sequence += 1
+            for path in changed:
+                self._changed[path] = self._sequence
+
+    def changes(self, cursor: typing.Optional[int] = None) -> typing.Tuple[int, typing.Set[Path]]:
+        """cursor より後に変更 (作成・削除を含む) のあったパスと, 次に渡す cursor を返す. cursor が None なら今の cursor だけを返す."""
+        with self._lock:
+            if cursor is None:
+                return self._sequence, set()
+            return self._sequence, {path for path, sequence in self._changed.items() if sequence > cursor}
+
+    def close(self) -> None:
+        self._closed.set()
+        self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
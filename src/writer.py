@@ -0,0 +1,136 @@
+import atexit
+import threading
+import time
+import typing
+from concurrent.futures import Future
+from pathlib import Path
+
+
+class WriteResult(typing.NamedTuple):
+    path: Path
+    value: typing.Any  # write() の戻り値
+    seconds: float
+    error: typing.Optional[str]
+    finished: float  # time.time()
+
+
+class _Job(typing.NamedTuple):
+    write: typing.Callable[[], typing.Any]
+    futures: typing.List[Future]
+    due: float
+
+
+class WriteBehind:
+    """ファイルの書き込みをバックグラウンドのスレッドで行う.
+
+    同じパスへの書き込みが delay 秒以内に続いたら, 最後のものだけを書く (途中のものの Future も同じ結果になる).
+    flush() で待っている書き込みと書き込み中のものをすぐに行い, ディスクに書き終わるまで待つ. プロセスの終了時にも flush する.
+    書き込みは 1 つのスレッドで順に行うので, 同じファイルを並行して書くことはない.
+    """
+
+    def __init__(self, delay: float = 0.3):
+        self.delay = delay
+        self.last: typing.Dict[Path, WriteResult] = {}
+        self._pending: typing.Dict[Path, _Job] = {}
+        # スレッドが書き込み中のもの. _pending からは取り出し済みなので, flush() はこちらも待つ
+        self._running: typing.Optional[typing.Tuple[Path, _Job]] = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True, name="write-behind")
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, path: Path, write: typing.Callable[[], typing.Any]) -> Future:
+        """path への書き込み write() を予約する. Future は WriteResult になる."""
+        path = Path(path)
+        future: Future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("write-behind queue is closed")
+            job = self._pending.get(path)
+            futures = (job.futures if job else []) + [future]
+            self._pending[path] = _Job(write, futures, job.due if job else time.monotonic() + self.delay)
+            self._cond.notify()
+        return future
+
+    def flush(self, paths: typing.Optional[typing.Iterable[Path]] = None, timeout: typing.Optional[float] = None) -> typing.List[WriteResult]:
+        """paths (None なら全部) の待っている書き込みをすぐに行い, 書き込み中のものと合わせてその結果を返す."""
+        with self._cond:
+            keys = list(self._pending) if paths is None else [Path(path) for path in paths if Path(path) in self._pending]
+            futures = []
+            if self._running is not None and (paths is None or self._running[0] in {Path(path) for path in paths}):
+                futures.append(self._running[1].futures[-1])
+            for key in keys:
+                job = self._pending[key]
+                self._pending[key] = job._replace(due=0.0)
+                futures.append(job.futures[-1])
+            self._cond.notify()
+        return [future.result(timeout) for future in futures]
+
+    def _next(self) -> typing.Optional[typing.Tuple[Path, _Job]]:
+        with self._cond:
+            while True:
+                if self._pending:
+                    path, job = min(self._pending.items(), key=lambda item: item[1].due)
+                    wait = job.due - time.monotonic()
+                    if wait <= 0:
+                        del self._pending[path]
+                        self._running = (path, job)
+                        return path, job
+                elif self._closed:
+                    return None
+                else:
+                    wait = None
+                self._cond.wait(wait)
+
+    def _run(self) -> None:
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            path, job = item
+            start = time.perf_counter()
+            value, error = None, None
+            try:
+                value = job.write()
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            result = WriteResult(path, value, time.perf_counter() - start, error, time.time())
+            with self._cond:
+                # 書き終わってから外すので, flush() が書き込み中のものを見落とすことはない
+                self.last[path] = result
+                self._running = None
+            for future in job.futures:
+                future.set_result(result)
+
+    def busy(self, path: Path) -> bool:
+        """path への書き込みを待っているか, 書き込み中か."""
+        path = Path(path)
+        with self._cond:
+            return path in self._pending or (self._running is not None and self._running[0] == path)
+
+    def rows(self) -> list:
+        # 表示用の, パスごとの直近の書き込み
+        with self._cond:
+            results = sorted(self.last.values(), key=lambda result: result.finished, reverse=True)
+            queued = len(self._pending) + (self._running is not None)
+        rows = [
+            {
+                "File": f"{result.path.parent.name}/{result.path.name}",
+                "At": time.strftime("%H:%M:%S", time.localtime(result.finished)),
+                "ms": result.seconds * 1000,
+                "Error": result.error or "",
+            }
+            for result in results
+        ]
+        return rows + [{"File": f"({queued} queued or writing)", "At": "", "ms": None, "Error": ""}] if queued else rows
+
+    def close(self) -> None:
+        with self._cond:
+            if self._closed:
+                return
+            for path, job in self._pending.items():
+                self._pending[path] = job._replace(due=0.0)
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
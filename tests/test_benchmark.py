@@ -0,0 +1,58 @@
+import json
+from pathlib import Path
+
+import benchmark
+
+# 数秒で終わる規模
+small = ["--packets", "4", "--rows", "20", "60", "--commands", "100", "--repeat", "1"]
+
+
+def test_runs_every_stage() -> None:
+    results = benchmark.run(4, (20, 60), 100, repeat=1)
+    assert list(results) == [
+        "tlm.process_csv_files",
+        "tlm.extract_data",
+        "tlm.calc_data",
+        "tlm.save",
+        "tlm.export",
+        "cmd.process_csv_files",
+        "cmd.calc_cmd_db",
+    ]
+    for result in results.values():
+        assert result["rows"] > 0 and result["seconds"] > 0 and result["peak_mb"] >= 0
+
+
+def test_gate_fails_on_regression(tmp_path: Path) -> None:
+    baseline = tmp_path / "baseline.json"
+    assert benchmark.main(small + ["--baseline", str(baseline), "--save-baseline"]) == 0
+    saved = json.loads(baseline.read_text())
+    assert list(saved) == ["4x20-60/100"]
+    # baseline を 100 倍速く書き換えると, 同じ規模で測り直したときに失敗する
+    for result in saved["4x20-60/100"].values():
+        result["seconds"] /= 100
+        result["peak_mb"] /= 100
+    baseline.write_text(json.dumps(saved))
+    assert benchmark.main(small + ["--baseline", str(baseline)]) == 1
+
+
+def test_compare() -> None:
+    base = {"stage": {"seconds": 1.0, "peak_mb": 10.0}}
+    assert benchmark.compare({"stage": {"seconds": 1.2, "peak_mb": 12.0}}, base, 0.3) == []
+    assert len(benchmark.compare({"stage": {"seconds": 1.5, "peak_mb": 14.0}}, base, 0.3)) == 2
+    # noise_seconds より小さい差は無視する
+    assert benchmark.compare({"stage": {"seconds": 0.04, "peak_mb": 0}}, {"stage": {"seconds": 0.001, "peak_mb": 0}}, 0.3) == []
+
+
+def test_committed_baseline_covers_the_default_scale() -> None:
+    # 既定の規模の baseline がないと rye run bench は比べずに終わってしまう
+    baselines = json.loads(benchmark.baseline_file.read_text())
+    stages = baselines["432x50-800/5000"]
+    assert set(stages) == {
+        "tlm.process_csv_files",
+        "tlm.extract_data",
+        "tlm.calc_data",
+        "tlm.save",
+        "tlm.export",
+        "cmd.process_csv_files",
+        "cmd.calc_cmd_db",
+    }
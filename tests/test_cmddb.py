@@ -0,0 +1,122 @@
+import typing
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cmddb
+
+fixture = Path(__file__).parent / "data" / "SAMPLE_MOBC_CMD_DB_CMD_DB.csv"
+allocation = {"CORE": 16, "CDH": 32, "POWER": 8, "Other": 4}
+
+
+def legacy_calc_cmd_db(allocation: dict, df: pd.DataFrame) -> typing.Tuple[pd.DataFrame, list]:
+    # ベクトル化する前の cmddb-editor.py の calc_cmd_db (iterrows の 2 パス). st.error に出していた区間名を list で返す
+    unknown = []
+    allocation = {k.upper(): v for k, v in allocation.items()}
+    for index, row in df.iterrows():
+        if row["Target"] != "":
+            num_params = sum(1 for i in range(1, 7) if row[f"Param{i} Type"] not in ["", None, np.nan])
+            df.at[index, "Num Params"] = str(num_params)
+        for _type in cmddb.param_type_columns:
+            df[_type] = df[_type].fillna("")
+
+    code_count = 0
+    code_count_next = 0
+    for index, row in df.iterrows():
+        if row["Comment"] == "" and row["Name"] != "":
+            code_str = format(code_count, "04X")
+            df.at[index, "Code"] = f"0x{code_str}"
+            code_count += 1
+        elif row["Comment"].startswith("* "):
+            word = row["Comment"][2:].upper()
+            code_count = code_count_next
+            if word in allocation:
+                code_count_next += allocation[word]
+            else:
+                if word != "NONORDER":
+                    unknown.append(word)
+    return df, unknown
+
+
+@pytest.fixture
+def table() -> pd.DataFrame:
+    return cmddb.load_cmd_db(fixture)["data"]
+
+
+def as_text(df: pd.DataFrame) -> pd.DataFrame:
+    # 以前と同じく Code と Num Params を CSV の文字列にする
+    df = df.copy()
+    df["Code"] = cmddb.format_code(df["Code"])
+    df["Num Params"] = df["Num Params"].astype(object).fillna("").astype(str)
+    return df
+
+
+def assert_same(df: pd.DataFrame) -> typing.Tuple[pd.DataFrame, list]:
+    expected, expected_unknown = legacy_calc_cmd_db(allocation, as_text(df))
+    result = cmddb.calc_cmd_db(allocation, df.copy())
+    assert isinstance(result, tuple) and len(result) == 2
+    actual, unknown = result
+    assert actual["Code"].dtype == cmddb.code_dtype and actual["Num Params"].dtype == cmddb.num_params_dtype
+    pd.testing.assert_frame_equal(as_text(actual), expected)
+    assert unknown == expected_unknown
+    return actual, unknown
+
+
+def test_matches_legacy(table: pd.DataFrame) -> None:
+    df, unknown = assert_same(table)
+    assert unknown == ["UNKNOWN_SECTION"]
+    codes = df.set_index("Name")["Code"]
+    # CORE は 0 から, CDH は CORE の 16 の後, NONORDER は次の区間と同じ番号から, 区間名は大文字小文字を区別しない
+    assert codes["Cmd_BEFORE_SECTION"] == 0x0000
+    assert codes[["Cmd_NOP", "Cmd_TMGR_SET_TIME", "Cmd_AM_REGISTER_APP", "Cmd_RAW"]].tolist() == [0x0000, 0x0001, 0x0002, 0x0003]
+    assert codes["Cmd_CDH_0"] == 0x0010
+    assert codes[["Cmd_NONORDER_0", "Cmd_NONORDER_1"]].tolist() == [0x0030, 0x0031]
+    assert codes["Cmd_UNKNOWN_0"] == 0x0030
+    assert codes[["Cmd_POWER_0", "Cmd_POWER_1"]].tolist() == [0x0030, 0x0031]
+    # "*" でコメントアウトした行は Code を振り直さない
+    assert codes["Cmd_DISABLED"] is pd.NA
+
+
+def test_num_params(table: pd.DataFrame) -> None:
+    df, _ = assert_same(table)
+    num_params = df.set_index("Name")["Num Params"]
+    assert num_params[["Cmd_NOP", "Cmd_AM_REGISTER_APP", "Cmd_RAW", "Cmd_CDH_0"]].tolist() == [0, 3, 2, 6]
+    # Target が空の行は Num Params を書き換えない
+    assert num_params["Cmd_POWER_1"] is pd.NA
+
+
+def test_nan_params(table: pd.DataFrame) -> None:
+    # st.data_editor で追加した行などは Param の型が NaN になる
+    table.loc[table["Name"] == "Cmd_CDH_0", ["Param5 Type", "Param6 Type"]] = np.nan
+    df, _ = assert_same(table)
+    assert df.set_index("Name").loc["Cmd_CDH_0", "Num Params"] == 4
+    assert not df[cmddb.param_type_columns].isna().any().any()
+
+
+def test_blank_names(table: pd.DataFrame) -> None:
+    table.loc[table["Name"] == "Cmd_TMGR_SET_TIME", "Name"] = ""
+    df, _ = assert_same(table)
+    assert df.set_index("Name").loc["Cmd_AM_REGISTER_APP", "Code"] == 0x0001
+
+
+def test_unknown_sections(table: pd.DataFrame) -> None:
+    _, unknown = assert_same(table)
+    assert unknown == ["UNKNOWN_SECTION"]
+    _, unknown = cmddb.calc_cmd_db({}, table.copy())
+    assert unknown == ["CORE", "CDH", "UNKNOWN_SECTION", "POWER"]
+
+
+def test_empty_table(table: pd.DataFrame) -> None:
+    df, unknown = assert_same(table.iloc[:0])
+    assert df.empty and unknown == []
+
+
+def test_render_roundtrip(table: pd.DataFrame) -> None:
+    # 整数にした Code と Num Params は保存するときに元の文字列に戻る
+    assert cmddb.render(cmddb.load_cmd_db(fixture)) == fixture.read_text()
+    assert cmddb.format_code(pd.Series([0x1F, pd.NA], dtype=cmddb.code_dtype)).tolist() == ["0x001F", ""]
+    # 検索は画面と同じ "0x" の形の Code でも当たる
+    df, _ = cmddb.calc_cmd_db(allocation, table.copy())
+    assert df.loc[cmddb.window_labels(df, term="0x0010"), "Name"].tolist() == ["Cmd_CDH_0"]
@@ -0,0 +1,48 @@
+from pathlib import Path
+
+import pytest
+
+import cmddb
+import dbgen
+import dblint
+import tlmdb
+
+settings = {"prefix": dbgen.prefix}
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_tlm_db_roundtrips_through_save(tmp_path: Path, seed: int) -> None:
+    # 作った packet は読み込んで保存し直しても 1 byte も変わらない
+    for csv_path in dbgen.write_tlm_db(tmp_path, packets=20, seed=seed):
+        data = tlmdb.extract_data(csv_path, settings)
+        assert tlmdb.render_source(tlmdb.make_header_frame(data), data) == csv_path.read_bytes(), csv_path.name
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_bitfields_have_continuation_rows(tmp_path: Path, seed: int) -> None:
+    for csv_path in dbgen.write_tlm_db(tmp_path, packets=20, seed=seed):
+        rows = tlmdb.read_rows(csv_path)[tlmdb.num_start_line :]
+        # BitLen を数式でなく値で書いた行は bitfield の先頭か "||" の行で, 先頭の次は "||" の行
+        for row, following in zip(rows, rows[1:] + [None]):
+            if row[2] != "||" and not row[7].startswith("="):
+                assert following is not None and following[2] == "||", (csv_path.name, row[1])
+
+
+def test_packets_fit_in_a_frame(tmp_path: Path) -> None:
+    for csv_path in dbgen.write_tlm_db(tmp_path, packets=40, rows=(50, 800)):
+        df = tlmdb.extract_data(csv_path, settings)["data"]
+        assert int(df["BitLen"].sum()) <= dbgen.max_packet_bytes * 8, csv_path.name
+
+
+def test_raw_is_only_the_last_parameter(tmp_path: Path) -> None:
+    dbgen.write_cmd_db(tmp_path / "CMD_DB.csv", tmp_path / "BCT.csv", commands=2000)
+    df = cmddb.load_cmd_db(tmp_path / "CMD_DB.csv")["data"]
+    types = df[cmddb.param_type_columns].astype(str)
+    num_params = types.ne("").sum(axis=1)
+    for i, column in enumerate(cmddb.param_type_columns, start=1):
+        assert not ((types[column] == "raw") & (num_params != i)).any(), column
+
+
+def test_generated_db_passes_lint(tmp_path: Path) -> None:
+    settings_file = dbgen.generate(tmp_path, packets=40, commands=1000, seed=3)
+    assert dblint.main(["--settings", str(settings_file), "--fail-on", "warning", "-j", "1"]) == 0
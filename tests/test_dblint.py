@@ -0,0 +1,49 @@
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import toml
+
+import dbgen
+import dblint
+
+
+class Py38Executor(ThreadPoolExecutor):
+    # Python 3.8 までの shutdown() には cancel_futures がない
+    def shutdown(self, wait: bool = True) -> None:  # type: ignore[override]
+        super().shutdown(wait)
+
+
+def test_close_while_running(tmp_path: Path) -> None:
+    settings = {"prefix": dbgen.prefix, "path": tmp_path}
+    dbgen.write_tlm_db(tmp_path, packets=30, rows=(20, 40))
+    jobs = dblint.packet_jobs(settings)
+    linter = dblint.Linter(max_workers=1, processes=False)
+    linter._executor = Py38Executor(max_workers=1)
+    results = linter.run(jobs)
+    next(results)
+    # 途中でやめたときの close() は, 始まっていない検査を取り消して待たずに返る
+    linter.close()
+    results.close()
+    assert linter._executor is None and not linter._submitted
+    # 閉じた後でも新しい executor で検査し直せる
+    assert len(dict(linter.run(jobs))) == len(jobs)
+    linter.close()
+
+
+def test_packet_ids_are_checked_per_project(tmp_path: Path, capsys) -> None:
+    settings_file = dbgen.generate(tmp_path, packets=10, commands=100, seed=1)
+    shutil.copytree(tmp_path / "TLM_DB", tmp_path / "TLM_DB_2")
+    settings = toml.load(settings_file)
+    settings["copy"] = {"tlmdb": dict(settings["generated"]["tlmdb"], path="TLM_DB_2", dest_path="TLM_DB_2/calced_data")}
+    settings_file.write_text(toml.dumps(settings))
+    # 別の project が同じ PacketID を使っていても重複にしない
+    assert dblint.main(["--settings", str(settings_file), "--fail-on", "warning", "-j", "1"]) == 0
+    # 同じ project の中の重複は今まで通りエラーにする
+    first = sorted((tmp_path / "TLM_DB_2").glob("*.csv"))[0]
+    shutil.copy(first, first.with_name(first.stem + "_DUP.csv"))
+    capsys.readouterr()
+    assert dblint.main(["--settings", str(settings_file), "--format", "json", "-j", "1"]) == 1
+    issues = json.loads(capsys.readouterr().out)
+    assert [Path(issue["path"]).parent.name for issue in issues if issue["check"] == "duplicate-packet-id"] == ["TLM_DB_2"]
@@ -0,0 +1,35 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import decoder
+import tlmdb
+
+fixture = Path(__file__).parent / "data" / "SAMPLE_MOBC_TLM_DB_FIXTURE.csv"
+settings = {"prefix": "SAMPLE_MOBC_TLM_DB_"}
+
+
+def test_decode_fixture() -> None:
+    df = tlmdb.extract_data(fixture, settings)["data"]
+    plan = decoder.DecodePlan(df)
+    frame = bytearray(plan.length)
+    frame[0] = 0b101_1_0_000  # PH.VER=5, PH.TYPE=1, PH.SH_FLAG=0
+    frame[2:6] = (123456).to_bytes(4, "big")  # SH.TI
+    columns = plan.decode(bytes(frame) * 3)
+    assert list(columns) == plan.names
+    assert columns["PH.VER"].tolist() == [5] * 3
+    assert columns["PH.TYPE"].tolist() == [1] * 3
+    assert columns["SH.TI"].tolist() == [123456] * 3
+    assert columns["SH.TI"].dtype == np.uint32
+
+
+def test_duplicate_names() -> None:
+    df = tlmdb.extract_data(fixture, settings)["data"]
+    # "*" の行は出力しないので, 同じ名前でもよい
+    df.loc[df["Comment"] == "*", "Name"] = "SH.TI"
+    decoder.DecodePlan(df)
+    df.loc[df["Name"] == "PH.APID", "Name"] = "PH.VER"
+    df.loc[df["Name"] == "FIX.GAIN", "Name"] = "FIX.TEMP"
+    with pytest.raises(ValueError, match=r"duplicate field name\(s\): FIX.TEMP, PH.VER$"):
+        decoder.DecodePlan(df)
@@ -0,0 +1,36 @@
+import sys
+import tracemalloc
+
+import pytest
+import streamlit as st
+from streamlit.runtime.scriptrunner import RerunData, RerunException, StopException
+
+import profiling
+
+
+@pytest.mark.parametrize("exception", [StopException(), RerunException(RerunData())])
+def test_rerun_stops_the_capture_when_the_script_ends_early(exception: Exception) -> None:
+    # st.stop() や st.experimental_rerun() で finish_rerun まで行かなくても, cProfile と tracemalloc は止まる
+    st.session_state["test_profile"] = True
+    with pytest.raises(type(exception)):
+        with profiling.rerun("test") as (_, capture):
+            assert capture is not None and tracemalloc.is_tracing()
+            raise exception
+    assert not tracemalloc.is_tracing()
+    assert sys.getprofile() is None
+    assert set(st.session_state["test_capture"]) == {"rerun.prof", "rerun-profile.txt", "rerun-tracemalloc.txt"}
+
+
+def test_rerun_without_profile() -> None:
+    st.session_state["test_profile"] = False
+    with profiling.rerun("test") as (timer, capture):
+        with timer.stage("stage"):
+            pass
+    assert capture is None and list(timer.stages) == ["stage"]
+
+
+def test_stop_twice() -> None:
+    capture = profiling.Capture()
+    capture.start()
+    assert capture.stop() is capture.stop()
+    assert not tracemalloc.is_tracing()
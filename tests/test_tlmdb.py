@@ -0,0 +1,115 @@
+import csv
+import typing
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import tlmdb
+
+fixture = Path(__file__).parent / "data" / "SAMPLE_MOBC_TLM_DB_FIXTURE.csv"
+settings = {"prefix": "SAMPLE_MOBC_TLM_DB_"}
+
+
+def legacy_extract_data(csv_path: Path, settings: dict) -> dict:
+    # ベクトル化する前の tlmdb-editor.py の extract_data (iterrows で 1 行ずつ処理する)
+    data = {"path": Path(), "name": "", "data": pd.DataFrame()}
+    with open(csv_path, "r", errors="ignore") as csv_file:
+        data["path"] = csv_path
+        data["name"] = csv_path.stem.replace(f'{settings["prefix"]}', "")
+        rows = list(csv.reader(csv_file, delimiter=","))
+        data.update({rows[i][1]: rows[i][2] for i in range(4)})
+        data[rows[0][3]] = rows[1][3]
+        rows = rows[tlmdb.num_start_line :]
+        df = pd.DataFrame([{tlmdb.dict_index[i]: col for i, col in enumerate(row) if i in tlmdb.dict_index} for row in rows if row[1]])
+
+        bitlen_pre = 0
+        bitlen_pre_init = True
+        for index, row in df.iterrows():
+            index = typing.cast(int, index)
+            if row["VarType"] == "||":
+                if bitlen_pre_init:
+                    df.at[index - 1, "BitLen"] = bitlen_pre
+                    bitlen_pre_init = False
+            else:
+                bitlen_pre, bitlen_pre_init = row["BitLen"], True
+                df.at[index, "BitLen"] = tlmdb.type2bit[row["VarType"]]
+            if row["ConvType"] == "POLY":
+                for i in range(6):
+                    if row[f"a{i}"] == "":
+                        break
+                    df.at[index, "ConvInfo"] += f"a{i}=" + row[f"a{i}"] + ","
+                if df.at[index, "ConvInfo"][-1] == ",":
+                    df.at[index, "ConvInfo"] = df.at[index, "ConvInfo"][:-1]
+
+        df["VarType"] = df["VarType"].astype(tlmdb.var_type_dtype)
+        df["ExtType"] = df["ExtType"].astype(tlmdb.ext_type_dtype)
+        df["BitLen"] = df["BitLen"].astype(int)
+        df["ConvType"] = df["ConvType"].astype(tlmdb.conv_type_dtype)
+        df["ConvInfo"] = df["ConvInfo"].str.replace("@@ ", ",").str.replace("@@", ",")
+        data["data"] = df
+    return data
+
+
+@pytest.fixture(scope="module")
+def parsed() -> typing.Tuple[dict, dict]:
+    return tlmdb.extract_data(fixture, settings), legacy_extract_data(fixture, settings)
+
+
+def test_header_matches_legacy(parsed: typing.Tuple[dict, dict]) -> None:
+    data, legacy = parsed
+    for key in ["path", "name", "Target", "PacketID", "Enable/Disable", "IsRestricted", "Local Var"]:
+        assert data[key] == legacy[key]
+
+
+@pytest.mark.parametrize("column", ["Comment", "Name", "VarType", "VarOrFunc", "ExtType", "BitLen", "ConvType", "ConvInfo", "Description", "Note"])
+def test_column_matches_legacy(parsed: typing.Tuple[dict, dict], column: str) -> None:
+    # OctPos / BitPos は以前は CSV の数式の文字列のままだったので, 下の test_positions で確かめる
+    data, legacy = parsed
+    assert data["data"][column].astype(object).tolist() == legacy["data"][column].astype(object).tolist()
+
+
+def test_dtypes(parsed: typing.Tuple[dict, dict]) -> None:
+    df = parsed[0]["data"]
+    assert list(df.columns) == tlmdb.editor_columns
+    assert df["VarType"].dtype == tlmdb.var_type_dtype
+    assert df["ExtType"].dtype == tlmdb.ext_type_dtype
+    assert df["ConvType"].dtype == tlmdb.conv_type_dtype
+    assert df["BitLen"].dtype == np.int32
+
+
+def test_fixture_cases(parsed: typing.Tuple[dict, dict]) -> None:
+    df = parsed[0]["data"].set_index("Name")
+    # Name が空の行は読み飛ばす
+    assert "" not in df.index and len(df) == 16
+    # bitfield の先頭と "||" の行は CSV の BitLen, それ以外は VarType の幅
+    assert df.loc[["PH.VER", "PH.TYPE", "PH.SH_FLAG", "PH.APID", "SH.TI"], "BitLen"].tolist() == [3, 1, 1, 11, 32]
+    assert df.loc[["FIX.FLAGS", "FIX.FLAG_A", "FIX.FLAG_B", "FIX.FLAG_C"], "BitLen"].tolist() == [4, 2, 1, 1]
+    # POLY は最初の空欄までの係数, STATUS は "@@" と "@@ " の区切りを "," にする
+    assert df.loc["FIX.TEMP", "ConvInfo"] == "a0=-273.15,a1=0.01"
+    assert df.loc["FIX.GAIN", "ConvInfo"] == "a0=1,a1=2.5,a2=-0.125,a3=3e-05,a4=4,a5=5"
+    assert df.loc["FIX.OFFSET", "ConvInfo"] == "a0=0.5"
+    assert df.loc["FIX.LAST", "ConvInfo"] == "a0=10"
+    assert df.loc["FIX.MODE", "ConvInfo"] == "0=OFF,1=ON,2=SAFE"
+    assert df.loc["FIX.FLAGS", "ConvInfo"] == "0=NG,1=OK"
+    assert df.loc["FIX.MODE", "Description"] == "mode, commented out"
+
+
+def test_positions(parsed: typing.Tuple[dict, dict]) -> None:
+    df = parsed[0]["data"]
+    bits = np.concatenate(([0], np.cumsum(df["BitLen"].to_numpy())[:-1]))
+    assert df["OctPos"].tolist() == (bits // 8).tolist()
+    assert df["BitPos"].tolist() == (bits % 8).tolist()
+    assert df.set_index("Name").loc["SH.TI", ["OctPos", "BitPos"]].tolist() == [2, 0]
+
+
+def test_save_roundtrip(parsed: typing.Tuple[dict, dict], tmp_path: Path) -> None:
+    # save で書いた CSV を読み直すと同じ表になり, もう一度 save しても同じ内容になる
+    data = parsed[0]
+    content = tlmdb.render_source(tlmdb.make_header_frame(data), data)
+    path = tmp_path / fixture.name
+    path.write_bytes(content)
+    reloaded = tlmdb.extract_data(path, settings)
+    pd.testing.assert_frame_equal(reloaded["data"], data["data"])
+    assert tlmdb.render_source(tlmdb.make_header_frame(reloaded), reloaded) == content
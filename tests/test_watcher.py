@@ -0,0 +1,54 @@
+import time
+from pathlib import Path
+
+import pytest
+
+import watcher
+
+
+def wait_for(watch: watcher.FileWatcher, cursor: int, path: Path, timeout: float = 5.0) -> None:
+    # バックグラウンドのスレッドが path の変更を記録し, 1 回の書き込みによる続きのイベントも記録し終わるまで待つ
+    deadline = time.monotonic() + timeout
+    latest, changed = watch.changes(cursor)
+    while path not in changed:
+        if time.monotonic() > deadline:
+            raise AssertionError("no change recorded")
+        time.sleep(0.02)
+        latest, changed = watch.changes(cursor)
+    while True:
+        time.sleep(0.2)
+        settled, _ = watch.changes(cursor)
+        if settled == latest:
+            return
+        latest = settled
+
+
+@pytest.mark.parametrize("use_inotify", [True, False])
+def test_each_cursor_sees_every_change(tmp_path: Path, use_inotify: bool) -> None:
+    a, b = tmp_path / "A.csv", tmp_path / "B.csv"
+    a.write_text("a")
+    watch = watcher.FileWatcher([tmp_path], interval=0.05, use_inotify=use_inotify)
+    try:
+        # 2 つの session の cursor. 最初の呼び出しは今の位置だけを返す
+        first, changed = watch.changes(None)
+        second, _ = watch.changes(None)
+        assert changed == set()
+        time.sleep(0.1)
+        a.write_text("aa")
+        wait_for(watch, first, a)
+        first, changed = watch.changes(first)
+        assert changed == {a}
+        # 一方の session が取り出しても, もう一方の session にも同じ変更が見える
+        b.write_text("b")
+        wait_for(watch, first, b)
+        second, changed = watch.changes(second)
+        assert changed == {a, b}
+        first, changed = watch.changes(first)
+        assert changed == {b}
+        assert watch.changes(first)[1] == set() and watch.changes(second)[1] == set()
+        # 監視していない名前の変更は記録しない
+        (tmp_path / "note.txt").write_text("x")
+        time.sleep(0.2)
+        assert watch.changes(first)[1] == set()
+    finally:
+        watch.close()
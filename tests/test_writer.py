@@ -0,0 +1,47 @@
+import threading
+import time
+from pathlib import Path
+
+import writer
+
+
+def test_coalesces_writes_to_the_same_path() -> None:
+    queue = writer.WriteBehind(delay=0.1)
+    calls = []
+    first = queue.submit(Path("a.csv"), lambda: calls.append(1) or 1)
+    second = queue.submit(Path("a.csv"), lambda: calls.append(2) or 2)
+    assert [result.value for result in queue.flush()] == [2]
+    assert calls == [2] and first.result().value == second.result().value == 2
+    queue.close()
+
+
+def test_flush_waits_for_the_write_in_flight() -> None:
+    # スレッドが取り出して書き込み中のものも, flush() が返る時点で書き終わっている
+    queue = writer.WriteBehind(delay=0.0)
+    started, done = threading.Event(), []
+
+    def slow() -> str:
+        started.set()
+        time.sleep(0.3)
+        done.append(True)
+        return "written"
+
+    queue.submit(Path("a.csv"), slow)
+    assert started.wait(1)
+    assert queue.busy(Path("a.csv")) and not queue.busy(Path("b.csv"))
+    assert [result.value for result in queue.flush([Path("a.csv")])] == ["written"]
+    assert done == [True] and not queue.busy(Path("a.csv"))
+    assert queue.last[Path("a.csv")].value == "written"
+    queue.close()
+
+
+def test_errors_are_reported() -> None:
+    queue = writer.WriteBehind(delay=0.0)
+
+    def fail() -> None:
+        raise OSError("disk full")
+
+    result = queue.submit(Path("a.csv"), fail).result(1)
+    assert result.error == "OSError: disk full"
+    assert queue.rows()[0]["Error"] == "OSError: disk full"
+    queue.close()